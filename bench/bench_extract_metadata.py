@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the chunked metadata reader of extract_metadata.py.
+
+Runs extract_metadata.py on a synthetic metadata table with and without
+--chunksize, and checks that both write byte-identical tables and ID
+lists. Besides the filter columns, the table has columns whose dtype
+depends on rows that are filtered out (integers with missing values
+only in other lineages, booleans, numbers with leading zeros and
+strings), so that the chunked read has to reproduce the dtypes pandas
+infers over the whole table. Blank lines are scattered through the
+table, so that row numbers are not line numbers in the file.
+
+usage: python bench/bench_extract_metadata.py [--rows 20000]
+                                              [--chunksize 1000]
+"""
+
+import argparse
+import gzip
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'bin', 'extract_metadata.py')
+
+
+def make_metadata(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    lineage = rng.choice(['BA.2', 'BA.1', 'B.1.1.7', 'XBB.1.5'], rows)
+    other = lineage != 'BA.2'
+    df = pd.DataFrame({
+        'isolate': ['sample_%d' % i for i in range(rows)],
+        'lineage': lineage,
+        'geo_loc_name_state_province_territory': rng.choice(
+            ['Ontario', 'Quebec', 'Alberta'], rows),
+        'host_scientific_name': rng.choice(
+            ['Homo sapiens', 'Homo sapiens', 'Felis catus'], rows),
+        'length': rng.integers(28500, 29900, rows),
+        'sample_collection_date': (
+            pd.Timestamp('2022-01-01') + pd.to_timedelta(
+                rng.integers(0, 120, rows), unit='D')).strftime('%Y-%m-%d')})
+    # integers, missing only in rows of other lineages
+    for col in ['ct_value', 'num_ambiguous']:
+        values = pd.Series(rng.integers(10, 30000, rows), dtype='Int64')
+        values[other & (rng.random(rows) < 0.3)] = pd.NA
+        df[col] = values
+    df['passed_qc'] = rng.choice(['True', 'False'], rows)
+    # numbers with leading zeros, and strings in a few rows
+    df['lab_code'] = ['%05d' % x for x in rng.integers(0, 1000, rows)]
+    df.loc[other & (rng.random(rows) < 0.01), 'lab_code'] = 'unknown'
+    df['coverage'] = np.round(rng.random(rows) * 100, 2)
+    return df
+
+
+def run(table, args, cwd):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script, '--table', table] + args,
+                   cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def outputs(directory):
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(os.path.join(directory, name), 'rb') as fp:
+            files[name] = fp.read()
+    return files
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks chunked metadata reading')
+    parser.add_argument('--rows', type=int, default=20000,
+                        help='Number of metadata rows to generate')
+    parser.add_argument('--chunksize', type=int, default=1000,
+                        help='Chunk size of the chunked read')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    modes = {
+        'lineage': ['--voc', 'BA.2', '--outtable', 'BA.2.tsv.gz',
+                    '--outids', 'BA.2.txt'],
+        'location': ['--voc', 'BA.2', '--location', 'Ontario',
+                     '--startdate', '2022-02-01', '--enddate', '2022-03-01',
+                     '--outtable', 'BA.2.tsv.gz', '--outids', 'BA.2.txt'],
+        'time': ['--criteria', 'time', '--startdate', '2022-01-01',
+                 '--enddate', '2022-04-30', '--window', '14']}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        table = os.path.join(tmp, 'metadata.tsv.gz')
+        lines = make_metadata(args.rows).to_csv(
+            sep='\t', index=False).splitlines(keepends=True)
+        with gzip.open(table, 'wt') as fp:
+            for i, line in enumerate(lines):
+                fp.write(line)
+                if i % 97 == 1:
+                    fp.write('\n')
+        for mode, mode_args in modes.items():
+            results = {}
+            for label, extra in [('whole', []),
+                                 ('chunked', ['--chunksize',
+                                              str(args.chunksize)])]:
+                outdir = os.path.join(tmp, mode + '_' + label)
+                os.mkdir(outdir)
+                t = run(table, mode_args + extra, outdir)
+                results[label] = outputs(outdir)
+                print(f"{mode:>8} {label:>8}: {t:8.3f}s")
+            assert results['whole'] == results['chunked'], \
+                mode + ': chunked output differs'
+    print("chunked output identical")
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark for the GVF attribute codec in bin/functions.py.
+
+Compares separate_attributes/rejoin_attributes against the previous
+row-wise pandas implementations on a synthetic GVF, and checks that
+both produce byte-identical '#attributes' strings.
+
+usage: python bench/bench_gvf_attributes.py [--rows 5000] [--repeat 3]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+from functions import separate_attributes, rejoin_attributes, \
+    attribute_keys
+from functions import empty_attributes, gvf_columns
+
+
+def legacy_separate_attributes(df):
+    attributes = df['#attributes'].str.split(pat=';').apply(pd.Series)
+    attributes = attributes.drop(labels=len(attributes.columns) - 1,
+                                 axis=1)
+    for column in attributes.columns:
+        split = attributes[column].str.split(pat='=').apply(pd.Series)
+        title = split[0].drop_duplicates().tolist()[0]
+        attributes[column] = split[1]
+        attributes.rename(columns={column: title}, inplace=True)
+    return pd.concat((df, attributes), axis=1)
+
+
+def legacy_rejoin_attributes(df, empty_attributes_str):
+    columns_to_join = empty_attributes_str.split('=;')[:-1]
+    for col in columns_to_join:
+        df[col] = col + "=" + df[col].astype(str) + ';'
+    df['#attributes'] = df[columns_to_join].apply(
+        lambda row: ''.join(row.values.astype(str)), axis=1)
+    return df.drop(columns=columns_to_join)
+
+
+def make_gvf(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    gvf = pd.DataFrame(index=range(rows), columns=gvf_columns)
+    gvf['#seqid'] = 'NC_045512.2'
+    gvf['#source'] = '.'
+    gvf['#type'] = 'snp'
+    gvf['#start'] = rng.integers(1, 29903, rows).astype(str)
+    gvf['#end'] = gvf['#start']
+    gvf['#score'] = '.'
+    gvf['#strand'] = '+'
+    gvf['#phase'] = '.'
+    attributes = pd.DataFrame(
+        {key: [key + '_' + str(x) for x in rng.integers(0, 50, rows)]
+         for key in attribute_keys(empty_attributes)})
+    attributes['alternate_frequency'] = rng.random(rows)
+    attributes['clade_defining'] = attributes['alternate_frequency'] > 0.75
+    attributes['function_description'] = ''
+    gvf['#attributes'] = legacy_rejoin_attributes(
+        attributes, empty_attributes)['#attributes']
+    return gvf
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the GVF attribute codec')
+    parser.add_argument('--rows', type=int, default=5000,
+                        help='Number of GVF rows to generate')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs per implementation')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    gvf = make_gvf(args.rows)
+
+    # check that both implementations round-trip to identical strings
+    legacy = legacy_rejoin_attributes(
+        legacy_separate_attributes(gvf.copy()), empty_attributes)
+    new = rejoin_attributes(separate_attributes(gvf.copy()),
+                            empty_attributes)
+    assert legacy['#attributes'].tolist() == new['#attributes'].tolist()
+    assert gvf['#attributes'].tolist() == new['#attributes'].tolist()
+
+    for label, separate, rejoin in [
+            ('legacy', legacy_separate_attributes, legacy_rejoin_attributes),
+            ('codec', separate_attributes, rejoin_attributes)]:
+        t_sep = min(timeit.repeat(lambda: separate(gvf.copy()),
+                                  number=1, repeat=args.repeat))
+        separated = separate(gvf.copy())
+        t_join = min(timeit.repeat(
+            lambda: rejoin(separated.copy(), empty_attributes),
+            number=1, repeat=args.repeat))
+        print(f"{label:>8}: separate {t_sep:8.3f}s  rejoin {t_join:8.3f}s "
+              f"({args.rows} rows)")
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark for functions.unnest_multi.
+
+Compares unnest_multi against the previous per-column
+list-comprehension/merge implementation on a synthetic frame shaped
+like a parsed wastewater VCF (ALT, ao, type and EFF records as list
+columns of 1-3 alleles per row), and checks both give the same result.
+
+usage: python bench/bench_unnest_multi.py [--rows 50000] [--repeat 3]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+from functions import unnest_multi
+
+
+def legacy_unnest_multi(df, columns, reset_index=False):
+    df_flat = pd.DataFrame(columns=columns)
+    for col in columns:
+        col_flat = pd.DataFrame([[i, x]
+                                 for i, y in df[col].apply(list).items()
+                                 for x in y], columns=['I', col])
+        col_flat = col_flat.set_index('I')
+        df_flat[col] = col_flat
+    df = df.drop(labels=columns, axis=1)
+    df = df.merge(df_flat, left_index=True, right_index=True)
+    if reset_index:
+        df = df.reset_index(drop=True)
+    return df
+
+
+def make_vcf_frame(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    n_alleles = rng.choice([1, 1, 1, 2, 3], rows)
+    df = pd.DataFrame({
+        '#CHROM': 'NC_045512.2',
+        'POS': rng.integers(1, 29903, rows).astype(str),
+        'REF': 'C',
+        'dp': rng.integers(100, 5000, rows).astype(str),
+        'ro': rng.integers(0, 100, rows).astype(str)})
+    df['ALT'] = [list('TGA'[:n]) for n in n_alleles]
+    df['ao'] = [[str(x) for x in rng.integers(1, 100, n)] for n in n_alleles]
+    df['type'] = [['snp'] * n for n in n_alleles]
+    df['eff_result'] = [['missense_variant(MODERATE|MISSENSE|Gca/Gta|'
+                         'p.A222V/c.665C>T|1273|S|protein_coding|CODING|'
+                         'GU280_gp02|1|' + alt + ')' for alt in alts]
+                        for alts in df['ALT']]
+    return df
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks unnest_multi')
+    parser.add_argument('--rows', type=int, default=50000,
+                        help='Number of VCF records to generate')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs per implementation')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    df = make_vcf_frame(args.rows)
+    columns = ['eff_result', 'ao', 'ALT', 'type']
+
+    legacy = legacy_unnest_multi(df, columns, reset_index=True)
+    new = unnest_multi(df, columns, reset_index=True)
+    assert legacy.equals(new)
+
+    for label, unnest in [('legacy', legacy_unnest_multi),
+                          ('offsets', unnest_multi)]:
+        t = min(timeit.repeat(
+            lambda: unnest(df, columns, reset_index=True),
+            number=1, repeat=args.repeat))
+        print(f"{label:>8}: {t:8.3f}s ({args.rows} rows -> "
+              f"{new.shape[0]} rows)")
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks ivar2gvf.py against the fixture in bench/ivar2gvf.
+
+variants.tsv holds iVar variants on a synthetic reference
+(reference.fasta, random bases with the codons around each variant
+planted), named with the SARS-CoV-2 gene positions JSON: an intergenic
+substitution, missense substitutions (D614G, P4715L and one at 13468,
+where ORF1b starts), an in-frame deletion moved 3' (H69_V70del), an
+insertion (R214_D215insEPE), an in-frame duplication (K375dup), and
+frameshifts by a duplicated base (F147fs, g.438dup) and by a deletion
+moved 3' into the next codon (F1353fs). The GVF written must be
+identical to expected.gvf.
+
+usage: python bench/check_ivar2gvf.py
+"""
+
+import difflib
+import os
+import subprocess
+import sys
+import tempfile
+
+bench = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(bench, '..', 'bin', 'ivar2gvf.py')
+fixture = os.path.join(bench, 'ivar2gvf')
+gene_positions = os.path.join(bench, '..', 'assets', 'virus_geneCoordinates',
+                              'NC_045512.2', 'NC_045512.2.json')
+
+
+if __name__ == '__main__':
+
+    with tempfile.TemporaryDirectory() as tmp:
+        outgvf = os.path.join(tmp, 'variants.gvf')
+        subprocess.run([sys.executable, script,
+                        '--ivar_tsv', os.path.join(fixture, 'variants.tsv'),
+                        '--reference', os.path.join(fixture,
+                                                    'reference.fasta'),
+                        '--gene_positions', gene_positions,
+                        '--outgvf', outgvf],
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(outgvf) as fp:
+            output = fp.readlines()
+
+    with open(os.path.join(fixture, 'expected.gvf')) as fp:
+        expected = fp.readlines()
+
+    if output != expected:
+        sys.stdout.writelines(difflib.unified_diff(
+            expected, output, 'expected.gvf', 'ivar2gvf.py'))
+        sys.exit(1)
+    print("ivar2gvf output matches expected.gvf")
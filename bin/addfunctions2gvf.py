@@ -13,10 +13,14 @@ The attributes completed by this script are:
 
 """
 import argparse
+import hashlib
+import os
 import pandas as pd
 import numpy as np
 from functions import separate_attributes, rejoin_attributes
-from functions import empty_attributes, gvf_columns, vcf_columns
+from functions import read_gvf, write_gvf
+from functions import empty_attributes, gvf_columns, vcf_columns, \
+    attribute_keys
 
 
 def parse_args():
@@ -26,6 +30,10 @@ def parse_args():
                         help='Path to a GVF file')
     parser.add_argument('--outgvf', type=str,
                         help='Filename for the output GVF file')
+    parser.add_argument('--format', type=str, default='gvf',
+                        choices=['gvf', 'parquet'],
+                        help='Output format; parquet keeps the attributes '
+                             'in separate columns for the next stage')
     parser.add_argument('--functional_annotations', type=str,
                         default=None, help='TSV file of functional '
                                            'annotations')
@@ -34,71 +42,184 @@ def parse_args():
                               "functional annotations to "
                               "this .txt filename for "
                               "troubleshooting purposes")
+    parser.add_argument('--annotation_index', type=str, default=None,
+                        help='Prebuilt .npz index of the functional '
+                             'annotations; it is (re)built and saved here '
+                             'if missing or out of date')
     return parser.parse_args()
     
 
-def add_pokay_annotations(gvf, annotation_file):
-    
-    # expand #attributes into columns to fill in separately
-    gvf = separate_attributes(gvf)
-    
-    # drop columns that are going to be re-added in the merge
-    functional_attributes = ["function_category", "function_description", 
-                             "source", "citation", "comb_mutation", 
-                             "heterozygosity"]
-    gvf = gvf.drop(columns=functional_attributes)
+functional_attributes = ["function_category", "function_description",
+                         "source", "citation", "comb_mutation",
+                         "heterozygosity"]
+
+
+def annotation_checksum(annotation_file):
+    # checksum of the functional annotations TSV, stored with the index
+    # so that a stale index can be detected
+    with open(annotation_file, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
 
+def read_annotations(annotation_file):
     # load functional annotations spreadsheet
     df = pd.read_csv(annotation_file, sep='\t', header=0)
     # remove any leading/trailing spaces
     for column in df.columns:
         df[column] = df[column].str.strip()
 
-    # merge annotated vcf and functional annotation files by 'Name' and 'alias'
-    df = df.rename(columns={"mutation": "Name", "gene": "protein_symbol", "alias":"Pokay_alias"})
-    merged_df = pd.merge(df, gvf, on=['Name', 'protein_symbol'], how='right') #, 'alias'
+    # rename columns to match the GVF attributes
+    df = df.rename(columns={"mutation": "Name", "gene": "protein_symbol",
+                            "alias": "Pokay_alias"})
 
     # data cleaning
-    merged_df['comb_mutation'] = merged_df['comb_mutation'].str.replace(
+    df['comb_mutation'] = df['comb_mutation'].str.replace(
         "B.1.617.2\\tT19R", "T19R", regex=False)
-    
-    # update ID attribute based on mutation groups
-    
-    # collect all mutation groups (including reference mutation) in
-    # merged_df["mutation_group"], sorted alphabetically
-    
-    # join columns with commas in between
-    merged_df["mutation_group"] = \
-        merged_df["Name"].astype(str) + "," + \
-        merged_df["comb_mutation"].astype(str) + "," + \
-        merged_df['multiaa_comb_mutation'].astype(str)
+    # change semicolons in function descriptions to colons
+    df['function_description'] = df['function_description'].str.replace(
+        ';', ':')
+    return df
+
+
+def mutation_group(name, comb_mutation, multiaa_comb_mutation):
+    # all mutations of a group (including the reference mutation),
+    # sorted alphabetically
+    # join names with commas in between
+    group = name + "," + comb_mutation + "," + multiaa_comb_mutation
     # cleaning: remove nans, quotations marks, spaces
     for x in [' ', 'nan', "'", '"']:
-        merged_df["mutation_group"] = merged_df[
-            "mutation_group"].str.replace(x, '')
+        group = group.replace(x, '')
     # cleaning: remove extra commas
-    merged_df["mutation_group"] = merged_df[
-        "mutation_group"].str.replace(',,', ',')
-    merged_df["mutation_group"] = merged_df[
-        "mutation_group"].str.strip(',')
-    # sort each row alphabetically
-    # extract column into a list (each row is an element)
-    unsorted_group_list = merged_df["mutation_group"].tolist()
-    # convert each element of the list to a list, making a nested list
-    nested_list = [x.split(",") for x in unsorted_group_list]
-    # sort sublists alphabetically
-    nested_list = [sorted(x) for x in nested_list]
-    # return sublists to strings
-    sorted_group_list = [",".join(x) for x in nested_list]
-    # add sorted lists back to the df
-    merged_df["mutation_group"] = pd.Series(sorted_group_list)
+    group = group.replace(',,', ',').strip(',')
+    return sorted(group.split(","))
+
+
+def build_annotation_index(annotation_file):
+    """
+    Builds a lookup index of the functional annotations, for
+    add_pokay_annotations.
+
+    'keys' holds the sorted "Name<tab>protein_symbol" keys of the
+    annotations, and 'key_rows' the annotation row of each key (rows with
+    the same key in file order). Each functional attribute is stored as
+    codes into its unique values ('codes_<attribute>',
+    'values_<attribute>'; -1 if missing), and 'mutation_group' holds the
+    sorted mutation group of each row, for GVF rows without a
+    multiaa_comb_mutation.
+    """
+    df = read_annotations(annotation_file)
+
+    index = {"checksum": annotation_checksum(annotation_file)}
+    for attribute in functional_attributes:
+        codes, values = pd.factorize(df[attribute])
+        index["codes_" + attribute] = codes.astype(np.int32)
+        index["values_" + attribute] = np.array(values, dtype=str)
+
+    keyed = df['Name'].notna() & df['protein_symbol'].notna()
+    rows = np.flatnonzero(keyed.to_numpy())
+    keys = (df['Name'][keyed] + "\t" + df['protein_symbol'][keyed]).to_numpy(
+        dtype=str)
+    order = np.argsort(keys, kind='stable')
+    index["keys"] = keys[order]
+    index["key_rows"] = rows[order]
+
+    index["mutation_group"] = np.array(
+        [",".join(mutation_group(str(name), str(comb), ''))
+         for name, comb in zip(df['Name'], df['comb_mutation'])], dtype=str)
+    return index
+
+
+def save_annotation_index(index, filepath):
+    # compressed, as the function descriptions are long and padded to
+    # the same width; an index staged as a symlink (eg. by Nextflow) is
+    # replaced rather than written through
+    if os.path.islink(filepath):
+        os.remove(filepath)
+    with open(filepath, 'wb') as fp:
+        np.savez_compressed(fp, **index)
+
+
+def load_annotation_index(filepath, annotation_file):
+    """
+    Loads a functional annotation index saved as .npz. If the file does
+    not exist, or was built from a different annotations TSV, the index
+    is rebuilt and saved to filepath.
+    """
+    if os.path.exists(filepath):
+        with np.load(filepath) as npz:
+            index = dict((key, npz[key]) for key in npz.files)
+        if str(index["checksum"]) == annotation_checksum(annotation_file):
+            return index
+        print("Functional annotation index " + filepath +
+              " does not match " + annotation_file + "; rebuilding")
+
+    index = build_annotation_index(annotation_file)
+    save_annotation_index(index, filepath)
+    return index
+
+
+def add_pokay_annotations(gvf, annotation_file, annotation_index=None):
+    # takes and returns a GVF with #attributes expanded into
+    # separate columns; annotation_index is a prebuilt
+    # build_annotation_index(annotation_file), built here if not given
+    if annotation_index is None:
+        annotation_index = build_annotation_index(annotation_file)
+
+    # drop columns that are going to be re-added in the merge
+    gvf = gvf.drop(columns=functional_attributes).reset_index(drop=True)
+
+    # look up the annotation rows of each GVF row by 'Name' and
+    # 'protein_symbol', as a right join: GVF rows in order, each
+    # repeated once per matching annotation (or kept once, unannotated)
+    keys = annotation_index["keys"]
+    gvf_keys = (gvf['Name'].astype(str) + "\t" +
+                gvf['protein_symbol'].astype(str)).to_numpy(dtype=str)
+    first = np.searchsorted(keys, gvf_keys, side='left')
+    counts = np.searchsorted(keys, gvf_keys, side='right') - first
+    n_rows = np.maximum(counts, 1)
+    gvf_rows = np.repeat(np.arange(len(gvf)), n_rows)
+    offsets = np.arange(len(gvf_rows)) - np.repeat(np.cumsum(n_rows) - n_rows,
+                                                  n_rows)
+    matched = np.repeat(counts, n_rows) > 0
+    # annotation row of each merged row, -1 if unannotated
+    key_rows = np.append(annotation_index["key_rows"], -1)
+    annotation_rows = key_rows[np.where(
+        matched, np.repeat(first, n_rows) + offsets, len(keys))]
+
+    merged_df = gvf.iloc[gvf_rows].reset_index(drop=True)
+    for attribute in functional_attributes:
+        codes = np.append(annotation_index["codes_" + attribute], -1)
+        values = np.append(
+            annotation_index["values_" + attribute].astype(object), np.nan)
+        merged_df[attribute] = values[codes[annotation_rows]]
+
+    # update ID attribute based on mutation groups
+
+    # collect all mutation groups (including reference mutation) in
+    # merged_df["mutation_group"], sorted alphabetically; the groups of
+    # annotated rows without a multiaa_comb_mutation are prebuilt
+    prebuilt_groups = np.append(
+        annotation_index["mutation_group"].astype(object), None)
+    groups = prebuilt_groups[annotation_rows]
+    multiaa = merged_df['multiaa_comb_mutation'].astype(str).to_numpy()
+    todo = np.flatnonzero(~matched | (multiaa != ''))
+    built_groups = {}
+    for i, name, comb in zip(todo, merged_df['Name'].astype(str).to_numpy()[todo],
+                             merged_df['comb_mutation'].astype(str).to_numpy()[todo]):
+        group = (name, comb, multiaa[i])
+        if group not in built_groups:
+            built_groups[group] = ",".join(mutation_group(*group))
+        groups[i] = built_groups[group]
+    merged_df["mutation_group"] = groups
 
     # make another column to check if all members of the group are
     # represented individually in 'Name' (True/False)
     unique_Name_entries = set(merged_df['Name'].tolist())
-    group_fully_represented = [set(x).issubset(unique_Name_entries)
-                               for x in nested_list]
-    merged_df['group_fully_represented'] = group_fully_represented
+    group_codes, unique_groups = pd.factorize(merged_df["mutation_group"])
+    group_fully_represented = np.array(
+        [set(x.split(",")).issubset(unique_Name_entries)
+         for x in unique_groups], dtype=bool)
+    merged_df['group_fully_represented'] = group_fully_represented[group_codes]
     # drop rows with mutation group members not found in 'Name',
     # leaving the index unchanged
     merged_df = merged_df[merged_df['group_fully_represented']==True]
@@ -107,11 +228,7 @@ def add_pokay_annotations(gvf, annotation_file):
     # in 'mutation_group' get the same ID
     merged_df['ID'] = 'ID_' + merged_df.groupby(
         'mutation_group', sort=False).ngroup().astype(str)
-    
-    # change semicolons in function descriptions to colons
-    merged_df['function_description'] = merged_df[
-        'function_description'].str.replace(';', ':')
-    
+
     # change heterozygosity column to True/False
     merged_df['heterozygosity'] = merged_df['heterozygosity'] == \
                                   'heterozygous'
@@ -119,37 +236,29 @@ def add_pokay_annotations(gvf, annotation_file):
     # replace NaNs in df with empty string
     merged_df = merged_df.fillna('')
 
-    # merge attributes back into a single column
-    merged_df = rejoin_attributes(merged_df, empty_attributes)
-
-    return merged_df[gvf_columns]
+    return merged_df[gvf_columns + attribute_keys(empty_attributes)]
 
 
 if __name__ == '__main__':
 
     args = parse_args()
     
-    # read in gvf file
-    gvf = pd.read_csv(args.ingvf, sep='\t', names=gvf_columns, index_col=False)
-
-    # remove pragmas and original header row
-    pragmas = gvf[gvf['#seqid'].astype(str).str.contains("##")]
-    pragmas.columns = range(9)
-    pragmas = pragmas.fillna('')
-    gvf = gvf[~gvf['#seqid'].astype(str).str.contains("#")]
+    # read in gvf file, with #attributes expanded into columns
+    gvf, pragmas = read_gvf(args.ingvf)
 
     # add functional annotations
-    pokay_annotated_gvf = add_pokay_annotations(gvf, args.functional_annotations)
+    annotation_index = None
+    if args.annotation_index:
+        annotation_index = load_annotation_index(args.annotation_index,
+                                                 args.functional_annotations)
+    pokay_annotated_gvf = add_pokay_annotations(
+        gvf, args.functional_annotations, annotation_index)
 
-    # add pragmas to df, then save to .gvf
-    # columns are now 0, 1, ...
-    final_gvf = pd.DataFrame(np.vstack([pokay_annotated_gvf.columns,
-                                            pokay_annotated_gvf]))
-    final_gvf = pragmas.append(final_gvf)
+    # add pragmas and save modified file
     filepath = args.outgvf  # outdir + strain + ".annotated.gvf"
+    write_gvf(pokay_annotated_gvf, pragmas, filepath, args.format)
     print("Saved as: ", filepath)
     print("")
-    final_gvf.to_csv(filepath, sep='\t', index=False, header=False)
 
 
     # get name troubleshooting report
@@ -158,9 +267,9 @@ if __name__ == '__main__':
         # functional_annotations) to a .tsv file
         
         # create mask to find which rows do not have a functional annotation
-        notinPokay_mask = pokay_annotated_gvf["#attributes"].str.contains("function_category=;")
-        # extract all mutation names from #attributes column
-        names = pd.Series(pokay_annotated_gvf["#attributes"].str.findall('(?<=Name=)(.*?)(?=;)').str[0])
+        notinPokay_mask = pokay_annotated_gvf["function_category"] == ''
+        # mutation names
+        names = pokay_annotated_gvf["Name"]
         # get unique mutation names not in Pokay
         unmatched_names = pd.Series(names[notinPokay_mask].unique())
         # save unmatched names to file
@@ -170,7 +279,7 @@ if __name__ == '__main__':
             print("")
             print(str(unmatched_names.shape[0]) +
                   " mutation names not matched with functional annotations "
-                  "file saved to " + leftover_names_filepath)
+                  "file saved to " + args.names)
 
     print("")
     print("Processing complete.")
@@ -12,17 +12,18 @@ The attributes completed by this script are:
 """
 
 import argparse
+import json
 import pandas as pd
 import numpy as np
 from functions import separate_attributes, rejoin_attributes, get_variant_info
+from functions import read_gvf, write_gvf, build_lineage_trie, load_lineage_trie
 from functions import empty_attributes, gvf_columns, vcf_columns
 
 
-def add_variant_information(clade_file, gvf, strain):    
-    # get variant info from clades file
-
-    # expand #attributes into columns to fill in separately
-    gvf = separate_attributes(gvf)
+def add_variant_information(clade_file, gvf, strain, alias_key=None,
+                            lineage_trie_file=None):
+    # get variant info from clades file; takes and returns a GVF with
+    # #attributes expanded into separate columns
     
     variant_attributes = ["variant", "variant_type", "voi_designation_date",
                    "voc_designation_date", "vum_designation_date",
@@ -36,8 +37,16 @@ def add_variant_information(clade_file, gvf, strain):
         clades = pd.read_csv(clade_file, sep='\t', header=0)
         clades = clades.fillna('')
         
+        # index lineages in the clades file, reusing a saved trie if
+        # one is given
+        if lineage_trie_file is not None:
+            lineage_trie = load_lineage_trie(lineage_trie_file, clades,
+                                             alias_key)
+        else:
+            lineage_trie = build_lineage_trie(clades, alias_key)
+
         # retrieve relevant variant information from clades file
-        x = get_variant_info(strain, clades)
+        x = get_variant_info(strain, clades, lineage_trie)
         
         # if the strain is listed in the file,
         # add variant attributes to the GVF
@@ -50,11 +59,6 @@ def add_variant_information(clade_file, gvf, strain):
             gvf["status"] = x.status
         else:
             gvf[[variant_attributes]] = "n/a"
-    
-    # merge attributes back into a single column
-    gvf = rejoin_attributes(gvf, empty_attributes)
-
-                                    
                                     
     return(gvf)
 
@@ -66,12 +70,23 @@ def parse_args():
                         help='Path to a GVF file')
     parser.add_argument('--outgvf', type=str,
                         help='Filename for the output GVF file')
+    parser.add_argument('--format', type=str, default='gvf',
+                        choices=['gvf', 'parquet'],
+                        help='Output format; parquet keeps the attributes '
+                             'in separate columns for the next stage')
     parser.add_argument('--strain', type=str,
                         default='n/a',
                         help='Lineage; user mode is if strain="n/a"')
     parser.add_argument('--clades', type=str, default='n/a',
                         help='TSV file of WHO strain names and '
                              'VOC/VOI status')
+    parser.add_argument('--alias_key', type=str, default=None,
+                        help='Pango alias_key.json, to match aliased '
+                             'lineages (eg. Q.1 and B.1.1.7.1)')
+    parser.add_argument('--lineage_trie', type=str, default=None,
+                        help='JSON file caching the lineages of the '
+                             'clades file; it is (re)built and saved here '
+                             'if missing or out of date')
     return parser.parse_args()
 
  
@@ -79,26 +94,20 @@ if __name__ == '__main__':
 
     args = parse_args()                                          
 
-    # read in gvf file
-    gvf = pd.read_csv(args.ingvf, sep='\t', names=gvf_columns, index_col=False)
+    # read in gvf file, with #attributes expanded into columns
+    gvf, pragmas = read_gvf(args.ingvf)
 
-    # remove pragmas and original header row
-    pragmas = gvf[gvf['#seqid'].astype(str).str.contains("##")]
-    pragmas.columns = range(9)
-    pragmas = pragmas.fillna('')
-    gvf = gvf[~gvf['#seqid'].astype(str).str.contains("#")]
-        
     # add variant info
+    alias_key = None
+    if args.alias_key:
+        with open(args.alias_key) as fp:
+            alias_key = json.load(fp)
     variant_annotated_gvf = add_variant_information(
-        args.clades, gvf, args.strain)
-    
-    # add pragmas to df, then save to .gvf
-    # columns are now 0, 1, ...
-    final_gvf = pd.DataFrame(np.vstack([variant_annotated_gvf.columns,
-                                            variant_annotated_gvf]))
-    final_gvf = pragmas.append(final_gvf)
+        args.clades, gvf, args.strain, alias_key, args.lineage_trie)
+
+    # add pragmas and save modified file
     filepath = args.outgvf  # outdir + strain + ".annotated.gvf"
+    write_gvf(variant_annotated_gvf, pragmas, filepath, args.format)
     print("Saved as: ", filepath)
     print("")
-    final_gvf.to_csv(filepath, sep='\t', index=False, header=False)
 
@@ -12,8 +12,11 @@ also filters sequences based on the provided criteria.
 """
 import argparse
 import pandas as pd
+import numpy as np
 import csv
+import os
 import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -44,6 +47,21 @@ def parse_args():
                         help='Metadata file (.tsv) format')
     parser.add_argument('--outids', type=str, default=None,
                         help='ids file (.txt) format')
+    parser.add_argument('--chunksize', type=int, default=0,
+                        help='Number of rows to read at a time when '
+                             'filtering; if "0" the whole table is read '
+                             'at once; Default=0')
+    parser.add_argument('--partition', type=str, default=None,
+                        help='File of lineages, one per line; extracts '
+                             'all of them in one pass, writing '
+                             '<lineage>_metadata.tsv.gz and <lineage>.txt '
+                             'for each lineage to --outdir')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes writing time windows '
+                             'with --criteria time; Default=1')
+    parser.add_argument('--outdir', type=str, default='.',
+                        help='Output directory for --partition; '
+                             'Default=.')
                                                                            
                                                        
     return parser.parse_args()
@@ -56,12 +74,12 @@ def sub_sampling(dataframe, subsampling):
     return dataframe
 
 
-def write_ids(dataframe, start_date, end_date):
+def write_ids(dataframe, start_date, end_date, criteria, outids):
     ids = dataframe['isolate'].tolist()
     #with open(args.outids, 'w') as filehandle:
     #         filehandle.writelines("%s\n" % id for id in ids)
-    if args.criteria == "lineage":
-        with open(args.outids, 'w') as filehandle:
+    if criteria == "lineage":
+        with open(outids, 'w') as filehandle:
             filehandle.writelines("%s\n" % id for id in ids)
     else:
         with open( str(start_date)+ "_" + str(end_date) + ".txt", 'w') as filehandle:
@@ -93,13 +111,158 @@ def filter_metadata(dataframe):
         dataframe = dataframe[dataframe['length'] >= 29000]        
     return dataframe
 
+
+
+# repetitive strings the metadata is filtered on, read as categories
+# when reading in chunks
+categorical_columns = ['lineage', 'geo_loc_name_state_province_territory',
+                       'host_scientific_name']
+
+
+def parse_collection_dates(dataframe):
+    if 'sample_collection_date' in dataframe.columns:
+        dataframe['sample_collection_date'] = pd.to_datetime(dataframe[
+                                            'sample_collection_date'],
+                                            format='%Y-%m-%d',
+                                            errors='coerce')
+    return dataframe
+
+
+def filter_rows(dataframe):
+    """ Filtering for human associated and consensus sequence of
+        at least 29Kb, and lineage, location and dates if given """
+    if args.criteria == "lineage":
+        if not args.partition == None:
+            dataframe = dataframe[dataframe['lineage'].isin(lineages)]
+        elif not args.voc == None:
+            dataframe = dataframe[dataframe['lineage'] == args.voc]
+        return data_filtering(dataframe=dataframe)
+    return filter_metadata(dataframe=dataframe)
+
+
+def combine_dtypes(dtype, other):
+    # dtype a column gets when read whole, from the dtypes read_csv gave
+    # two parts of it: integers with missing values in either part become
+    # floats, and anything other than numbers is read as objects
+    if dtype == other:
+        return dtype
+    if pd.api.types.is_numeric_dtype(dtype) and \
+            pd.api.types.is_numeric_dtype(other) and \
+            not pd.api.types.is_bool_dtype(dtype) and \
+            not pd.api.types.is_bool_dtype(other):
+        return np.result_type(dtype, other)
+    return np.dtype(object)
+
+
+def read_filtered_metadata(table, chunksize):
+    """
+    Reads the metadata rows that pass filter_rows without loading the
+    whole table. The table is read in chunks to find the rows to keep,
+    recording the dtype each column would get if read at once, then read
+    again in the same chunks with these dtypes, keeping those rows by
+    their order in the data, so the memory used depends on the number of
+    rows extracted and the output is the same as reading the whole table.
+    """
+    header = pd.read_csv(table, sep="\t", compression='gzip', nrows=0).columns
+    dtype = dict((col, 'category') for col in categorical_columns
+                 if col in header)
+
+    keep = [np.zeros(0, dtype=np.int64)]
+    column_dtypes = {}
+    for chunk in pd.read_csv(table, sep="\t", low_memory=False,
+                             compression='gzip', dtype=dtype,
+                             parse_dates=['sample_collection_date'],
+                             chunksize=chunksize):
+        for col in chunk.columns.difference(
+                list(dtype) + ['sample_collection_date']):
+            column_dtypes[col] = combine_dtypes(
+                column_dtypes.get(col, chunk[col].dtype), chunk[col].dtype)
+        chunk = parse_collection_dates(chunk)
+        keep.append(filter_rows(chunk).index.to_numpy())
+    keep = np.concatenate(keep)
+
+    # the chunks number their rows on from the previous one, so the same
+    # chunking gives the same row numbers whatever the lines in the file
+    column_dtypes.update((col, object) for col in dtype)
+    kept = [chunk[np.isin(chunk.index.to_numpy(), keep)]
+            for chunk in pd.read_csv(table, sep="\t", low_memory=False,
+                                     compression='gzip', dtype=column_dtypes,
+                                     parse_dates=['sample_collection_date'],
+                                     chunksize=chunksize)]
+    dataframe = pd.concat(kept, ignore_index=True)
+    return parse_collection_dates(dataframe)
+
+
+def time_windows(dataframe, sdate, edate, window):
+    """
+    Splits the metadata into windows of `window` days from sdate to
+    edate, yielding the start and end date and the rows of each window.
+    The collection dates are sorted once and the window boundaries found
+    with searchsorted; within a window, rows keep their order in the
+    table.
+    """
+    dates = dataframe['sample_collection_date'].to_numpy()
+    rows = np.flatnonzero(~pd.isna(dates))
+    order = rows[np.argsort(dates[rows], kind='stable')]
+    sorted_dates = dates[order]
+
+    while sdate <= edate:
+        query_date = sdate + pd.DateOffset(days=window - 1)
+        start = np.searchsorted(sorted_dates, sdate.to_datetime64(),
+                                side='left')
+        end = np.searchsorted(sorted_dates, query_date.to_datetime64(),
+                              side='right')
+        yield (str(sdate)[:10], str(query_date)[:10],
+               np.sort(order[start:end]))
+        sdate += pd.DateOffset(days=window)
+
+
+# metadata the time windows are taken from, in worker processes
+window_metadata = None
+
+
+def set_window_metadata(dataframe):
+    # process pool initializer: with fork the metadata is inherited, not
+    # copied; with spawn it is sent once per worker
+    global window_metadata
+    window_metadata = dataframe
+
+
+def write_window(dataframe, rows, start_date, end_date, samplingsize,
+                 criteria, outtable, outids):
+    # subsample the rows of a time window and write them out
+    sub_meta = sub_sampling(dataframe=dataframe.iloc[rows],
+                            subsampling=samplingsize)
+    write_ids(dataframe=sub_meta, start_date=start_date, end_date=end_date,
+              criteria=criteria, outids=outids)
+    write_metadata(dataframe=sub_meta, start_date=start_date,
+                   end_date=end_date, criteria=criteria, outtable=outtable)
+
+
+def write_worker_window(rows, start_date, end_date, *write_args):
+    write_window(window_metadata, rows, start_date, end_date, *write_args)
+
+
+def write_partitions(dataframe, lineages, outdir):
+    # one metadata table and ids file per lineage, the same as running
+    # with --voc for each of them
+    rows = dataframe.groupby('lineage', sort=False, observed=True).indices
+    for lineage in lineages:
+        sub_meta = dataframe.iloc[rows.get(lineage, [])]
+        sub_meta = sub_sampling(dataframe=sub_meta,
+                                subsampling=args.samplingsize)
+        with open(os.path.join(outdir, lineage + ".txt"), 'w') as filehandle:
+            filehandle.writelines("%s\n" % id for id in sub_meta['isolate'])
+        sub_meta.to_csv(os.path.join(outdir, lineage + "_metadata.tsv.gz"),
+                        sep="\t", compression='gzip', quoting=csv.QUOTE_NONE,
+                        index=False, header=True)
     
 
-def write_metadata(dataframe, start_date, end_date):
+def write_metadata(dataframe, start_date, end_date, criteria, outtable):
     # dataframe.to_csv(args.outtable, sep="\t", compression='gzip',
     #                   quoting=csv.QUOTE_NONE, index=False, header=True)
-    if args.criteria == "lineage":
-        dataframe.to_csv(args.outtable, sep="\t", compression='gzip',
+    if criteria == "lineage":
+        dataframe.to_csv(outtable, sep="\t", compression='gzip',
                      quoting=csv.QUOTE_NONE, index=False, header=True)
     else:
         dataframe.to_csv( str(start_date)+ "_" + str(end_date) + 
@@ -113,42 +276,57 @@ def write_metadata(dataframe, start_date, end_date):
 if __name__ == '__main__':
     args = parse_args()
 
-    Metadata = pd.read_csv(args.table, sep="\t", low_memory=False, compression='gzip',
-                           parse_dates=['sample_collection_date'])
-
-    if 'sample_collection_date' in Metadata.columns:
-        Metadata['sample_collection_date'] = pd.to_datetime(Metadata[
-                                            'sample_collection_date'],
-                                            format='%Y-%m-%d',
-                                            errors='coerce')
-
-        sdate = pd.to_datetime(args.startdate, format='%Y-%m-%d')
-        edate = pd.to_datetime(args.enddate, format='%Y-%m-%d')
-        location=args.location
-        window=args.window
+    sdate = pd.to_datetime(args.startdate, format='%Y-%m-%d')
+    edate = pd.to_datetime(args.enddate, format='%Y-%m-%d')
+    location=args.location
+    window=args.window
 
+    # lineages to extract with --partition
+    lineages = []
+    if not args.partition == None:
+        with open(args.partition) as fp:
+            lineages = list(dict.fromkeys(line.strip() for line in fp
+                                          if line.strip()))
 
-    """ Filtering for human associated and consensus sequence of
-        at least 29Kb """ 
+    if args.chunksize > 0:
+        # stream the table, keeping only the rows that pass the filters
+        Metadata = read_filtered_metadata(args.table, args.chunksize)
+    else:
+        Metadata = pd.read_csv(args.table, sep="\t", low_memory=False, compression='gzip',
+                               parse_dates=['sample_collection_date'])
+        Metadata = parse_collection_dates(Metadata)
+        Metadata = filter_rows(Metadata)
     
-    if args.criteria == "lineage":
-        if not args.voc == None:
-            Metadata = Metadata[Metadata['lineage'] == args.voc]
-        
-        Metadata = data_filtering(dataframe=Metadata)
+    if args.criteria == "lineage" and not args.partition == None:
+        write_partitions(dataframe=Metadata, lineages=lineages,
+                         outdir=args.outdir)
+    elif args.criteria == "lineage":
         Metadata = sub_sampling(dataframe=Metadata, subsampling=args.samplingsize)
-        write_ids(dataframe=Metadata, start_date=sdate, end_date=edate)
-        write_metadata(dataframe=Metadata, start_date=sdate, end_date=edate)    
+        write_ids(dataframe=Metadata, start_date=sdate, end_date=edate,
+                  criteria=args.criteria, outids=args.outids)
+        write_metadata(dataframe=Metadata, start_date=sdate, end_date=edate,
+                       criteria=args.criteria, outtable=args.outtable)
     else:
-        Metadata = filter_metadata(dataframe=Metadata)
-        while sdate <= edate:
-            query_date = sdate + pd.DateOffset(days=window - 1)
-            #print(sdate, query_date)
-            sub_meta = Metadata.query('sample_collection_date >= @sdate and sample_collection_date <= @query_date')
-            #print(len(sub_meta))
-            sub_meta = sub_sampling(dataframe=sub_meta, subsampling=args.samplingsize)
-            
-            write_ids(dataframe=sub_meta, start_date=str(sdate)[:10], end_date=str(query_date)[:10])
-            write_metadata(dataframe=sub_meta, start_date=str(sdate)[:10], end_date=str(query_date)[:10])
-            
-            sdate += pd.DateOffset(days=window)
+        # subsample and write each window as it is found; workers take
+        # the rows of a window from their own reference to the metadata,
+        # with at most --workers windows queued at a time
+        windows = time_windows(Metadata, sdate, edate, window)
+        write_args = (args.samplingsize, args.criteria, args.outtable,
+                      args.outids)
+        if args.workers > 1:
+            with ProcessPoolExecutor(max_workers=args.workers,
+                                     initializer=set_window_metadata,
+                                     initargs=(Metadata,)) as executor:
+                futures = []
+                for start_date, end_date, rows in windows:
+                    if len(futures) >= args.workers:
+                        futures.pop(0).result()
+                    futures.append(executor.submit(
+                        write_worker_window, rows, start_date, end_date,
+                        *write_args))
+                for future in futures:
+                    future.result()
+        else:
+            for start_date, end_date, rows in windows:
+                write_window(Metadata, rows, start_date, end_date,
+                             *write_args)
@@ -1,6 +1,11 @@
 import pandas as pd
 import numpy as np
 import logging
+import itertools
+import re
+import hashlib
+import json
+import os
 
 # standard variables used by all scripts
 empty_attributes = 'ID=;Name=;alias=;gene=;protein_name=;protein_symbol=;\
@@ -26,27 +31,82 @@ pragmas = pd.DataFrame([['##gff-version 3'],
                         ['##species']])
 
 
-def separate_attributes(df):
+def attribute_keys(attributes_str=empty_attributes):
+    # get the ordered attribute tags of a "key=;key=;" schema string
+    # like empty_attributes (last one will be empty)
+    return attributes_str.split('=;')[:-1]
+
+
+def decode_attributes(attributes, keys):
+    """
+    Parses a series of '#attributes' strings that all follow the fixed
+    schema given by keys (eg. attribute_keys(empty_attributes)) into a
+    dataframe with one column per tag, in a single vectorized pass.
+
+    Returns None if any row does not follow the schema exactly (missing
+    or reordered tags, or '=' or ';' inside a value), so that the caller
+    can fall back to the generic parser.
+    """
+    n_rows = attributes.shape[0]
+    n_keys = len(keys)
+    try:
+        joined = ''.join(attributes.tolist())
+    except TypeError:
+        # non-string (eg. NaN) entries
+        return None
+
+    # every row ends in ';', so the joined column splits into alternating
+    # tags and values with one empty string left over at the end
+    tokens = joined.replace(';', '=').split('=')
+    if len(tokens) != 2 * n_keys * n_rows + 1:
+        return None
+    tokens = np.array(tokens[:-1], dtype=object).reshape(n_rows, n_keys, 2)
+
+    # check that all tags are in the schema order
+    if not (tokens[:, :, 0] == np.array(keys, dtype=object)).all():
+        return None
+
+    return pd.DataFrame(tokens[:, :, 1], index=attributes.index,
+                        columns=keys)
+
+
+def encode_attributes(df, keys):
+    """
+    Serializes the attribute columns named in keys into a list of
+    '#attributes' strings ('key=value;' for every key, in order).
+    """
+    # one format string for the whole schema, filled once per row
+    template = ''.join(key + '={};' for key in keys)
+    values = [df[col].astype(str).tolist() for col in keys]
+    return [template.format(*row) for row in zip(*values)]
+
+
+def separate_attributes(df, attributes_str=empty_attributes):
     # expand #attributes column into multiple columns for each attribute,
     # keeping the original #attributes column
-    
-    # split #attributes column into separate columns for each tag
-    # split at ;, form dataframe
-    attributes = df['#attributes'].str.split(pat=';').apply(pd.Series)
-    # last column is a copy of the index so drop it
-    attributes = attributes.drop(labels=len(attributes.columns) - 1,
-                                 axis=1)
 
-    for column in attributes.columns:
-        split = attributes[column].str.split(pat='=').apply(pd.Series)
-        title = split[0].drop_duplicates().tolist()[0] #.lower()
+    # fast path: #attributes follows the fixed GVF schema
+    attributes = decode_attributes(df['#attributes'],
+                                   attribute_keys(attributes_str))
+
+    if attributes is None:
+        # split #attributes column into separate columns for each tag
+        # split at ;, form dataframe
+        attributes = df['#attributes'].str.split(pat=';', expand=True)
+        # last column is the empty string after the trailing ; so drop it
+        attributes = attributes.drop(labels=len(attributes.columns) - 1,
+                                     axis=1)
+
+        for column in attributes.columns:
+            split = attributes[column].str.split(pat='=', n=2, expand=True)
+            title = split[0].drop_duplicates().tolist()[0] #.lower()
 
-        content = split[1]
+            content = split[1].where(split[1].notna(), np.nan)
 
-        # ignore "tag=" in column content
-        attributes[column] = content
-        # make attribute tag as column label
-        attributes.rename(columns={column: title}, inplace=True)
+            # ignore "tag=" in column content
+            attributes[column] = content
+            # make attribute tag as column label
+            attributes.rename(columns={column: title}, inplace=True)
 
     # replace attributes column in the original df with the new
     # separated out attributes
@@ -57,20 +117,104 @@ def separate_attributes(df):
 
 def rejoin_attributes(df, empty_attributes_str):
     # get column names as list
-    columns_to_join = empty_attributes_str.split('=;')[:-1] #last one will be empty
-    for col in columns_to_join:
-        df[col] = col + "=" + df[col].astype(str) + ';'
+    columns_to_join = attribute_keys(empty_attributes_str)
     # replace #attributes column with filled attributes
-    df['#attributes'] = df[columns_to_join].apply(lambda row: ''.join(row.values.astype(str)), axis=1)
+    df['#attributes'] = encode_attributes(df, columns_to_join)
     df = df.drop(columns=columns_to_join)
     
     return(df)
     
 
+def read_gvf(filepath):
+    """
+    Reads a GVF file, either as text or as the columnar .parquet format
+    written by write_gvf(..., file_format='parquet').
+
+    Returns the GVF with #attributes expanded into separate columns, and
+    the pragmas as a dataframe (one pragma per row in column 0).
+    """
+    if filepath.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(filepath)
+        metadata = table.schema.metadata or {}
+        gvf = table.to_pandas()
+        # placeholder, filled in by rejoin_attributes
+        gvf.insert(gvf_columns.index('#attributes'), '#attributes', '')
+        pragmas = pd.DataFrame(
+            json.loads(metadata.get(b'gvf_pragmas', b'[]')),
+            dtype=object).reindex(columns=range(9)).fillna('')
+        return gvf, pragmas
+
+    gvf = pd.read_csv(filepath, sep='\t', names=gvf_columns, index_col=False)
+
+    # remove pragmas and original header row
+    pragmas = gvf[gvf['#seqid'].astype(str).str.contains("##")]
+    pragmas.columns = range(9)
+    pragmas = pragmas.fillna('')
+    gvf = gvf[~gvf['#seqid'].astype(str).str.contains("#")]
+
+    # expand #attributes into columns
+    gvf = separate_attributes(gvf)
+
+    return gvf, pragmas
+
+
+def write_gvf(gvf, pragmas, filepath, file_format='gvf'):
+    """
+    Saves a GVF with #attributes expanded into separate columns.
+
+    file_format='gvf' writes the canonical GVF text: pragmas, header and
+    the attributes merged back into a single #attributes column.
+    file_format='parquet' keeps the attributes as separate
+    (dictionary-encoded) string columns, holding the same text they
+    would have in the GVF, and stores the pragmas in the file metadata.
+    This is meant for intermediate files read back with read_gvf.
+    """
+    keys = attribute_keys(empty_attributes)
+
+    if file_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        gvf = gvf[[col for col in gvf_columns if col != '#attributes']
+                  + keys].reset_index(drop=True)
+        # attributes hold the text they would be rejoined with; missing
+        # values in the other columns are kept as nulls
+        for col in gvf.columns:
+            if col in keys:
+                gvf[col] = gvf[col].astype(str)
+            else:
+                gvf[col] = gvf[col].astype(str).where(gvf[col].notna(), None)
+        table = pa.Table.from_pandas(gvf, preserve_index=False)
+        pragma_lines = pragmas[0].astype(str).tolist()
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'gvf_pragmas'] = json.dumps(
+            [[x] for x in pragma_lines]).encode()
+        table = table.replace_schema_metadata(metadata)
+        pq.write_table(table, filepath, use_dictionary=True)
+        return
+
+    # merge attributes back into a single column
+    gvf = rejoin_attributes(gvf, empty_attributes)
+    gvf = gvf[gvf_columns]
+
+    # add pragmas to df, then save to .gvf
+    # columns are now 0, 1, ...
+    final_gvf = pd.DataFrame(np.vstack([gvf.columns, gvf]))
+    final_gvf = pragmas.append(final_gvf)
+    final_gvf.to_csv(filepath, sep='\t', index=False, header=False)
+
+
 def get_unknown_labels(df):
 # determines variant calling source (eg. iVar) based on pragmas
 # returns GVF-relevant names for last column ("unknown") of vcf
-    source = df['#CHROM'][df['#CHROM'].str.contains("##source=")].values[0].split("=")[1].split()[0]
+    source_line = df['#CHROM'][df['#CHROM'].str.contains("##source=")].values[0]
+    return get_source_labels(source_line)
+
+
+def get_source_labels(source_line):
+# returns GVF-relevant names for last column ("unknown") of vcf, given
+# the "##source=" pragma line
+    source = source_line.split("=")[1].split()[0]
     if source=="freeBayes":
         columns = [x.lower() for x in ["GT","DP","AD","RO","QR","AO","QA","GL"]]
     elif source=="iVar":
@@ -82,66 +226,142 @@ def get_unknown_labels(df):
     return columns
         
 
-def parse_pango_lineages(strain, dataframe):
+def expand_pango_lineages(pango_lineage):
     '''
-    Expands the pango_lineage column in the clades file into
-    a nested list called who_lineages, where each inside
-    list is one expanded row of pango_lineages.
-    
-    Returns the nested list, as well as the row index for
-    the input strain (if found).
+    Expands one pango_lineage entry of the clades file into a list of
+    lineage names, eg. "Q,AP" -> ["Q", "AP"] and
+    "B[A|B],B.1.617.[2|3]" -> ["BA", "BB", "B.1.617.2", "B.1.617.3"].
     '''
-    # initialize variables
-    who_lineages = []
-    var_to_match = 'None'
-    
-    # for each who_variant, expand the lineage names in
-    # pango_lineages and save these to a list
-    for var in dataframe["pango_lineage"]:
-        var_pango_lineages = []
-        if "," in var:
-            for temp in var.split(","):
-                if not "[" in var:
-                    var_pango_lineages.append(temp)
-                    var_pango_lineages.append(temp + ".*")
-                    if strain.startswith(temp):
-                        var_to_match = var
-                else:
-                    parent=temp[0]
-                    child=temp[2:-1].split("|")
-                    for c in child:
-                        var_pango_lineages.append(parent + str(c))
-                        var_pango_lineages.append(parent+str(c)+".*")
-                        if strain.startswith(parent + str(c)):
-                            var_to_match = var
-        else:
-            var_pango_lineages.append(var)
-            if strain.startswith(var):
-                var_to_match = var    
-        
-        # append the list for each variant to the larger
-        # list for all variants
-        who_lineages.append(var_pango_lineages)
-        
-        # get the row index for information on the input strain
-        if var_to_match != 'None':
-            strain_index = dataframe.index[dataframe['pango_lineage'] == \
-                                 var_to_match].tolist()[0]
-        else:
-            strain_index = 'n/a'
-        
-    return who_lineages, strain_index
+    lineages = []
+    for name in pango_lineage.split(","):
+        name = name.strip()
+        if "[" in name:
+            parent, children = name.split("[", 1)
+            children, suffix = children.split("]", 1)
+            lineages.extend(parent + child + suffix
+                            for child in children.split("|"))
+        elif name:
+            lineages.append(name)
+    return lineages
+
+
+def uncompress_lineage(lineage, alias_key):
+    # replace the alias at the start of a Pango lineage with the full
+    # lineage it stands for, eg. BA.2 -> B.1.1.529.2; recombinants (X*)
+    # and unknown prefixes are left as they are
+    prefix, dot, rest = lineage.partition(".")
+    full_name = alias_key.get(prefix)
+    if isinstance(full_name, str) and full_name != "":
+        return full_name + dot + rest
+    return lineage
+
+
+def build_lineage_trie(clades, alias_key=None):
+    """
+    Builds a prefix trie of the lineages in the pango_lineage column of
+    the clades file, for resolve_lineages.
+
+    Lineages are split at '.' and each node is a dict of the next name
+    parts. A node where a clades row ends stores the row number under
+    '$', which matches the lineage and all its sublineages; a lineage
+    ending in '.*' is stored under '*' and only matches sublineages.
+    If the Pango alias_key is given, all lineages are uncompressed so
+    that eg. Q.1 and B.1.1.7.1 resolve to the same variant.
+    """
+    trie = {}
+    for row, pango_lineage in enumerate(clades["pango_lineage"].fillna("")):
+        for lineage in expand_pango_lineages(pango_lineage):
+            if alias_key is not None:
+                lineage = uncompress_lineage(lineage, alias_key)
+            parts = lineage.split(".")
+            key = "$"
+            if parts[-1] == "*":
+                parts = parts[:-1]
+                key = "*"
+            node = trie
+            for part in parts:
+                node = node.setdefault(part, {})
+            # later rows overwrite earlier ones
+            node[key] = row
+    return {"trie": trie, "alias_key": alias_key,
+            "checksum": lineage_trie_checksum(clades, alias_key)}
+
+
+def lineage_trie_checksum(clades, alias_key=None):
+    # checksum of what the trie is built from
+    pango_lineages = clades["pango_lineage"].fillna("").tolist()
+    return json_checksum({"pango_lineage": pango_lineages,
+                          "alias_key": alias_key})
+
+
+def load_lineage_trie(filepath, clades, alias_key=None):
+    """
+    Loads a lineage trie saved as JSON by an earlier run. If the file
+    does not exist, or was built from a different clades file or alias
+    key, the trie is rebuilt and saved to filepath.
+    """
+    if os.path.exists(filepath):
+        with open(filepath) as fp:
+            lineage_trie = json.load(fp)
+        if lineage_trie["checksum"] == lineage_trie_checksum(clades,
+                                                             alias_key):
+            return lineage_trie
+        logging.info("Lineage trie " + filepath +
+                     " does not match the clades file; rebuilding")
+
+    lineage_trie = build_lineage_trie(clades, alias_key)
+    with open(filepath, 'w') as fp:
+        json.dump(lineage_trie, fp)
+    return lineage_trie
+
+
+def match_lineage(lineage, lineage_trie):
+    # row of the clades file for one lineage (-1 if not found); the
+    # most specific match wins, eg. BB.2 is Mu even though BB is listed
+    # under Omicron
+    if not isinstance(lineage, str):
+        return -1
+    if lineage_trie["alias_key"] is not None:
+        lineage = uncompress_lineage(lineage, lineage_trie["alias_key"])
+    parts = lineage.split(".")
+    node = lineage_trie["trie"]
+    row = -1
+    for i, part in enumerate(parts):
+        node = node.get(part)
+        if node is None:
+            break
+        if "$" in node:
+            row = node["$"]
+        if "*" in node and i < len(parts) - 1:
+            row = node["*"]
+    return row
+
+
+def resolve_lineages(lineages, lineage_trie):
+    """
+    Resolves an array of lineages to rows of the clades file (-1 where
+    the lineage is not listed). Each distinct lineage is only looked up
+    once.
+    """
+    codes, uniques = pd.factorize(pd.Series(lineages, dtype=object))
+    # codes are -1 for missing values, which picks the trailing -1
+    rows = np.array([match_lineage(lineage, lineage_trie)
+                     for lineage in uniques] + [-1], dtype=np.int64)
+    return rows[codes]
 
 
 class get_variant_info:
 
-    def __init__(self, strain, clades):
+    def __init__(self, strain, clades, lineage_trie=None):
 
         # retrieve row number that matches the input strain
-        who_lineages, var_index = parse_pango_lineages(strain, clades)
+        if lineage_trie is None:
+            lineage_trie = build_lineage_trie(clades)
+        var_index = match_lineage(strain, lineage_trie)
 
         # save status, WHO strain name, etc. from clades file
-        if var_index != 'n/a':
+        if var_index != -1:
+            var_index = clades.index[var_index]
             self.who_variant = clades.loc[var_index, 'variant']
             self.variant_type = clades.loc[var_index, 'variant_type']
             self.voi_designation_date = clades.loc[var_index, 'voi_designation_date']
@@ -157,17 +377,25 @@ def unnest_multi(df, columns, reset_index=False):
 # expands out columns of lists into 1d, as well as
 # duplicating other non-specified rows as needed.
 # all the lists must be the same length across columns in a given row, but
-# can vary between rows
-# adapted from https://stackoverflow.com/questions/21160134/flatten-a-column-with-value-of-type-list-while-duplicating-the-other-columns-va
-    df_flat = pd.DataFrame(columns=columns)
-    for col in columns:
-        col_flat = pd.DataFrame([[i, x] 
-                       for i, y in df[col].apply(list).iteritems() 
-                           for x in y], columns=['I', col])
-        col_flat = col_flat.set_index('I')
-        df_flat[col] = col_flat
+# can vary between rows; rows with empty lists are dropped.
+# the other columns are repeated once per list element using a single
+# lengths array, and the list columns are flattened in one pass each
+    lists = dict((col, [x if isinstance(x, list) else list(x)
+                        for x in df[col]]) for col in columns)
+    lengths = np.array([len(x) for x in lists[columns[0]]], dtype=np.int64)
+    for col in columns[1:]:
+        col_lengths = np.array([len(x) for x in lists[col]], dtype=np.int64)
+        if not np.array_equal(lengths, col_lengths):
+            row = df.index[np.flatnonzero(lengths != col_lengths)[0]]
+            raise ValueError("Lists in columns " + columns[0] + " and " +
+                             col + " have different lengths in row " +
+                             str(row))
+
+    # repeat each row of the other columns once per list element
     df = df.drop(labels=columns, axis=1)
-    df = df.merge(df_flat, left_index=True, right_index=True)
+    df = df.take(np.repeat(np.arange(df.shape[0]), lengths))
+    for col in columns:
+        df[col] = list(itertools.chain.from_iterable(lists[col]))
     if reset_index:
         df = df.reset_index(drop=True)
     return df
@@ -196,11 +424,20 @@ def select_snpeff_records(eff_string, ao_count):
     return EFF_records_list
 
 
-def find_sample_size(table, lineage, vcf_file, wastewater):
+def read_size_stats(table):
+    # read the 'file' and 'num_seqs' columns of a seqkit stats table
+    return pd.read_csv(table, delim_whitespace=True,
+                       usecols=['file', 'num_seqs'])
+
+
+def find_sample_size(table, lineage, vcf_file, wastewater,
+                     strain_tsv_df=None):
+    # strain_tsv_df is the already-loaded table (see read_size_stats),
+    # to avoid re-reading it when converting many VCFs
     sample_size='n/a'
     if table != 'n/a':
-        strain_tsv_df = pd.read_csv(table, delim_whitespace=True,
-                                    usecols=['file', 'num_seqs'])
+        if strain_tsv_df is None:
+            strain_tsv_df = read_size_stats(table)
 
         # Reference mode
         if lineage != 'n/a':
@@ -239,105 +476,137 @@ def find_sample_size(table, lineage, vcf_file, wastewater):
 
 
     
-def parse_INFO(df, var_cols): # return INFO dataframe with named columns, including EFF split apart
-
-    # make 'INFO' column easier to extract attributes from:
-    # split at ;, form dataframe
-    info = df['INFO'].str.split(pat=';').apply(pd.Series)
-
-    for column in info.columns:
-        split = info[column].str.split(pat='=').apply(pd.Series)
-        title = split[0].drop_duplicates().tolist()[0]
-        if isinstance(title, str):
-            title = title.lower()
-            content = split[1]
-            # ignore "tag=" in column content
-            info[column] = content
-            # make attribute tag as column label
-            info.rename(columns={column: title}, inplace=True)
-
-    # concatenate info and df horizontally
-    df = pd.concat([df, info], axis=1)
-    df = df.drop(columns="INFO")
-
-    # expand "unknown" column into multiple named columns
-    unknown = df['unknown'].str.split(pat=':').apply(pd.Series)
-    unknown.columns = var_cols
-    #drop columns in df that have the same name as 'unknown' column names
-    cols_to_drop = list(set(df.columns) & set(unknown.columns)) 
-    df = df.drop(columns=cols_to_drop)
-
-    df = pd.concat([df, unknown], axis=1)
-    # make ALT, AO, type into lists
-    for column in ["ao", "ALT"]:
-        df[column] = df[column].str.split(",")
-    if "type" in df.columns: # "type" is not an attribute of INFO for wastewater
-        df["type"] = df["type"].str.split(",")   
-    # get number of AO values given in "unknown" column
-    df['ao_count'] = df["ao"].str.len()
-    
-    # parse EFF entry from INFO
-    df["eff_result"] = [select_snpeff_records(x, y) for x, y in
-                        zip(df['eff'], df["ao_count"])]
-    #df.to_csv("eff_result_checking.tsv", sep="\t")
-    # check how many "type" entries there are
-    #df['eff_result_len'] = df["eff_result"].str.len()
-    #df['type_len'] = df["type"].str.len()
-    #print(df.query('eff_result_len != type_len'))
-    #mismatch = df.query(df.query('eff_result_len != type_len'))[['POS', 'eff_result', 'eff_result_len', 'ao', 'type']]
-    #mismatch.to_csv("mismatches.csv", sep='\t', header=True, index=True)
-    # unnest list columns
-    if "type" in df.columns: # "type" is not an attribute of INFO for wastewater
-        df = unnest_multi(df, ["eff_result", "ao", "ALT", "type"], reset_index=True)
-    else:
-        df = unnest_multi(df, ["eff_result", "ao", "ALT"], reset_index=True)
-    # calculate Alternate Frequency
-    df['AF'] = df['ao'].astype(int) / df['dp'].astype(int)
+# INFO attributes that are copied to the GVF as-is if present
+vcf_info_attributes = ['ps_filter', 'ps_exc', 'mat_pep', 'mat_pep_desc',
+                       'mat_pep_acc']
 
-    # expand the contents of eff_result into separate columns, named as in the 
-    # VCF header
-    eff_info = df['eff_result'].str.findall('\((.*?)\)').str[0]
-    # split at pipe, form dataframe
-    eff_info = eff_info.str.split(pat='|').apply(pd.Series)
-    num_cols = len(eff_info.columns)
-    eff_info_cols = ['Effect_Impact','Functional_Class','Codon_Change','Amino_Acid_Change','Amino_Acid_length','Gene_Name','Transcript_BioType','Gene_Coding','Transcript_ID','Exon_Rank','Genotype ERRORS', 'Genotype WARNINGS'][:num_cols]
-    eff_info.columns = eff_info_cols
-
-    df = pd.concat([df, eff_info], axis=1)
-    df = df.drop(columns='eff_result')
-    
 
-    # split df['Amino_Acid_Change'] into two columns: one for HGVS amino acid
-    # names, and the righthand column for nucleotide-level names
-    name_mask = df['Amino_Acid_Change'].str.contains('/')
-    df.loc[~name_mask, 'Amino_Acid_Change'] = '/' + df['Amino_Acid_Change']
-    hgvs = df['Amino_Acid_Change'].str.rsplit(pat='/').apply(pd.Series)
-    hgvs.columns = ["hgvs_protein", "hgvs_nucleotide"]
-    df = pd.concat([df, hgvs], axis=1)
-    
-    # make adjustments to the nucleotide names
-    # 1) change 'c.' to 'g.' for nucleotide names ### double check that we want this
-    df["hgvs_nucleotide"] = df["hgvs_nucleotide"].str.replace("c.", "g.", regex=True) 
-    df["hgvs_nucleotide"] = df["hgvs_nucleotide"].str.replace("n.", "g.", regex=True) 
-    # 2) change nucleotide names of the form "g.C*4378A" to g.C4378AN;
-    asterisk_mask = df["hgvs_nucleotide"].str.contains('\*')
-    df.loc[asterisk_mask, "hgvs_nucleotide"] = 'g.' + df['REF'] + df['POS'] + \
-        df['ALT']
-    # 3) change 'Gene_Name' to "intergenic" where names contain a "*"
-    df.loc[asterisk_mask, 'Gene_Name'] = "intergenic"
-
-    # create a "Names" column that holds the amino acid name (minus 'p.')
-    # if there is one, or the nucleotide level name if not
-    df["Names"] = df["hgvs_nucleotide"]
-    protein_mask = df["hgvs_protein"].str.contains("p.")
-    df.loc[protein_mask, "Names"] = df["hgvs_protein"].str.replace(
-        "p.", "", regex=True)
-
-    # rename some columns
-    df = df.rename(columns={'Gene_Name': "vcf_gene", 'Functional_Class':
-                            "mutation_type", 'hgvs_nucleotide': 'nt_name',
-                            'hgvs_protein': 'aa_name', 'REF': 'Reference_seq',
-                            'ALT': 'Variant_seq'})
+def parse_vcf(vcf):
+    """
+    Reads a snpEff-annotated VCF record by record and returns a dataframe
+    with one row per alternate allele, holding the columns vcf2gvf.py
+    needs: '#CHROM', 'POS', 'Reference_seq', 'Variant_seq', 'type' (if
+    given in INFO), 'dp', 'ro', 'ao', 'AF', 'vcf_gene', 'mutation_type',
+    'nt_name', 'aa_name', 'Names' and any of vcf_info_attributes found
+    in INFO.
+
+    Only the output columns are kept in memory, so memory use does not
+    depend on the size of the INFO/EFF fields. INFO tags are matched by
+    name (lowercased), and values from the last ("unknown") VCF column
+    take precedence over INFO tags of the same name.
+    """
+    eff_pattern = re.compile(r'\((.*?)\)')
+    cdot_pattern = re.compile('c.')
+    ndot_pattern = re.compile('n.')
+    pdot_pattern = re.compile('p.')
+
+    var_cols = None
+    columns = dict((col, []) for col in [
+        '#CHROM', 'POS', 'Reference_seq', 'Variant_seq', 'type', 'dp',
+        'ro', 'ao', 'vcf_gene', 'mutation_type', 'nt_name', 'aa_name',
+        'Names'] + vcf_info_attributes)
+    found = set()
+
+    with open(vcf) as fp:
+        for line in fp:
+            line = line.rstrip('\n')
+            if line.startswith('#') or line == '':
+                # get variant-calling source from pragmas
+                if var_cols is None and line.startswith('##source='):
+                    var_cols = get_source_labels(line)
+                continue
+            fields = line.split('\t')
+            chrom, pos, ref, alt, info = fields[0], fields[1], fields[3], \
+                fields[4], fields[7]
+
+            # INFO tags, lowercased; flags without a value are NaN
+            record = {}
+            for item in info.split(';'):
+                tag = item.split('=')
+                record[tag[0].lower()] = tag[1] if len(tag) > 1 else np.nan
+            # named values from the last ("unknown") column
+            record.update(zip(var_cols, fields[9].split(':')))
+
+            # make ALT, AO, type into lists
+            alt_list = alt.split(',')
+            ao_list = record['ao'].split(',')
+            type_list = record['type'].split(',') if 'type' in record \
+                else None
+            eff_list = select_snpeff_records(record['eff'], len(ao_list))
+            lengths = set([len(alt_list), len(ao_list), len(eff_list)])
+            if type_list is not None:
+                lengths.add(len(type_list))
+            if len(lengths) != 1:
+                raise ValueError("Number of ALT, AO, type and EFF values "
+                                 "differ at " + chrom + ":" + pos + " in "
+                                 + vcf)
+
+            for tag in vcf_info_attributes:
+                if tag in record:
+                    found.add(tag)
+            if type_list is not None:
+                found.add('type')
+
+            # one row per alternate allele
+            for i in range(len(alt_list)):
+                # expand the contents of the EFF record, named as in the
+                # VCF header: Effect_Impact|Functional_Class|Codon_Change|
+                # Amino_Acid_Change|Amino_Acid_length|Gene_Name|...
+                eff = eff_pattern.search(eff_list[i])
+                eff = eff.group(1).split('|') if eff else []
+                eff += [np.nan] * (6 - len(eff))
+                mutation_type, amino_acid_change, gene = eff[1], eff[3], \
+                    eff[5]
+
+                # split Amino_Acid_Change into HGVS amino acid name (left)
+                # and nucleotide-level name (right)
+                aa_name, nt_name = np.nan, np.nan
+                if isinstance(amino_acid_change, str):
+                    if '/' not in amino_acid_change:
+                        amino_acid_change = '/' + amino_acid_change
+                    aa_name, nt_name = amino_acid_change.split('/')[:2]
+
+                    # make adjustments to the nucleotide names
+                    # 1) change 'c.' and 'n.' to 'g.'
+                    nt_name = ndot_pattern.sub('g.',
+                                               cdot_pattern.sub('g.', nt_name))
+                    # 2) change nucleotide names of the form "g.C*4378A"
+                    # to g.C4378A, and gene to "intergenic"
+                    if '*' in nt_name:
+                        nt_name = 'g.' + ref + pos + alt_list[i]
+                        gene = "intergenic"
+
+                # "Names" holds the amino acid name (minus 'p.') if there
+                # is one, or the nucleotide level name if not
+                name = nt_name
+                if isinstance(aa_name, str) and pdot_pattern.search(aa_name):
+                    name = pdot_pattern.sub('', aa_name)
+
+                columns['#CHROM'].append(chrom)
+                columns['POS'].append(pos)
+                columns['Reference_seq'].append(ref)
+                columns['Variant_seq'].append(alt_list[i])
+                columns['type'].append(type_list[i] if type_list is not None
+                                       else np.nan)
+                columns['dp'].append(record.get('dp', np.nan))
+                columns['ro'].append(record.get('ro', np.nan))
+                columns['ao'].append(ao_list[i])
+                columns['vcf_gene'].append(gene)
+                columns['mutation_type'].append(mutation_type)
+                columns['nt_name'].append(nt_name)
+                columns['aa_name'].append(aa_name)
+                columns['Names'].append(name)
+                for tag in vcf_info_attributes:
+                    columns[tag].append(record.get(tag, np.nan))
+
+    # drop optional columns that no record had
+    for col in vcf_info_attributes + ['type']:
+        if col not in found:
+            del columns[col]
+    df = pd.DataFrame(columns)
+
+    # calculate Alternate Frequency
+    df['AF'] = df['ao'].astype(int) / df['dp'].astype(int)
 
     return(df)
     
@@ -377,45 +646,115 @@ def split_names(names_to_split, new_gvf, col_to_split):
     return(new_gvf)
 
 
-def map_pos_to_gene_protein(pos, GENE_PROTEIN_POSITIONS_DICT):
+gene_index_attributes = ["gene", "protein_name", "protein_symbol",
+                         "protein_id"]
+
+
+def json_checksum(contents):
+    # checksum of JSON-serializable contents (eg. the gene positions
+    # JSON), stored with an index so that a stale index can be detected
+    return hashlib.sha256(json.dumps(contents,
+                                     sort_keys=True).encode()).hexdigest()
+
+
+def build_gene_position_index(GENE_PROTEIN_POSITIONS_DICT):
+    """
+    Builds a sorted-array index of the CDS regions in the gene positions
+    JSON, for map_pos_to_gene_protein.
+
+    The genome is cut into elementary segments at every CDS start and
+    end+1, so that each segment is either entirely inside or entirely
+    outside of each CDS. 'breaks' holds the sorted segment starts and
+    'segment_cds' the CDS that each segment maps to (-1 if none). Where
+    CDS regions overlap, the one listed last in the JSON is used.
+    """
+    entries = [entry for entry in GENE_PROTEIN_POSITIONS_DICT.values()
+               if entry["type"]=="CDS" and "protein_alias" in entry.keys()]
+    starts = np.array([int(entry["start"]) for entry in entries], dtype=np.int64)
+    ends = np.array([int(entry["end"]) for entry in entries], dtype=np.int64)
+
+    breaks = np.unique(np.concatenate([starts, ends + 1]))
+    segment_cds = np.full(breaks.shape[0], -1, dtype=np.int64)
+    # later entries overwrite earlier ones
+    for i in range(len(entries)):
+        segment_cds[(breaks >= starts[i]) & (breaks <= ends[i])] = i
+
+    index = {"breaks": breaks, "segment_cds": segment_cds,
+             "checksum": json_checksum(GENE_PROTEIN_POSITIONS_DICT)}
+    for attribute, key in zip(gene_index_attributes,
+                              ["gene", "product", "protein_alias",
+                               "protein_id"]):
+        index[attribute] = np.array([entry[key] for entry in entries],
+                                    dtype=object)
+    return index
+
+
+def save_gene_position_index(index, filepath):
+    # save index as a .npz file (no pickled objects); an index staged as
+    # a symlink (eg. by Nextflow) is replaced rather than written through
+    arrays = dict((key, np.array(value, dtype=str)) if key not in
+                  ["breaks", "segment_cds"] else (key, value)
+                  for key, value in index.items())
+    if os.path.islink(filepath):
+        os.remove(filepath)
+    with open(filepath, 'wb') as fp:
+        np.savez(fp, **arrays)
+
+
+def load_gene_position_index(filepath, GENE_PROTEIN_POSITIONS_DICT):
+    """
+    Loads a gene position index saved with save_gene_position_index.
+    If the file does not exist, or was built from a different gene
+    positions JSON, the index is rebuilt and saved to filepath.
+    """
+    if os.path.exists(filepath):
+        with np.load(filepath) as npz:
+            index = dict((key, npz[key]) for key in npz.files)
+        if str(index["checksum"]) == \
+                json_checksum(GENE_PROTEIN_POSITIONS_DICT):
+            index["checksum"] = str(index["checksum"])
+            for attribute in gene_index_attributes:
+                index[attribute] = index[attribute].astype(object)
+            return index
+        logging.info("Gene position index " + filepath +
+                     " does not match the gene positions JSON; rebuilding")
+
+    index = build_gene_position_index(GENE_PROTEIN_POSITIONS_DICT)
+    save_gene_position_index(index, filepath)
+    return index
+
+
+def map_pos_to_gene_protein(pos, GENE_PROTEIN_POSITIONS_DICT, index=None):
     """This function is inspired/lifted from Ivan's code.
     Map a series of nucleotide positions to SARS-CoV-2 genes.
     See https://www.ncbi.nlm.nih.gov/nuccore/MN908947.
     :param pos: Nucleotide position pandas series from VCF
     :param GENE_PROTEIN_POSITIONS_DICT: Dictionary of gene positions from cov_lineages
+    :param index: Prebuilt index from build_gene_position_index (optional)
     :type pos: int
     :return: series containing SARS-CoV-2 chromosome region names at each
     nucleotide position in ``pos``
     """
-    # make an empty dataframe of the same length as pos and with four columns
-    cols_to_add = ["gene", "protein_name", "protein_symbol", "protein_id"]
-    df = pd.DataFrame(np.nan, index=range(0,pos.shape[0]), columns=cols_to_add)
-    # add positions to this df
-    df["POS"] = pos
+    if index is None:
+        index = build_gene_position_index(GENE_PROTEIN_POSITIONS_DICT)
 
-    # loop through all CDS regions in dict to get attributes
-    for entry in GENE_PROTEIN_POSITIONS_DICT.keys():
-        if GENE_PROTEIN_POSITIONS_DICT[entry]["type"]=="CDS" and ("protein_alias" in GENE_PROTEIN_POSITIONS_DICT[entry].keys()):
-            # extract values from JSON entry
-            start = GENE_PROTEIN_POSITIONS_DICT[entry]["start"]
-            end = GENE_PROTEIN_POSITIONS_DICT[entry]["end"]
-            #aa_start = GENE_PROTEIN_POSITIONS_DICT[entry]["aa_start"]
-            #aa_end = GENE_PROTEIN_POSITIONS_DICT[entry]["aa_end"]
-            gene = GENE_PROTEIN_POSITIONS_DICT[entry]["gene"]
-            protein_name = GENE_PROTEIN_POSITIONS_DICT[entry]["product"]
-            protein_symbol = GENE_PROTEIN_POSITIONS_DICT[entry]["protein_alias"]
-            protein_id = GENE_PROTEIN_POSITIONS_DICT[entry]["protein_id"]
-
-            # fill in attributes for mutations in this CDS region
-            cds_mask = df["POS"].astype(int).between(start, end, inclusive="both")
-            df.loc[cds_mask, "gene"] = gene
-            df.loc[cds_mask, "protein_name"] = protein_name
-            df.loc[cds_mask, "protein_symbol"] = protein_symbol
-            df.loc[cds_mask, "protein_id"] = protein_id
+    # find the segment containing each position with a binary search;
+    # positions before the first segment get -1 (no CDS)
+    segment = np.searchsorted(index["breaks"],
+                              np.asarray(pos).astype(np.int64), side="right")
+    cds = np.concatenate([[-1], index["segment_cds"]])[segment]
 
+    # make a dataframe of the same length as pos and with four columns,
+    # filled in from the CDS each position maps to;
     # label all mutations that didn't belong to any gene as "intergenic"
-    df.loc[df["gene"].isna(), "gene"] = "intergenic"
-    # label all mutations that didn't belong to any protein as "n/a"
+    # and all mutations that didn't belong to any protein as "n/a"
+    # (cds == -1 takes the last element)
+    df = pd.DataFrame(index=range(0,pos.shape[0]))
+    for attribute in gene_index_attributes:
+        fill = "intergenic" if attribute == "gene" else "n/a"
+        df[attribute] = np.append(index[attribute], fill)[cds]
+    # add positions to this df
+    df["POS"] = pos
     df = df.fillna("n/a")
 
     return(df)
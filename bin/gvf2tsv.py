@@ -11,9 +11,12 @@ case report.
 """
 import argparse
 import pandas as pd
+import numpy as np
 import os
 import re
-from functions import separate_attributes
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+from functions import separate_attributes, read_gvf
 
 
 def parse_args():
@@ -41,115 +44,152 @@ def parse_args():
                              'workflow that contains num_seqs column')
     parser.add_argument('--user', action="store_true",
                         help='Use user-uploaded file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to convert GVFs and '
+                             'write variant reports with')
 
     return parser.parse_args()
 
 
-def match_gvfs_to_who_variant(pango_lineage_list, gvf_files_list):
+def index_gvf_files(gvf_files_list):
+    """
+    Indexes file names for match_gvfs_to_who_variant: the sorted
+    names, where names starting with a lineage are next to each other,
+    and the names by lineage (the part of the name before the first
+    '_').
+    """
+    sorted_files = sorted(set(gvf_files_list))
+    lineage_files = dict()
+    for file in gvf_files_list:
+        lineage_files.setdefault(file[:file.find("_")], []).append(file)
+    return sorted_files, lineage_files
+
+
+def match_gvfs_to_who_variant(pango_lineage_list, gvf_files_list,
+                              file_index=None):
+    # file_index is index_gvf_files(gvf_files_list), which can be
+    # built once when matching the same files to several variants
+    if file_index is None:
+        file_index = index_gvf_files(gvf_files_list)
+    sorted_files, lineage_files = file_index
+
     matched_files = []
     if len(pango_lineage_list) > 1:
         for lineage in pango_lineage_list:
             if "*" in lineage:
                 lineage = lineage.replace("*", "")
-            matched_files.extend([i for i in gvf_files_list if
-                                  i.startswith(lineage)])
+            i = bisect.bisect_left(sorted_files, lineage)
+            while i < len(sorted_files) and \
+                    sorted_files[i].startswith(lineage):
+                matched_files.append(sorted_files[i])
+                i += 1
 
-            matched_files = sorted(set(matched_files))
+        matched_files = sorted(set(matched_files))
     else:
         for lineage in pango_lineage_list:
-        #    matched_files.extend([i for i in gvf_files_list if
-        #                          i.startswith(lineage)])
-            matched_files = ([i for i in gvf_files_list if
-                            i[:i.find("_")]==lineage])
+            matched_files = list(lineage_files.get(lineage, []))
 
     return matched_files
 
 
-def find_variant_pop_size(table, pango_lineage_list):
+def read_stats_table(table):
     strain_tsv_df = pd.read_csv(table, header=0,
                                 delim_whitespace=True, thousands=r',',
                                 usecols=['file', 'num_seqs'])
+    return strain_tsv_df
 
+
+def find_variant_pop_size(strain_tsv_df, pango_lineage_list,
+                          file_index=None):
+    # strain_tsv_df is the stats table from read_stats_table
     files = match_gvfs_to_who_variant(
         pango_lineage_list=pango_lineage_list,
-        gvf_files_list=strain_tsv_df['file'].tolist())
-    # print(files)
+        gvf_files_list=strain_tsv_df['file'].tolist(),
+        file_index=file_index)
 
     pop_size = strain_tsv_df.loc[strain_tsv_df['file'].isin(
         files), 'num_seqs'].sum()
     return pop_size
 
 
-def add_ao_by_variant_seq(ao_str, variant_seq_str):
+def get_pango_lineages(clades, who_variant):
+    # get list of relevant pango lineages, expanding bracketed
+    # aliases like B[A|B] into BA, BA.*, BB, BB.*
+    pango_lineages = []
+    for var in clades[clades['variant']==who_variant]['pango_lineage'].tolist():
+        if "," in var:
+            for temp in var.split(","):
+                if "[" not in var:
+                    pango_lineages.append(temp)
+                else:
+                    parent = temp[0]
+                    child = temp[2:-3].split("|")
+                    for c in child:
+                        pango_lineages.append(parent + str(c))
+                        pango_lineages.append(parent + str(c) + ".*")
+        else:
+            pango_lineages.append(var)
+
+    return pango_lineages
+
+
+def add_ao_by_variant_seq(ao_list, variant_seq_list):
     """
-    Takes a pair of strings like ao_str="7,7,24" and
-    variant_seq_str="T,T,T" or "8,21,3" and "T,T,A".
-    Output should be a string "T=38" (first case) or "T=29, A=3" (
-    second case).
+    Takes a list of ao counts like [7, 7, 24] or [8, 21, 3] and their
+    variant seqs like ["T", "T", "T"] or ["T", "T", "A"].
+    Output should be the strings "T=38", "38", "T" (first case) or
+    "T=29, A=3", "29,3", "T,A" (second case).
     """
-    ao_list = ao_str.split(',')
-    ao_list = [int(x) for x in ao_list]
-    var_str_list = variant_seq_str.split(',')
-    zipped_lists = list(zip(var_str_list, ao_list))
-
     ao_dict = dict()
-    for pair in zipped_lists:
-        # if a variant seq isn't in the dictionary, add it
-        if pair[0] not in ao_dict:
-            ao_dict[pair[0]] = pair[1]
-        # if it's already there, add this ao to the existing key
-        else:
-            ao_dict[pair[0]] += pair[1]
+    for variant_seq, ao in zip(variant_seq_list, ao_list):
+        # if a variant seq isn't in the dictionary, add it; if it's
+        # already there, add this ao to the existing key
+        ao_dict[variant_seq] = ao_dict.get(variant_seq, 0) + ao
 
     # create 3 strings: one for ao, one for var_seq, one for both
     # joined together with an '=' between
-    joined_string = ''
-    ao_string = ''
-    var_string = ''
-    for item in list(ao_dict.items()):
-        joined_string = joined_string + item[0] + '=' + str(item[1]) \
-                        + ', '
-        ao_string = ao_string + str(item[1]) + ','
-        var_string = var_string + item[0] + ','
-    joined_string = joined_string.rstrip(", ")
-    ao_string = ao_string.rstrip(", ")
-    var_string = var_string.rstrip(", ")
+    joined_string = ', '.join(variant_seq + '=' + str(ao)
+                              for variant_seq, ao in ao_dict.items())
+    ao_string = ','.join(str(ao) for ao in ao_dict.values())
+    var_string = ','.join(ao_dict.keys())
 
     return joined_string, ao_string, var_string
 
 
-def add_one_from_each_lineage(count_str, lineage_str, mode):
+def summarize_lineages(lineages, dp, ro, ao, variant_seq, clade_defining):
     """
-    Takes a pair of strings like count_str="7,7,24" and
-    lineage_str="Q.3,Q.3,Q.1".
-    Output should be a string "31", adding unique lineage
-    values only, if mode='add'.
-    If mode='comma', returns a comma-separated set of values,
-    like "7,24".
+    Takes the values of one mutation in each GVF it was found in, as
+    lists in the same order, and returns its dp, ro, ao_by_var_seq,
+    ao, variant_seq, viral_lineages and clade_defining_status. dp, ro
+    and ao are counted once per lineage, from the first GVF of that
+    lineage.
     """
-    count_list = count_str.split(';')
-    if mode == 'add':
-        count_list = [int(x) for x in count_list]
-    lineage_str_list = lineage_str.replace(" ", "")
-    lineage_str_list = lineage_str.split(',')
-    zipped_lists = list(zip(lineage_str_list, count_list))
-
-    count_dict = dict()
-    for pair in zipped_lists:
-        # if a lineage isn't in the dictionary, add it
-        if pair[0] not in count_dict:
-            count_dict[pair[0]] = pair[1]
-        # if it's already there, do nothing
-
-    # if mode=='comma', return a comma-separated string of values
-    if mode == 'comma':
-        return_str = ','.join(list(count_dict.values()))
-    # elif mode=='add', add up all the keys and return the value as a
-    # string
-    elif mode == 'add':
-        return_str = str(sum(list(count_dict.values())))
-
-    return return_str
+    # index of the first row of each lineage
+    first_rows = dict()
+    for i, lineage in enumerate(lineages):
+        first_rows.setdefault(lineage, i)
+    rows = list(first_rows.values())
+
+    dp_sum = str(sum(int(dp[i]) for i in rows))
+    ro_sum = str(sum(int(ro[i]) for i in rows))
+    ao_by_var_seq, ao_str, var_str = add_ao_by_variant_seq(
+        [int(ao[i]) for i in rows], [variant_seq[i] for i in rows])
+
+    # combine viral_lineages and clade_defining into key-value pairs,
+    # dropping repeated pairs, and clade_defining status for n/a
+    # strains
+    pairs = dict()
+    for lineage, status in zip(lineages, clade_defining):
+        pair = lineage + '=' + status
+        if pair == 'n/a=n/a':
+            pair = 'n/a'
+        elif pair == 'nan=nan':
+            continue
+        pairs[pair] = None
+    clade_defining_status = ', '.join(pairs)
+
+    return dp_sum, ro_sum, ao_by_var_seq, ao_str, var_str, \
+        ', '.join(first_rows), clade_defining_status
 
 
 def gvf2tsv(gvf):
@@ -157,15 +197,19 @@ def gvf2tsv(gvf):
     gvf_columns = ['#seqid', '#source', '#type', '#start', '#end',
                    '#score', '#strand', '#phase', '#attributes']
 
-    df = pd.read_csv(gvf, sep='\t', names=gvf_columns)
-    # remove pragmas and original header
-    df = df[~df['#seqid'].str.contains("#")]
-    # restart index from 0
-    df = df.reset_index(drop=True)
-
-    # expand #attributes column into multiple columns for each attribute,
-    # keeping the original #attributes column
-    df = separate_attributes(df)
+    if gvf.endswith('.parquet'):
+        # attributes are already in separate columns
+        df = read_gvf(gvf)[0].reset_index(drop=True)
+    else:
+        df = pd.read_csv(gvf, sep='\t', names=gvf_columns)
+        # remove pragmas and original header
+        df = df[~df['#seqid'].str.contains("#")]
+        # restart index from 0
+        df = df.reset_index(drop=True)
+
+        # expand #attributes column into multiple columns for each
+        # attribute, keeping the original #attributes column
+        df = separate_attributes(df)
     # change all labels to lowercase
     df.columns = [x.lower() for x in df.columns]
     # drop original #attributes column, and also #source
@@ -187,6 +231,14 @@ def gvf2tsv(gvf):
     return df
 
 
+def write_variant_report(gvf_df, variant_pop_size, filename):
+    # streamline the concatenated GVFs of one variant and save them
+    out_df = streamline_tsv(tsv_df=gvf_df,
+                            variant_pop_size=variant_pop_size)
+    out_df.to_csv(filename, sep='\t', index=False)
+    return filename
+
+
 def streamline_user(tsv_df):
     tsv_df = tsv_df.rename(columns={'multiaa_comb_mutation':
                                         'multiaa_mutation_split_names'})
@@ -199,37 +251,29 @@ def streamline_user(tsv_df):
             'citation', 'citation_url', 'comb_mutation',
             'function_description',
             'heterozygosity']
-    tsv_df = tsv_df[cols]
+    # columns not in the GVF (eg. chrom_region) are left empty
+    tsv_df = tsv_df.reindex(columns=cols)
 
     return tsv_df
 
 
-def streamline_tsv(tsv_df):
+def streamline_tsv(tsv_df, variant_pop_size):
     # find identical rows across strains, and keep only one row.
     # change n/a to 0 in 'ao' for counting purposes
     tsv_df['ao'] = tsv_df['ao'].str.replace("n/a", "0")
 
-    '''
-    # make ro, dp, and obs_sample_size numeric
-    for colname in ['ro', 'dp', 'obs_sample_size']:
-        tsv_df[colname] = pd.to_numeric(tsv_df[colname],
-                                        errors='coerce')
-    '''
     # make obs_sample_size numeric
     tsv_df['obs_sample_size'] = pd.to_numeric(tsv_df['obs_sample_size'],
                                               errors='coerce')
 
-    agg_dict = dict((col, 'first') for col in
-                    tsv_df.columns.values.tolist())
+    # columns with a value per lineage, summarized below
+    lineage_cols = ['viral_lineages', 'dp', 'ro', 'ao', 'variant_seq',
+                    'clade_defining']
 
+    agg_dict = dict((col, 'first') for col in
+                    tsv_df.columns.values.tolist()
+                    if col not in lineage_cols)
     agg_dict['obs_sample_size'] = 'sum'
-    # join some columns with commas
-    agg_dict['viral_lineages'] = ', '.join
-    agg_dict['clade_defining'] = ','.join
-    agg_dict['ao'] = ';'.join
-    agg_dict['dp'] = ';'.join
-    agg_dict['ro'] = ';'.join
-    agg_dict['variant_seq'] = ','.join
 
     cols_to_check = ['name', 'nt_name', 'aa_name', 'multi_aa_name',
                      'multiaa_comb_mutation', 'start',
@@ -237,101 +281,35 @@ def streamline_tsv(tsv_df):
                      'comb_mutation', 'function_description',
                      'heterozygosity']
 
-    final_df = tsv_df.groupby(cols_to_check).agg(agg_dict)
-    final_df = final_df.rename(columns={'ao': 'ao_all',
-                                        'variant_seq':
-                                            'variant_seq_all',
-                                        'multiaa_comb_mutation':
+    grouped = tsv_df.groupby(cols_to_check)
+    final_df = grouped.agg(agg_dict)
+    final_df = final_df.rename(columns={'multiaa_comb_mutation':
                                             'multiaa_mutation_split_names'})
 
-    # add dp, ro per mutation
-    for colname in ['dp', 'ro']:
-        final_df[colname] = [add_one_from_each_lineage(x, y, mode='add')
-                             for x, y in
-                             zip(final_df[colname],
-                                 final_df['viral_lineages'])]
-
-    # add ao, variant_seq per mutation
-    for colname in ['ao_all', 'variant_seq_all']:
-        final_df[colname] = [
-            add_one_from_each_lineage(x, y, mode='comma') for x, y in
-            zip(final_df[colname],
-                final_df['viral_lineages'])]
-
-    # add ao according to the heterogeneous mutations
-    final_df['ao_by_var_seq'] = [add_ao_by_variant_seq(x, y)[0] for x, y
-                                 in zip(final_df['ao_all'],
-                                        final_df['variant_seq_all'])]
-    final_df['ao'] = [add_ao_by_variant_seq(x, y)[1] for x, y in
-                      zip(final_df['ao_all'],
-                          final_df['variant_seq_all'])]
-    final_df['variant_seq'] = [add_ao_by_variant_seq(x, y)[2] for x, y
-                               in zip(final_df['ao_all'],
-                                      final_df['variant_seq_all'])]
-
-    # remove 'who_variant'; rename 'multiaa_comb_mutation'
+    # collect the per-lineage columns of each mutation as lists, in
+    # row order, with mutations in the same (sorted) order as final_df;
+    # rows with a missing key are dropped by groupby (group -1)
+    group_ids = grouped.ngroup().to_numpy()
+    order = np.argsort(group_ids, kind='stable')
+    bounds = np.searchsorted(group_ids[order],
+                             np.arange(-1, len(final_df)), side='right')
+    lineage_values = [np.split(tsv_df[col].to_numpy()[order], bounds)[1:-1]
+                      for col in lineage_cols]
+
+    # add dp, ro, ao, variant_seq, viral_lineages and
+    # clade_defining_status per mutation
+    summaries = [summarize_lineages(*values)
+                 for values in zip(*lineage_values)]
+    summary_cols = ['dp', 'ro', 'ao_by_var_seq', 'ao', 'variant_seq',
+                    'viral_lineages', 'clade_defining_status']
+    for col, values in zip(summary_cols, zip(*summaries)):
+        final_df[col] = list(values)
+
+    # remove 'who_variant'
     final_df = final_df.drop(labels=['variant'], axis=1)
     # add variant_pop_size
     final_df['variant_pop_size'] = variant_pop_size
 
-    # combine viral_lineages and clade_defining into key-value pairs
-
-    # split viral_lineages and clade_defining by ','
-    split_lineages = final_df['viral_lineages'].str.split(
-        pat=',').apply(pd.Series)  # split at ,, form dataframe
-    split_clade_defining = final_df['clade_defining'].str.split(
-        pat=',').apply(pd.Series)  # split at ,, form dataframe
-    # go through and make key-value pairs of corresponding columns
-    # from each
-    final_df['clade_defining_status'] = ''
-    for col in split_clade_defining.columns:
-        final_df['clade_defining_status'] = final_df[
-                                                'clade_defining_status'] + \
-                                            split_lineages[col].astype(
-                                                str) + '=' + \
-                                            split_clade_defining[
-                                                col].astype(str) + '; '
-    # drop clade_defining status for n/a strains and empty nan=nan pairs
-    final_df.clade_defining_status = \
-        final_df.clade_defining_status.str.replace('n/a=n/a; ',
-                                                   'n/a; ')
-    final_df.clade_defining_status = \
-        final_df.clade_defining_status.str.replace('nan=nan; ', '')
-    # strip trailing spaces and semicolons
-    final_df.clade_defining_status = \
-        final_df.clade_defining_status.str.rstrip("; ")
-
-    # drop repeated key-value pairs in each row (find these rows as
-    # they contain spaces)
-    for row in final_df['clade_defining_status']:
-        if ' ' in row:
-            mylist = row.split('; ')
-            newlist = []
-            for pair in mylist:
-                pair = pair.replace(';', '')
-                pair = pair.lstrip(' ')
-                newlist.append(pair)
-            mylist = list(set(newlist))
-            row_str = ', '.join(str(e) for e in mylist)
-            mask = final_df['clade_defining_status'] == row
-            final_df.loc[mask, 'clade_defining_status'] = row_str
-
-    # drop repeated lineage names in each row of viral_lineages
-    # return an ordered list of lineages
-    for row in final_df['viral_lineages']:
-        if ' ' in row:
-            lineage_list = row.split(', ')
-            mylist = list(set(lineage_list))
-            '''
-            #order lineages alphanumerically
-            #split each element of mylist into a sublist, split at
-            the first '.'
-            split_list =
-            '''
-            row_str = ', '.join(str(e) for e in mylist)
-            mask = final_df['viral_lineages'] == row
-            final_df.loc[mask, 'viral_lineages'] = row_str
-
     # reorder columns
     cols = ['name', 'nt_name', 'aa_name', 'multi_aa_name',
             'multiaa_mutation_split_names', 'start', 'vcf_gene',
@@ -345,7 +323,8 @@ def streamline_tsv(tsv_df):
             'clade_defining_status', 'status',
             'voi_designation_date', 'voc_designation_date',
             'vum_designation_date']
-    final_df = final_df[cols]
+    # columns not in the GVFs (eg. chrom_region) are left empty
+    final_df = final_df.reindex(columns=cols)
 
     return final_df
 
@@ -382,7 +361,9 @@ if __name__ == '__main__':
                     who_variants_list.append(clades.loc[i,
                                                         'variant'])
 
-        # for each variant, create a surveillance report
+        # match GVF files to each variant
+        file_index = index_gvf_files(gvf_list)
+        variants = []
         for who_variant in who_variants_list:
             if "_" in who_variant:
                 who_variant = who_variant[0:who_variant.find(
@@ -392,59 +373,71 @@ if __name__ == '__main__':
                 who_variant = who_variant.capitalize()
             
             # get list of relevant pango lineages
-            pango_lineages = []
-            for var in clades[clades['variant']==who_variant]['pango_lineage'].tolist():
-                if "," in var:
-                    for temp in var.split(","):
-                        if "[" not in var:
-                            pango_lineages.append(temp)
-                        else:
-                            parent = temp[0]
-                            child = temp[2:-3].split("|")
-                            for c in child:
-                                pango_lineages.append(parent + str(c))
-                                pango_lineages.append(parent + str(c) + ".*")
-                else:
-                    pango_lineages.append(var)
-
-            #print(pango_lineages)
+            pango_lineages = get_pango_lineages(clades, who_variant)
 
             # get list of gvf files pertaining to variant
-            gvf_files = []
             gvf_files = match_gvfs_to_who_variant(
                 pango_lineage_list=pango_lineages,
-                gvf_files_list=gvf_list)
+                gvf_files_list=gvf_list, file_index=file_index)
             print(str(len(gvf_files)) + " GVF files found for " +
                   who_variant + " variant.")
+            if len(gvf_files) > 0:
+                variants.append((who_variant, pango_lineages, gvf_files))
 
+        executor = None
+        if args.workers > 1:
+            executor = ProcessPoolExecutor(max_workers=args.workers)
 
-            if len(gvf_files) > 0:
-                # convert all gvf files to tsv and concatenate them
-                print("")
-                print("Processing:")
-                print(gvf_files[0])
-                gvf_df = gvf2tsv(gvf=gvf_files[0])
-                if len(gvf_files) > 1:
-                    for gvf in gvf_files[1:]:
-                        print(gvf)
-                        new_gvf_df = gvf2tsv(gvf=gvf)
-                        gvf_df = pd.concat([gvf_df, new_gvf_df],
-                                           ignore_index=True)
-
-
-                if args.table:
-                    # get variant population size
-                    variant_pop_size = find_variant_pop_size(table=args.table,
-                                                             pango_lineage_list=
-                                                             pango_lineages)
-
-                out_df = streamline_tsv(tsv_df=gvf_df)
-                filename = who_variant + '_' + outfile
-                out_df.to_csv(filename, sep='\t', index=False)
-                print("Processing complete.")
-                print(who_variant + " surveillance report saved as: " +
-                      filename)
-                print("")
+        # convert each gvf file to tsv once, even if it belongs to
+        # several variants
+        gvf_files = list(dict.fromkeys(
+            gvf for variant in variants for gvf in variant[2]))
+        print("")
+        print("Processing:")
+        for gvf in gvf_files:
+            print(gvf)
+        if executor is not None:
+            gvf_dfs = dict(zip(gvf_files, executor.map(gvf2tsv, gvf_files)))
+        else:
+            gvf_dfs = dict(zip(gvf_files, map(gvf2tsv, gvf_files)))
+
+        # read the stats table once for all variants
+        if args.table:
+            strain_tsv_df = read_stats_table(args.table)
+            stats_index = index_gvf_files(strain_tsv_df['file'].tolist())
+
+        # for each variant, create a surveillance report
+        reports = []
+        for who_variant, pango_lineages, gvf_files in variants:
+            # concatenate the variant's gvf files
+            gvf_df = pd.concat([gvf_dfs[gvf] for gvf in gvf_files],
+                               ignore_index=True)
+
+            if args.table:
+                # get variant population size
+                variant_pop_size = find_variant_pop_size(
+                    strain_tsv_df, pango_lineages, stats_index)
+            else:
+                variant_pop_size = "n/a"
+
+            filename = who_variant + '_' + outfile
+            if executor is not None:
+                report = executor.submit(write_variant_report, gvf_df,
+                                         variant_pop_size, filename)
+            else:
+                report = write_variant_report(gvf_df, variant_pop_size,
+                                              filename)
+            reports.append((who_variant, filename, report))
+
+        for who_variant, filename, report in reports:
+            if executor is not None:
+                report.result()
+            print(who_variant + " surveillance report saved as: " +
+                  filename)
+        if executor is not None:
+            executor.shutdown()
+        print("Processing complete.")
+        print("")
 
 
     # if user-provided, who_variant is the provided filename
@@ -460,9 +453,8 @@ if __name__ == '__main__':
 
         if args.table:
             # get variant population size
-            variant_pop_size = find_variant_pop_size(table=args.table,
-                                                     pango_lineage_list=
-                                                     pango_lineages)
+            variant_pop_size = find_variant_pop_size(
+                read_stats_table(args.table), pango_lineages)
         else:
             variant_pop_size = "n/a"
 
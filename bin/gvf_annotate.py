@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This script runs the whole GVF annotation chain for one VCF in a
+single process:
+vcf2gvf.py -> splitmutationnames_gvf.py -> addfunctions2gvf.py ->
+addvariantinfo2gvf.py
+
+The GVF is kept in memory with #attributes expanded into separate
+columns between steps, and is only written to disk once at the end.
+The output is the same as running the four scripts one after another,
+except that attribute values containing '=' (eg. in function
+descriptions) are no longer cut short by re-parsing between steps.
+
+Name splitting and functional annotation are skipped if
+--names_to_split or --functional_annotations are not given (eg. for
+mpox).
+"""
+
+import argparse
+import json
+import pandas as pd
+import numpy as np
+from functions import find_sample_size, rejoin_attributes, attribute_keys
+from functions import empty_attributes, pragmas
+from functions import build_gene_position_index, load_gene_position_index
+from vcf2gvf import vcftogvf
+from splitmutationnames_gvf import split_gvf_names
+from addfunctions2gvf import add_pokay_annotations
+from addvariantinfo2gvf import add_variant_information
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Converts an annotated VCF file to a GVF file with '
+                    'functional and variant annotation')
+    parser.add_argument('--vcffile', type=str, default=None,
+                        help='Path to a snpEFF-annotated VCF file')
+    parser.add_argument('--size_stats', type=str, default=None,
+                        help='Statistics file for for size extraction')
+    parser.add_argument('--clades_threshold', type=float,
+                        default=0.75,
+                        help='Alternate frequency cutoff for '
+                             'clade-defining mutations')
+    parser.add_argument('--gene_positions', type=str,
+                        default=None,
+                        help='gene positions in JSON format')
+    parser.add_argument('--gene_positions_index', type=str,
+                        default=None,
+                        help='Prebuilt .npz index of the gene positions '
+                             'JSON; it is (re)built and saved here if '
+                             'missing or out of date')
+    parser.add_argument('--strain', type=str,
+                        default=None,
+                        help='Lineage; user mode is if strain="n/a"')
+    parser.add_argument("--wastewater", help="Activate wastewater data mode",
+                        action="store_true")
+    parser.add_argument('--names_to_split', type=str,
+                        default='n/a',
+                        help='.tsv of multi-aa mutation names to '
+                             'split up into individual aa names')
+    parser.add_argument('--functional_annotations', type=str,
+                        default='n/a', help='TSV file of functional '
+                                            'annotations')
+    parser.add_argument('--clades', type=str, default='n/a',
+                        help='TSV file of WHO strain names and '
+                             'VOC/VOI status')
+    parser.add_argument('--outgvf', type=str,
+                        help='Filename for the output GVF file')
+
+    return parser.parse_args()
+
+
+def handoff(gvf):
+    # make the in-memory GVF look like it was written to and read back
+    # from disk, as each step expects when run as a separate script
+    gvf = gvf.reset_index(drop=True)
+    keys = attribute_keys(empty_attributes)
+    gvf[keys] = gvf[keys].astype(str)
+    return gvf
+
+
+def gvf_annotate(vcf, strain, GENE_PROTEIN_POSITIONS_DICT, sample_size,
+                 threshold, names_to_split, annotation_file, clade_file,
+                 gene_index=None):
+    # create gvf from annotated vcf
+    gvf = vcftogvf(vcf, strain, GENE_PROTEIN_POSITIONS_DICT,
+                   sample_size, threshold, gene_index)
+
+    # split names in "Names" attribute into separate rows
+    if names_to_split != 'n/a':
+        gvf = split_gvf_names(handoff(gvf), names_to_split)
+
+    # add functional annotations
+    if annotation_file != 'n/a':
+        gvf = add_pokay_annotations(handoff(gvf), annotation_file)
+
+    # add variant info
+    gvf = add_variant_information(clade_file, handoff(gvf), strain)
+
+    # merge attributes back into a single column
+    gvf = rejoin_attributes(gvf, empty_attributes)
+
+    return gvf
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    # Reading the gene & proetin coordinates of the genome
+    with open(args.gene_positions) as fp:
+        GENE_PROTEIN_POSITIONS_DICT = json.load(fp)
+
+    if args.gene_positions_index:
+        gene_index = load_gene_position_index(args.gene_positions_index,
+                                              GENE_PROTEIN_POSITIONS_DICT)
+    else:
+        gene_index = build_gene_position_index(GENE_PROTEIN_POSITIONS_DICT)
+
+    # If the strain and/or stats file are None, set them as 'n/a'
+    size_stats = args.size_stats
+    strain = args.strain
+
+    if size_stats == None:
+        size_stats = 'n/a'
+    if strain == None:
+        strain = 'n/a'
+
+    sample_size = find_sample_size(size_stats, strain, args.vcffile,
+                                   args.wastewater)
+
+    gvf = gvf_annotate(args.vcffile, strain, GENE_PROTEIN_POSITIONS_DICT,
+                       sample_size, args.clades_threshold,
+                       args.names_to_split, args.functional_annotations,
+                       args.clades, gene_index)
+
+    # add species to pragmas
+    species = GENE_PROTEIN_POSITIONS_DICT['Src']['species']
+    pragmas[0] = pragmas[0].str.replace("##species", "##species " + str(species))
+
+    # combine pragmas, header, GVF contents
+    final_gvf = pd.DataFrame(np.vstack([gvf.columns, gvf]))
+    final_gvf = pragmas.append(final_gvf)
+
+    # save GVF
+    filepath = args.outgvf
+    print("Saved as: ", filepath)
+    print("")
+    final_gvf.to_csv(filepath, sep='\t', index=False, header=False)
+
+    print("")
+    print("Processing complete.")
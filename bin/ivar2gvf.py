@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+This script converts an iVar variants TSV (eg. from freyja variants)
+directly into a GVF, without the VCF and snpEff steps: the variants
+are read as ivar_variants_to_vcf.py would write them to VCF, and the
+amino acid changes are computed here from the reference genome and
+the CDS regions of the gene positions JSON.
+
+Names follow snpEff's -formatEff -hgvs1LetterAa -hgvsOld output as
+read by vcf2gvf.py (eg. Name=D614G, aa_name=p.D614G,
+nt_name=g.1841A>G, mutation_type=MISSENSE). Indels are first moved as
+far 3' as they go in repeats, and named from the amino acids they
+change (eg. H69_V70del, K375dup, F1353fs); insertions of the bases or
+amino acids before them are named as duplications (eg. g.438dup).
+Variants outside the CDS regions are named as vcf2gvf.py names
+snpEff's intergenic variants (eg. g.C241T, vcf_gene=intergenic).
+
+Without --reference, the amino acid changes of substitutions are taken
+from the REF_AA, POS_AA and ALT_AA columns that iVar fills in when
+given a GFF, and indels get nucleotide-level names only, at the
+position iVar reports them and without duplications.
+
+The attributes completed by this script are the same as vcf2gvf.py's:
+['ID', 'Name', 'gene', 'protein_name', 'protein_symbol', 'protein_id',
+'ro', 'ao', 'dp', 'sample_size', 'Reference_seq', 'Variant_seq',
+'nt_name', 'aa_name', 'vcf_gene', 'mutation_type', 'viral_lineage',
+'alternate_frequency', 'alias', 'clade_defining']
+"""
+
+import argparse
+import os
+import json
+import numpy as np
+import pandas as pd
+from functions import find_sample_size, build_gene_position_index, \
+    load_gene_position_index, write_gvf
+from functions import pragmas
+from vcf2gvf import variants_to_gvf
+from ivar_variants_to_vcf import read_ivar_variants
+
+
+# standard genetic code, codons in TCAG order
+codon_table = dict(
+    (a + b + c, aa) for (a, b, c), aa in zip(
+        [(a, b, c) for a in "TCAG" for b in "TCAG" for c in "TCAG"],
+        "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"))
+
+
+def read_reference(fasta):
+    # sequences of a FASTA file by name (first word of the header),
+    # in upper case
+    sequences = {}
+    name = None
+    with open(fasta) as fp:
+        for line in fp:
+            line = line.strip()
+            if line.startswith('>'):
+                name = line[1:].split()[0]
+                sequences[name] = []
+            elif name is not None:
+                sequences[name].append(line.upper())
+    return dict((name, ''.join(seq)) for name, seq in sequences.items())
+
+
+def coding_regions(GENE_PROTEIN_POSITIONS_DICT):
+    # CDS regions of each gene, in JSON order, as used for gene names in
+    # map_pos_to_gene_protein; CDS regions of the same gene (eg. ORF1a
+    # and ORF1b of ORF1ab, across the ribosomal frameshift) are spliced
+    # together as one coding sequence
+    regions = {}
+    for entry in GENE_PROTEIN_POSITIONS_DICT.values():
+        if entry["type"] == "CDS" and "protein_alias" in entry.keys():
+            regions.setdefault(entry["gene"], []).append(
+                (int(entry["start"]), int(entry["end"])))
+    return list(regions.items())
+
+
+def translate(seq):
+    # amino acids of the complete codons of seq ('X' if not ACGT)
+    return ''.join(codon_table.get(seq[i:i + 3], 'X')
+                   for i in range(0, len(seq) - 2, 3))
+
+
+def coding_position(segments, start, end):
+    # 0-based position in the spliced coding sequence of genome
+    # positions start..end (1-based), or None if they are not all in a
+    # single CDS region; where regions overlap, the last one is used
+    offset = 0
+    position = None
+    for seg_start, seg_end in segments:
+        if seg_start <= start and end <= seg_end:
+            position = offset + start - seg_start
+        offset += seg_end - seg_start + 1
+    return position
+
+
+def amino_acid(cds, number):
+    # amino acid number (1-based) of the coding sequence cds
+    return translate(cds[(number - 1) * 3:number * 3])
+
+
+def protein_change(cds, ref_aa, alt_aa, first):
+    # HGVS (1-letter) name of the change from ref_aa to alt_aa, which
+    # start at amino acid number first of cds; unchanged amino acids
+    # are trimmed from the start, then the end, and deletions and
+    # insertions in repeats are named at their 3' end. None if nothing
+    # changes
+    while ref_aa and alt_aa and ref_aa[0] == alt_aa[0]:
+        ref_aa, alt_aa, first = ref_aa[1:], alt_aa[1:], first + 1
+    while ref_aa and alt_aa and ref_aa[-1] == alt_aa[-1]:
+        ref_aa, alt_aa = ref_aa[:-1], alt_aa[:-1]
+
+    if not alt_aa:
+        # shift deletions past the repeats that follow them
+        while ref_aa and amino_acid(cds, first + len(ref_aa)) == ref_aa[0]:
+            ref_aa, first = ref_aa[1:] + ref_aa[0], first + 1
+    elif not ref_aa:
+        # same for insertions
+        while amino_acid(cds, first) == alt_aa[0]:
+            alt_aa, first = alt_aa[1:] + alt_aa[0], first + 1
+
+    if not ref_aa:
+        # insertion between amino acids first - 1 and first, a
+        # duplication if the amino acids before it are the same
+        if not alt_aa or first < 2:
+            return None
+        dup_first = first - len(alt_aa)
+        if dup_first >= 1 and \
+                translate(cds[(dup_first - 1) * 3:(first - 1) * 3]) == alt_aa:
+            span = alt_aa[0] + str(dup_first)
+            if len(alt_aa) > 1:
+                span += '_' + alt_aa[-1] + str(first - 1)
+            return 'p.' + span + 'dup'
+        before, after = amino_acid(cds, first - 1), amino_acid(cds, first)
+        if not before or not after:
+            return None
+        return 'p.' + before + str(first - 1) + '_' + after + str(first) + \
+            'ins' + alt_aa
+    last = first + len(ref_aa) - 1
+    span = ref_aa[0] + str(first)
+    if last != first:
+        span += '_' + ref_aa[-1] + str(last)
+    if not alt_aa:
+        return 'p.' + span + 'del'
+    if len(ref_aa) == 1 and len(alt_aa) == 1:
+        return 'p.' + span + alt_aa
+    return 'p.' + span + 'delins' + alt_aa
+
+
+def shift_indel(cds, position, ref, alt):
+    # moves an indel at coding position (0-based) position of cds, with
+    # ref/alt as in a VCF (including the base before it), as far 3' as
+    # it goes in repeats, as snpEff does before naming it
+    if len(ref) == len(alt):
+        return position, ref, alt
+    if len(ref) > len(alt):
+        length = len(ref) - len(alt)
+        while position + 1 + length < len(cds) and \
+                cds[position + 1 + length] == cds[position + 1]:
+            position += 1
+        return position, cds[position:position + 1 + length], cds[position]
+    inserted = alt[1:]
+    while position + 1 < len(cds) and cds[position + 1] == inserted[0]:
+        inserted = inserted[1:] + inserted[0]
+        position += 1
+    return position, cds[position], cds[position] + inserted
+
+
+def nucleotide_name(position, ref, alt, cds=None):
+    # name of a variant at coding position (0-based) position, with
+    # ref/alt as in a VCF (indels include the base before them); given
+    # the coding sequence, insertions of the bases before them are named
+    # as duplications
+    if len(ref) == len(alt):
+        if len(ref) == 1:
+            return 'g.' + str(position + 1) + ref + '>' + alt
+        return 'g.' + str(position + 1) + '_' + str(position + len(ref)) + \
+            'delins' + alt
+    if len(ref) > len(alt):
+        # deleted bases are at position + 1 .. position + length
+        length = len(ref) - len(alt)
+        name = 'g.' + str(position + 2)
+        if length > 1:
+            name += '_' + str(position + 1 + length)
+        return name + 'del'
+    inserted = alt[1:]
+    dup_start = position + 2 - len(inserted)
+    if cds is not None and dup_start >= 1 and \
+            cds[dup_start - 1:position + 1] == inserted:
+        name = 'g.' + str(dup_start)
+        if len(inserted) > 1:
+            name += '_' + str(position + 1)
+        return name + 'dup'
+    return 'g.' + str(position + 1) + '_' + str(position + 2) + 'ins' + \
+        inserted
+
+
+def mutation_class(ref_aa, alt_aa):
+    # snpEff functional class of a single amino acid change
+    if ref_aa == alt_aa:
+        return 'SILENT'
+    elif alt_aa == '*':
+        return 'NONSENSE'
+    return 'MISSENSE'
+
+
+def codon_effect(cds, position, ref, alt):
+    """
+    Computes the effect of a variant at coding position (0-based)
+    position of the coding sequence cds, with ref/alt as in a VCF
+    (indels include the base before them).
+
+    Returns (mutation_type, aa_name) as vcf2gvf.py reads them from
+    snpEff: mutation_type is MISSENSE, SILENT or NONSENSE for
+    single-base substitutions and empty otherwise; aa_name is NaN if
+    there is no amino acid change to report.
+    """
+    aa_name = np.nan
+    mutation_type = ''
+    if len(ref) == len(alt):
+        first_codon = position // 3
+        last_codon = (position + len(ref) - 1) // 3
+        start = first_codon * 3
+        ref_codons = cds[start:last_codon * 3 + 3]
+        alt_codons = ref_codons[:position - start] + alt + \
+            ref_codons[position - start + len(ref):]
+        ref_aa, alt_aa = translate(ref_codons), translate(alt_codons)
+        if len(ref) == 1:
+            if ref_aa and alt_aa:
+                aa_name = 'p.' + ref_aa + str(first_codon + 1) + alt_aa
+                mutation_type = mutation_class(ref_aa, alt_aa)
+        else:
+            name = protein_change(cds, ref_aa, alt_aa, first_codon + 1)
+            if name is not None:
+                aa_name = name
+        return mutation_type, aa_name
+
+    # the indel starts after the base before it, at position + 1
+    first_codon = (position + 1) // 3
+    start = first_codon * 3
+    if (len(ref) - len(alt)) % 3 != 0:
+        # frameshift, named by the first amino acid it changes
+        ref_aa = amino_acid(cds, first_codon + 1)
+        if ref_aa:
+            aa_name = 'p.' + ref_aa + str(first_codon + 1) + 'fs'
+        return mutation_type, aa_name
+
+    # in-frame: translate the codons around the indel
+    last_base = position + len(ref) - 1
+    if len(ref) > len(alt):
+        # from the codon of the first deleted base to that of the last
+        end = (last_base // 3) * 3 + 3
+    elif start == position + 1:
+        # insertion between two codons
+        end = start
+    else:
+        # insertion inside a codon
+        end = start + 3
+    ref_codons = cds[start:end]
+    alt_codons = cds[start:position + 1] + alt[1:] + cds[last_base + 1:end]
+    name = protein_change(cds, translate(ref_codons), translate(alt_codons),
+                          first_codon + 1)
+    if name is not None:
+        aa_name = name
+    return mutation_type, aa_name
+
+
+def ivar_amino_acid_change(fields, ref, alt):
+    # (mutation_type, aa_name) of a single-base substitution from iVar's
+    # REF_AA, POS_AA and ALT_AA columns, if filled in
+    if len(fields) < 20 or len(ref) != 1 or len(alt) != 1 or \
+            'NA' in (fields[16], fields[18], fields[19].strip()):
+        return '', np.nan
+    ref_aa, aa_pos, alt_aa = fields[16], fields[19].strip(), fields[18]
+    return mutation_class(ref_aa, alt_aa), 'p.' + ref_aa + aa_pos + alt_aa
+
+
+def parse_ivar(ivar_tsv, GENE_PROTEIN_POSITIONS_DICT, reference=None,
+               pass_only=False, min_af=0):
+    """
+    Reads the variants of an iVar TSV into the columns returned by
+    parse_vcf (one row per variant), naming them with codon_effect if
+    the reference sequences are given, or from iVar's amino acid
+    columns if not.
+    """
+    regions = coding_regions(GENE_PROTEIN_POSITIONS_DICT)
+    # spliced coding sequences, by contig and gene
+    coding_sequences = {}
+
+    columns = dict((col, []) for col in [
+        '#CHROM', 'POS', 'Reference_seq', 'Variant_seq', 'dp', 'ro', 'ao',
+        'vcf_gene', 'mutation_type', 'nt_name', 'aa_name', 'Names'])
+    for chrom, pos, ref, alt, _, _, fields in read_ivar_variants(
+            ivar_tsv, pass_only, min_af):
+        seq = None
+        if reference is not None:
+            # use the only reference sequence if the names differ (eg.
+            # MN908947.3 and NC_045512.2)
+            seq = reference.get(chrom)
+            if seq is None and len(reference) == 1:
+                seq = list(reference.values())[0]
+
+        gene, position = None, None
+        for region_gene, segments in regions:
+            region_position = coding_position(segments, int(pos),
+                                              int(pos) + len(ref) - 1)
+            if region_position is not None:
+                gene, position = region_gene, region_position
+
+        if gene is None:
+            # "intergenic", named as vcf2gvf.py names snpEff's
+            # intergenic variants
+            mutation_type, aa_name = '', np.nan
+            nt_name = 'g.' + ref + pos + alt
+            gene = "intergenic"
+        elif seq is not None:
+            if (chrom, gene) not in coding_sequences:
+                coding_sequences[(chrom, gene)] = ''.join(
+                    seq[start - 1:end] for start, end in dict(regions)[gene])
+            cds = coding_sequences[(chrom, gene)]
+            position, cds_ref, cds_alt = shift_indel(cds, position, ref, alt)
+            mutation_type, aa_name = codon_effect(cds, position, cds_ref,
+                                                  cds_alt)
+            nt_name = nucleotide_name(position, cds_ref, cds_alt, cds)
+        else:
+            mutation_type, aa_name = ivar_amino_acid_change(fields, ref, alt)
+            nt_name = nucleotide_name(position, ref, alt)
+
+        # "Names" holds the amino acid name (minus 'p.') if there is
+        # one, or the nucleotide level name if not
+        name = nt_name
+        if isinstance(aa_name, str):
+            name = aa_name[2:]
+
+        columns['#CHROM'].append(chrom)
+        columns['POS'].append(pos)
+        columns['Reference_seq'].append(ref)
+        columns['Variant_seq'].append(alt)
+        columns['dp'].append(fields[11])
+        columns['ro'].append(fields[4])
+        columns['ao'].append(fields[7])
+        columns['vcf_gene'].append(gene)
+        columns['mutation_type'].append(mutation_type)
+        columns['nt_name'].append(nt_name)
+        columns['aa_name'].append(aa_name)
+        columns['Names'].append(name)
+    df = pd.DataFrame(columns)
+
+    # calculate Alternate Frequency
+    df['AF'] = df['ao'].astype(int) / df['dp'].astype(int)
+
+    return df
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Converts an iVar variants TSV file to a GVF file, '
+                    'computing amino acid changes without snpEff')
+    parser.add_argument('--ivar_tsv', type=str, required=True,
+                        help='Path to an iVar variants TSV file')
+    parser.add_argument('--reference', type=str, default=None,
+                        help='Reference genome FASTA, to compute amino '
+                             'acid changes; without it they are taken '
+                             'from the iVar TSV (substitutions only)')
+    parser.add_argument('--pass_only', action='store_true',
+                        help='Only keep variants that PASS iVar\'s '
+                             'filters')
+    parser.add_argument('--allele_freq_thresh', type=float, default=0,
+                        help='Only keep variants with an allele '
+                             'frequency of at least this')
+    parser.add_argument('--size_stats', type=str, default=None,
+                        help='Statistics file for for size extraction')
+    parser.add_argument('--clades_threshold', type=float,
+                        default=0.75,
+                        help='Alternate frequency cutoff for '
+                             'clade-defining mutations')
+    parser.add_argument('--gene_positions', type=str,
+                        default=None,
+                        help='gene positions in JSON format')
+    parser.add_argument('--gene_positions_index', type=str,
+                        default=None,
+                        help='Prebuilt .npz index of the gene positions '
+                             'JSON; it is (re)built and saved here if '
+                             'missing or out of date')
+    parser.add_argument('--strain', type=str,
+                        default='n/a',
+                        help='Lineage; user mode is if strain="n/a"')
+    parser.add_argument('--outgvf', type=str,
+                        help='Filename for the output GVF file')
+    parser.add_argument('--format', type=str, default='gvf',
+                        choices=['gvf', 'parquet'],
+                        help='Output format; parquet keeps the attributes '
+                             'in separate columns for the next stage')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    # Reading the gene & proetin coordinates of the genome
+    with open(args.gene_positions) as fp:
+        GENE_PROTEIN_POSITIONS_DICT = json.load(fp)
+
+    if args.gene_positions_index:
+        gene_index = load_gene_position_index(args.gene_positions_index,
+                                              GENE_PROTEIN_POSITIONS_DICT)
+    else:
+        gene_index = build_gene_position_index(GENE_PROTEIN_POSITIONS_DICT)
+
+    reference = None
+    if args.reference:
+        reference = read_reference(args.reference)
+
+    size_stats = args.size_stats
+    if size_stats == None:
+        size_stats = 'n/a'
+    sample_size = find_sample_size(size_stats, args.strain,
+                                   os.path.basename(args.ivar_tsv), True)
+
+    variants_df = parse_ivar(args.ivar_tsv, GENE_PROTEIN_POSITIONS_DICT,
+                             reference, args.pass_only,
+                             args.allele_freq_thresh)
+    gvf = variants_to_gvf(variants_df, args.strain,
+                          GENE_PROTEIN_POSITIONS_DICT, sample_size,
+                          args.clades_threshold, gene_index)
+
+    # add species to pragmas
+    species = GENE_PROTEIN_POSITIONS_DICT['Src']['species']
+    gvf_pragmas = pragmas.copy()
+    gvf_pragmas[0] = gvf_pragmas[0].str.replace("##species",
+                                                "##species " + str(species))
+
+    write_gvf(gvf, gvf_pragmas, args.outgvf, args.format)
+    print("Saved as: ", args.outgvf)
+    print("")
+    print("Processing complete.")
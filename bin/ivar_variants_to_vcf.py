@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import os
 import sys
-import re
 import errno
 import argparse
 
@@ -10,12 +9,17 @@ def parse_args(args=None):
     Epilog = """Example usage: python ivar_variants_to_vcf.py <FILE_IN> <FILE_OUT>"""
 
     parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
-    parser.add_argument('FILE_IN', help="Input tsv file.")
-    parser.add_argument('FILE_OUT', help="Full path to output vcf file.")
+    parser.add_argument('FILE_IN', nargs='?', help="Input tsv file.")
+    parser.add_argument('FILE_OUT', nargs='?', help="Full path to output vcf file.")
     parser.add_argument('-po', '--pass_only', dest="PASS_ONLY", help="Only output variants that PASS all filters.",action='store_true')
     parser.add_argument('-af', '--allele_freq_thresh', type=float, dest="ALLELE_FREQ_THRESH", default=0, help="Only output variants where allele frequency greater than this number (default: 0).")
+    parser.add_argument('-bz', '--bgzip', dest="BGZIP", help="Write bgzipped vcf files and index them with tabix (needs pysam).",action='store_true')
+    parser.add_argument('-fl', '--file_list', dest="FILE_LIST", default=None, help="File listing the tsv files to convert in one run instead of FILE_IN/FILE_OUT, one per line: tsv<tab>vcf. The vcf defaults to the tsv name with a .vcf (or .vcf.gz) extension in the current directory.")
 
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    if args.FILE_LIST is None and (args.FILE_IN is None or args.FILE_OUT is None):
+        parser.error("FILE_IN and FILE_OUT are required without --file_list")
+    return args
 
 def make_dir(path):
     if not len(path) == 0:
@@ -25,36 +29,44 @@ def make_dir(path):
             if exception.errno != errno.EEXIST:
                 raise
 
-def ivar_variants_to_vcf(FileIn,FileOut,passOnly=False,minAF=0):
-    filename = os.path.splitext(FileIn)[0]
-    header = ('##fileformat=VCFv4.2\n'
-              '##source=iVar\n'
-              '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">\n'
-              '##FILTER=<ID=PASS,Description="Result of p-value <= 0.05">\n'
-              '##FILTER=<ID=FAIL,Description="Result of p-value > 0.05">\n'
-              '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
-              '##FORMAT=<ID=REF_DP,Number=1,Type=Integer,Description="Depth of reference base">\n'
-              '##FORMAT=<ID=REF_RV,Number=1,Type=Integer,Description="Depth of reference base on reverse reads">\n'
-              '##FORMAT=<ID=REF_QUAL,Number=1,Type=Integer,Description="Mean quality of reference base">\n'
-              '##FORMAT=<ID=ALT_DP,Number=1,Type=Integer,Description="Depth of alternate base">\n'
-              '##FORMAT=<ID=ALT_RV,Number=1,Type=Integer,Description="Deapth of alternate base on reverse reads">\n'
-              '##FORMAT=<ID=ALT_QUAL,Number=1,Type=String,Description="Mean quality of alternate base">\n'
-              '##FORMAT=<ID=ALT_FREQ,Number=1,Type=String,Description="Frequency of alternate base">\n')
-    header += '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t'+filename+'\n'
+def read_file_list(FileList,bgzip=False):
+    extension = '.vcf.gz' if bgzip else '.vcf'
+    conversions = []
+    with open(FileList) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == '':
+                continue
+            if len(fields) > 1 and fields[1]:
+                conversions.append((fields[0], fields[1]))
+            else:
+                conversions.append((fields[0], os.path.splitext(os.path.basename(fields[0]))[0] + extension))
+    return conversions
 
-    varList = []
-    varCountDict = {'SNP':0, 'INS':0, 'DEL':0}
-    OutDir = os.path.dirname(FileOut)
-    make_dir(OutDir)
-    fout = open(FileOut,'w')
-    fout.write(header)
+def write_vcf(FileOut,lines,bgzip=False):
+    if bgzip:
+        import pysam
+        fout = pysam.BGZFile(FileOut,'wb')
+        fout.write(''.join(lines).encode())
+        fout.close()
+        pysam.tabix_index(FileOut, preset='vcf', force=True)
+    else:
+        with open(FileOut,'w') as fout:
+            fout.writelines(lines)
+
+def read_ivar_variants(FileIn,passOnly=False,minAF=0):
+    ## Yields (CHROM,POS,REF,ALT,FILTER,var_type,fields) for each variant
+    ## to output, with REF/ALT written as in a VCF; fields are the
+    ## tab-separated columns of the iVar line
+    # variants seen so far, written or not: only the first line of a
+    # variant is considered
+    varSet = set()
     with open(FileIn) as f:
         for line in f:
-            if not re.match("REGION",line):
-                line = re.split("\t", line)
+            if not line.startswith("REGION"):
+                line = line.split("\t")
                 CHROM=line[0]
                 POS=line[1]
-                ID='.'
                 REF=line[2]
                 ALT=line[3]
                 var_type = 'SNP'
@@ -65,39 +77,72 @@ def ivar_variants_to_vcf(FileIn,FileOut,passOnly=False,minAF=0):
                     REF += ALT[1:]
                     ALT = line[2]
                     var_type = 'DEL'
-                QUAL='.'
                 pass_test=line[13]
                 if pass_test == 'TRUE':
                     FILTER='PASS'
                 else:
                     FILTER='FAIL'
-                INFO='DP='+line[11]
-                FORMAT='GT:REF_DP:REF_RV:REF_QUAL:ALT_DP:ALT_RV:ALT_QUAL:ALT_FREQ'
-                SAMPLE='1:'+line[4]+':'+line[5]+':'+line[6]+':'+line[7]+':'+line[8]+':'+line[9]+':'+line[10]
-                oline = CHROM+'\t'+POS+'\t'+ID+'\t'+REF+'\t'+ALT+'\t'+QUAL+'\t'+FILTER+'\t'+INFO+'\t'+FORMAT+'\t'+SAMPLE+'\n'
-                writeLine = True
+                var = (CHROM,POS,REF,ALT)
+                if var in varSet:
+                    continue
+                varSet.add(var)
                 if passOnly and FILTER != 'PASS':
-                    writeLine = False
+                    continue
                 if float(line[10]) < minAF:
-                    writeLine = False
-                if (CHROM,POS,REF,ALT) in varList:
-                    writeLine = False
-                else:
-                    varList.append((CHROM,POS,REF,ALT))
-                if writeLine:
-                    varCountDict[var_type] += 1
-                    fout.write(oline)
-    fout.close()
+                    continue
+                yield CHROM,POS,REF,ALT,FILTER,var_type,line
+
+def ivar_variants_to_vcf(FileIn,FileOut,passOnly=False,minAF=0,bgzip=False):
+    filename = os.path.splitext(FileIn)[0]
+    header = ('##fileformat=VCFv4.2\n'
+              '##source=iVar\n'
+              '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">\n'
+              '##FILTER=<ID=PASS,Description="Result of p-value <= 0.05">\n'
+              '##FILTER=<ID=FAIL,Description="Result of p-value > 0.05">\n'
+              '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+              '##FORMAT=<ID=REF_DP,Number=1,Type=Integer,Description="Depth of reference base">\n'
+              '##FORMAT=<ID=REF_RV,Number=1,Type=Integer,Description="Depth of reference base on reverse reads">\n'
+              '##FORMAT=<ID=REF_QUAL,Number=1,Type=Integer,Description="Mean quality of reference base">\n'
+              '##FORMAT=<ID=ALT_DP,Number=1,Type=Integer,Description="Depth of alternate base">\n'
+              '##FORMAT=<ID=ALT_RV,Number=1,Type=Integer,Description="Deapth of alternate base on reverse reads">\n'
+              '##FORMAT=<ID=ALT_QUAL,Number=1,Type=String,Description="Mean quality of alternate base">\n'
+              '##FORMAT=<ID=ALT_FREQ,Number=1,Type=String,Description="Frequency of alternate base">\n')
+    header += '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t'+filename+'\n'
+
+    varCountDict = {'SNP':0, 'INS':0, 'DEL':0}
+    OutDir = os.path.dirname(FileOut)
+    make_dir(OutDir)
+    olines = [header]
+    for CHROM,POS,REF,ALT,FILTER,var_type,line in read_ivar_variants(FileIn,passOnly,minAF):
+        ID='.'
+        QUAL='.'
+        INFO='DP='+line[11]
+        FORMAT='GT:REF_DP:REF_RV:REF_QUAL:ALT_DP:ALT_RV:ALT_QUAL:ALT_FREQ'
+        SAMPLE='1:'+':'.join(line[4:11])
+        varCountDict[var_type] += 1
+        olines.append('\t'.join([CHROM,POS,ID,REF,ALT,QUAL,FILTER,INFO,FORMAT,SAMPLE])+'\n')
+    write_vcf(FileOut,olines,bgzip)
+
+    return filename, varCountDict
 
+def print_variant_counts(sampleCounts):
     ## Print variant counts to pass to MultiQC
-    varCountList = [(k, str(v)) for k, v in sorted(varCountDict.items())]
-    print('\t'.join(['sample'] + [x[0] for x in varCountList]))
-    print('\t'.join([filename] + [x[1] for x in varCountList]))
+    for i, (filename, varCountDict) in enumerate(sampleCounts):
+        varCountList = [(k, str(v)) for k, v in sorted(varCountDict.items())]
+        if i == 0:
+            print('\t'.join(['sample'] + [x[0] for x in varCountList]))
+        print('\t'.join([filename] + [x[1] for x in varCountList]))
 
 def main(args=None):
     args = parse_args(args)
-    ivar_variants_to_vcf(args.FILE_IN,args.FILE_OUT,args.PASS_ONLY,args.ALLELE_FREQ_THRESH)
+    if args.FILE_LIST:
+        conversions = read_file_list(args.FILE_LIST,args.BGZIP)
+    else:
+        conversions = [(args.FILE_IN,args.FILE_OUT)]
+    sampleCounts = [ivar_variants_to_vcf(FileIn,FileOut,args.PASS_ONLY,args.ALLELE_FREQ_THRESH,args.BGZIP)
+                    for FileIn, FileOut in conversions]
+    print_variant_counts(sampleCounts)
 
 
 if __name__ == '__main__':
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
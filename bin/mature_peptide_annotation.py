@@ -11,43 +11,176 @@ from NCBI.
 """
 
 import argparse
-import gffutils
+import hashlib
+import os
+import urllib.parse
+import numpy as np
 from cyvcf2 import VCF, Writer
 
 
+gene_protein = {
+    "orf1ab": "cds-YP_009724389.1",
+    "S": "cds-YP_009724390.1",
+    "ORF3a": "cds-YP_009724391.1",
+    "E": "cds-YP_009724392.1",
+    "M": "cds-YP_009724393.1",
+    "ORF6": "cds-YP_009724394.1",
+    "ORF7a": "cds-YP_009724395.1",
+    "ORF7b": "cds-YP_009725318.1",
+    "ORF8": "cds-YP_009724396.1",
+    "N": "cds-YP_009724397.2",
+    "ORF10": "cds-YP_009725255.1",
+}
+
+# INFO fields added to the VCF, and the GFF attribute each one is taken from
+peptide_attributes = {"mat_pep_id": "product",
+                      "mat_pep_desc": "Note",
+                      "mat_pep_acc": "protein_id"}
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description='Adds mature peptide annotation to VCF files ')
     parser.add_argument('--vcf_file', type=str, default=None,
                         help='Variant calling output file in VCF '
                              'format')
+    parser.add_argument('--vcf_list', type=str, default=None,
+                        help='Manifest of VCF files to annotate in one '
+                             'run, one per line: vcf<tab>output_vcf '
+                             '(output_vcf is optional, default is '
+                             '<vcf name>.annotated.vcf)')
     parser.add_argument('--annotation_file', type=str, default=None,
                         help='Annotation file (SARS-CoV-2) in GFF '
                              'format')
+    parser.add_argument('--peptide_index', type=str, default=None,
+                        help='Prebuilt .npz index of the mature peptides '
+                             'in the GFF; it is (re)built and saved here '
+                             'if missing or out of date')
     parser.add_argument('--output_vcf', type=str, default=None,
                         help='Output VCF file')
     return parser.parse_args()
 
 
-if __name__ == '__main__':
-    args = parse_args()
-    gene_protein = {
-        "orf1ab": "cds-YP_009724389.1",
-        "S": "cds-YP_009724390.1",
-        "ORF3a": "cds-YP_009724391.1",
-        "E": "cds-YP_009724392.1",
-        "M": "cds-YP_009724393.1",
-        "ORF6": "cds-YP_009724394.1",
-        "ORF7a": "cds-YP_009724395.1",
-        "ORF7b": "cds-YP_009725318.1",
-        "ORF8": "cds-YP_009724396.1",
-        "N": "cds-YP_009724397.2",
-        "ORF10": "cds-YP_009725255.1",
-    }
-    db = gffutils.create_db(
-        args.annotation_file, 'ncov_annotation.db',
-        force=True, merge_strategy="merge")
-    data_vcf = VCF(args.vcf_file)
+def gff_checksum(annotation_file):
+    # checksum of the GFF contents, stored with the index so that a
+    # stale index can be detected
+    with open(annotation_file, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def read_mature_peptides(annotation_file):
+    # mature peptide features of the GFF, in file order, with their
+    # attributes decoded and joined as gffutils would give them
+    peptides = []
+    with open(annotation_file) as fp:
+        for line in fp:
+            fields = line.rstrip('\n').split('\t')
+            if line.startswith('#') or len(fields) < 9 or \
+                    fields[2] != 'mature_protein_region_of_CDS':
+                continue
+            attributes = {}
+            for attribute in fields[8].split(';'):
+                if '=' in attribute:
+                    key, value = attribute.split('=', 1)
+                    attributes[key] = " ".join(
+                        urllib.parse.unquote(x) for x in value.split(','))
+            peptides.append((attributes.get('Parent', ''), int(fields[3]),
+                             int(fields[4]), attributes))
+    return peptides
+
+
+def build_peptide_index(annotation_file):
+    """
+    Builds a sorted-array index of the mature peptides of each CDS in
+    the GFF, for find_mature_peptide.
+
+    For each CDS (parent), the genome is cut into segments at every
+    peptide start and end+1, and 'segment_peptide' holds the peptide
+    that each segment maps to (-1 if none). Where peptides overlap, the
+    one that starts last is used (ties in GFF order), as when looping
+    over the peptides ordered by start.
+    """
+    peptides = read_mature_peptides(annotation_file)
+    order = sorted(range(len(peptides)), key=lambda i: peptides[i][1])
+    peptides = [peptides[i] for i in order]
+
+    parents = np.array([peptide[0] for peptide in peptides], dtype=str)
+    starts = np.array([peptide[1] for peptide in peptides], dtype=np.int64)
+    ends = np.array([peptide[2] for peptide in peptides], dtype=np.int64)
+
+    index = {"checksum": gff_checksum(annotation_file), "parent": parents}
+    for info, attribute in peptide_attributes.items():
+        index[info] = np.array(
+            [peptide[3].get(attribute, '').replace(";", ",")
+             for peptide in peptides], dtype=str)
+
+    # segments of each parent CDS, concatenated
+    segment_parent, breaks, segment_peptide = [], [], []
+    for parent in np.unique(parents):
+        rows = np.flatnonzero(parents == parent)
+        parent_breaks = np.unique(np.concatenate([starts[rows],
+                                                  ends[rows] + 1]))
+        parent_segments = np.full(parent_breaks.shape[0], -1,
+                                  dtype=np.int64)
+        # later peptides overwrite earlier ones
+        for i in rows:
+            parent_segments[(parent_breaks >= starts[i]) &
+                            (parent_breaks <= ends[i])] = i
+        segment_parent.append(np.full(parent_breaks.shape[0], parent,
+                                      dtype=parents.dtype))
+        breaks.append(parent_breaks)
+        segment_peptide.append(parent_segments)
+
+    index["segment_parent"] = np.concatenate(segment_parent) \
+        if segment_parent else np.zeros(0, dtype=str)
+    index["breaks"] = np.concatenate(breaks) \
+        if breaks else np.zeros(0, dtype=np.int64)
+    index["segment_peptide"] = np.concatenate(segment_peptide) \
+        if segment_peptide else np.zeros(0, dtype=np.int64)
+    return index
+
+
+def save_peptide_index(index, filepath):
+    # an index staged as a symlink (eg. by Nextflow) is replaced rather
+    # than written through
+    if os.path.islink(filepath):
+        os.remove(filepath)
+    with open(filepath, 'wb') as fp:
+        np.savez(fp, **index)
+
+
+def load_peptide_index(filepath, annotation_file):
+    """
+    Loads a mature peptide index saved as .npz. If the file does not
+    exist, or was built from a different GFF, the index is rebuilt and
+    saved to filepath.
+    """
+    if os.path.exists(filepath):
+        with np.load(filepath) as npz:
+            index = dict((key, npz[key]) for key in npz.files)
+        if str(index["checksum"]) == gff_checksum(annotation_file):
+            return index
+        print("Mature peptide index " + filepath +
+              " does not match " + annotation_file + "; rebuilding")
+
+    index = build_peptide_index(annotation_file)
+    save_peptide_index(index, filepath)
+    return index
+
+
+def find_mature_peptide(index, parent, pos):
+    # row of the mature peptide of CDS `parent` at position pos, or -1
+    first = np.searchsorted(index["segment_parent"], parent, side='left')
+    last = np.searchsorted(index["segment_parent"], parent, side='right')
+    segment = np.searchsorted(index["breaks"][first:last], pos,
+                              side='right') - 1
+    if segment < 0:
+        return -1
+    return int(index["segment_peptide"][first + segment])
+
+
+def annotate_vcf(vcf_file, output_vcf, index):
+    data_vcf = VCF(vcf_file)
     data_vcf.add_info_to_header(
         {'ID': 'mat_pep_id', 'Description': 'Mature Peptide ID',
          'Type': 'String', 'Number': '.'})
@@ -59,27 +192,50 @@ if __name__ == '__main__':
         {'ID': 'mat_pep_acc',
          'Description': 'Mature Peptide Accession Number',
          'Type': 'String', 'Number': '.'})
-    output_file_name = args.output_vcf
-    w = Writer(output_file_name, data_vcf)
+    w = Writer(output_vcf, data_vcf)
 
     for record in data_vcf:
         if record.INFO.get('EFF').split("|")[5] == "orf1ab":
-            gene = db[gene_protein[record.INFO.get('EFF').split("|")[5]]]
-            record.INFO["mat_pep_id"] = "n/a"
-            record.INFO["mat_pep_desc"] = "n/a"
-            record.INFO["mat_pep_acc"] = "n/a"
-            for i in db.children(gene,
-                                featuretype='mature_protein_region_of_CDS',
-                                order_by='start'):
-                if int(i.start) <= int(record.POS) <= int(i.end):
-                    record.INFO["mat_pep_id"] = str(" ".join(
-                        i.attributes['product'])).replace(";", ",")
-                    record.INFO["mat_pep_desc"] = str(" ".join(
-                        i.attributes['Note'])).replace(";", ",")
-                    record.INFO["mat_pep_acc"] = str(" ".join(
-                        i.attributes['protein_id'])).replace(";", ",")
-            w.write_record(record)
-        else:
-            w.write_record(record)
+            parent = gene_protein[record.INFO.get('EFF').split("|")[5]]
+            peptide = find_mature_peptide(index, parent, int(record.POS))
+            for info in peptide_attributes:
+                record.INFO[info] = "n/a" if peptide == -1 \
+                    else str(index[info][peptide])
+        w.write_record(record)
     w.close()
     data_vcf.close()
+
+
+def read_vcf_list(vcf_list):
+    # manifest of VCFs to annotate, one per line: vcf_path [<tab> output_vcf]
+    annotations = []
+    with open(vcf_list) as fp:
+        for line in fp:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == '':
+                continue
+            if len(fields) > 1 and fields[1]:
+                output_vcf = fields[1]
+            else:
+                output_vcf = os.path.basename(fields[0]).replace(
+                    '.vcf', '') + '.annotated.vcf'
+            annotations.append((fields[0], output_vcf))
+    return annotations
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # index the mature peptides once for all VCFs
+    if args.peptide_index:
+        index = load_peptide_index(args.peptide_index, args.annotation_file)
+    else:
+        index = build_peptide_index(args.annotation_file)
+
+    if args.vcf_list:
+        annotations = read_vcf_list(args.vcf_list)
+    else:
+        annotations = [(args.vcf_file, args.output_vcf)]
+
+    for vcf_file, output_vcf in annotations:
+        annotate_vcf(vcf_file, output_vcf, index)
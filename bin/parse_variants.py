@@ -13,6 +13,7 @@ dataset for extracting metadata.
 import argparse
 import pandas as pd
 import csv
+import json
 from functions import *
 import datetime
 
@@ -28,6 +29,13 @@ def parse_args():
                         help='metadata file')
     parser.add_argument('--virusseq', action='store_true', default=False,
                         help='virusseq updated lineages only')                    
+    parser.add_argument('--alias_key', type=str, default=None,
+                        help='Pango alias_key.json, to match aliased '
+                             'lineages (eg. Q.1 and B.1.1.7.1)')
+    parser.add_argument('--lineage_trie', type=str, default=None,
+                        help='JSON file caching the lineages of the '
+                             'variants file; it is (re)built and saved '
+                             'here if missing or out of date')
     parser.add_argument('--outfile', type=str, default=None,
                         help='list of lineages in output file')
 
@@ -51,17 +59,19 @@ if __name__ == '__main__':
         if not args.variants == None:
             variants = pd.read_csv(args.variants, sep="\t",
                                 low_memory=False)
-            lineages = parse_variant_file(dataframe = variants)
-
-            for metadata_lineage in metadata_lineages:
-                for who_lin in lineages:
-                    if "*" in who_lin:
-                        who_lin = who_lin[:-1]
-                        if isinstance(metadata_lineage, str) and metadata_lineage.startswith(who_lin):
-                            parsed_lineages.append(metadata_lineage)
-                    else:
-                        if metadata_lineage == who_lin:
-                            parsed_lineages.append(metadata_lineage)
+            alias_key = None
+            if args.alias_key:
+                with open(args.alias_key) as fp:
+                    alias_key = json.load(fp)
+            if args.lineage_trie:
+                lineage_trie = load_lineage_trie(args.lineage_trie,
+                                                 variants, alias_key)
+            else:
+                lineage_trie = build_lineage_trie(variants, alias_key)
+
+            # keep the metadata lineages that belong to a listed variant
+            rows = resolve_lineages(metadata_lineages, lineage_trie)
+            parsed_lineages = metadata_lineages[rows != -1]
 
         else:
             parsed_lineages=metadata_lineages
@@ -10,7 +10,7 @@ EMBL-EBI at https://github.com/W-L/ProblematicSites_SARS-CoV2/
 """
 
 import argparse
-import pandas as pd
+import os
 from cyvcf2 import VCF, Writer
 
 
@@ -22,6 +22,11 @@ def parse_args():
     parser.add_argument('--vcffile', type=str, default=None,
                         help='Variant calling output file in VCF '
                              'format')
+    parser.add_argument('--vcf_list', type=str, default=None,
+                        help='Manifest of VCF files to tag in one run, '
+                             'one per line: vcf<tab>output_vcf '
+                             '(output_vcf is optional, default is '
+                             '<vcf name>.filtered.vcf)')
     parser.add_argument('--filter_vcf', type=str, default=None,
                         help='Problematic sites in SARS-CoV-2 genomes '
                              'in VCF file')
@@ -30,12 +35,25 @@ def parse_args():
     return parser.parse_args()
 
 
-if __name__ == '__main__':
+def read_problematic_sites(filter_vcf):
+    """
+    Indexes the problematic sites VCF by (POS, REF), with the FILTER
+    (mask/caution) and EXC (reasons) of each site. The ALT column of
+    the problematic sites lists the alleles seen at a site, and the
+    mask/caution applies to the site whatever the ALT of a record is.
+    """
+    sites = {}
+    prob_vcf = VCF(filter_vcf)
+    for v in prob_vcf:
+        sites[(v.POS, v.REF)] = (v.FILTER, v.INFO.get('EXC'))
+    prob_vcf.close()
+    return sites
 
-    args = parse_args()
+
+def tag_vcf(vcffile, output_vcf, sites):
 
     # Reading the VCF file and adding 2 more attributes into INFO header
-    data_vcf = VCF(args.vcffile)
+    data_vcf = VCF(vcffile)
     data_vcf.add_info_to_header(
         {'ID': 'ps_filter', 'Description': 'Mask/Caution',
          'Type': 'String', 'Number': '1'})
@@ -45,54 +63,49 @@ if __name__ == '__main__':
          'Type': 'String', 'Number': '1'})
 
     # create a new vcf Writer using the input vcf as a template.
-    fname = args.output_vcf
-
-    w = Writer(fname, data_vcf)
-    prob_vcf_columns = ['CHROM', 'POS', 'ID', 'REF',
-                        'ALT', 'QUAL', 'FILTER',
-                        'INFO']
-    prob_vcf_df = pd.DataFrame(index=range(0, 478),
-                               columns=prob_vcf_columns)
-
-    # Make a dataframe from VCF object for indexed searching
-    row = 0
-    prob_vcf = VCF(args.filter_vcf)
-    print(prob_vcf)
-    for v in prob_vcf:
-        prob_vcf_df.iloc[row, [0]] = "MN908947.3"
-        prob_vcf_df.iloc[row, [1]] = v.POS
-        if not v.ALT:
-            prob_vcf_df.iloc[row, [2]] = "."
-        else:
-            prob_vcf_df.iloc[row, [2]] = v.ID
-        prob_vcf_df.iloc[row, [3]] = v.REF
-        if not v.ALT:
-            prob_vcf_df.iloc[row, [4]] = "."
-        else:
-            prob_vcf_df.iloc[row, [4]] = ",".join(v.ALT)
-        if not v.QUAL:
-            prob_vcf_df.iloc[row, [5]] = "."
-        else:
-            prob_vcf_df.iloc[row, [5]] = v.QUAL
-        prob_vcf_df.iloc[row, [6]] = v.FILTER
-        prob_vcf_df.iloc[row, [7]] = v.INFO.get('EXC')
-        row = row + 1
+    w = Writer(output_vcf, data_vcf)
 
     # Searching records and adding TAGs into INFO column
     for record in data_vcf:
         record.INFO["ps_filter"] = ""
         record.INFO["ps_exc"] = ""
-        if (record.POS in prob_vcf_df["POS"].values) & \
-                (record.REF in prob_vcf_df["REF"].values) & \
-                (record.ALT in prob_vcf_df["ALT"].values):
-            record.INFO["ps_filter"] = prob_vcf_df.loc[
-                prob_vcf_df['POS']
-                == record.POS, 'FILTER'].item()
-            record.INFO["ps_exc"] = prob_vcf_df.loc[prob_vcf_df[
-                                                        'POS'] ==
-                                                    record.POS,
-                                                    'INFO'].item()
+        tags = sites.get((record.POS, record.REF))
+        if tags is not None:
+            record.INFO["ps_filter"], record.INFO["ps_exc"] = tags
         w.write_record(record)
 
     w.close()
     data_vcf.close()
+
+
+def read_vcf_list(vcf_list):
+    # manifest of VCFs to tag, one per line: vcf_path [<tab> output_vcf]
+    taggings = []
+    with open(vcf_list) as fp:
+        for line in fp:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == '':
+                continue
+            if len(fields) > 1 and fields[1]:
+                output_vcf = fields[1]
+            else:
+                output_vcf = os.path.basename(fields[0]).replace(
+                    '.vcf', '') + '.filtered.vcf'
+            taggings.append((fields[0], output_vcf))
+    return taggings
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    # index the problematic sites once for all VCFs
+    sites = read_problematic_sites(args.filter_vcf)
+
+    if args.vcf_list:
+        taggings = read_vcf_list(args.vcf_list)
+    else:
+        taggings = [(args.vcffile, args.output_vcf)]
+
+    for vcffile, output_vcf in taggings:
+        tag_vcf(vcffile, output_vcf, sites)
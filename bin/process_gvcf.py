@@ -11,22 +11,26 @@ is used in nf-ncov-voc workflow.
 
 """
 
-import itertools
 import argparse
+import json
+import numpy as np
 import pysam
 import sys
 import os
+import tempfile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-# fromhttps://www.geeksforgeeks.org/python-make-a-list-of-intervals-with-sequential-numbers/
-# via artic-mask
+# intervals of consecutive True positions of a boolean vector, as
+# [first, last] 0-based positions (same as artic-mask's intervals of
+# sequential numbers), found by run-length encoding the mask
 
 
-def intervals_extract(iterable):
-    iterable = sorted(set(iterable))
-    for _, group in itertools.groupby(enumerate(iterable), lambda t: t[1] - t[0]):
-        group = list(group)
-        yield [group[0][1], group[-1][1]]
+def intervals_extract(mask_vector):
+    edges = np.diff(np.concatenate(([0], mask_vector.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    return zip(starts, ends)
 
 # write the depth mask used with bcftools to turn consensus positions
 # into Ns
@@ -35,20 +39,65 @@ def intervals_extract(iterable):
 def write_depth_mask(out_filename, contig_depths, min_coverage):
     maskfh = open(out_filename, 'w')
     for contig_name, depths in contig_depths.items():
-        # from artic-mask, create list of positions that fail the
-        # depth check
-        mask_vector = []
-        for pos, depth in enumerate(depths):
-            if depth < min_coverage:
-                mask_vector.append(pos)
+        # from artic-mask, mask positions that fail the depth check
+        mask_vector = depths < min_coverage
 
         # get the intervals from the mask_vector
-        intervals = list(intervals_extract(mask_vector))
-
-        for i in intervals:
-            maskfh.write("%s\t%s\t%s\n" % (contig_name, i[0]+1, i[1]+1))
+        for start, end in intervals_extract(mask_vector):
+            maskfh.write("%s\t%s\t%s\n" % (contig_name, start+1, end+1))
     maskfh.close()
 
+# features of the gene positions JSON summarized in the coverage
+# output: CDS regions and mature peptides
+
+coverage_feature_types = ["CDS", "mature_protein_region_of_CDS"]
+
+# write the per-gene and per-mature-peptide depth summary of each
+# contig, from prefix sums over the depth vector; positions outside the
+# contig are ignored
+
+
+def write_coverage_summary(out_filename, contig_depths, gene_positions,
+                           min_coverage):
+    features = [(name, entry) for name, entry in gene_positions.items()
+                if entry["type"] in coverage_feature_types]
+    coverfh = open(out_filename, 'w')
+    coverfh.write("contig\tfeature\ttype\tstart\tend\tmean_depth\t"
+                  "median_depth\tfraction_min_depth\n")
+    for contig_name, depths in contig_depths.items():
+        depth_sums = np.concatenate(([0], np.cumsum(depths, dtype=np.int64)))
+        covered_sums = np.concatenate(
+            ([0], np.cumsum(depths >= min_coverage, dtype=np.int64)))
+        for name, entry in features:
+            # 1-based, inclusive coordinates to a 0-based slice
+            start = max(int(entry["start"]) - 1, 0)
+            end = min(int(entry["end"]), len(depths))
+            length = end - start
+            if length <= 0:
+                continue
+            mean_depth = (depth_sums[end] - depth_sums[start]) / length
+            median_depth = np.median(depths[start:end])
+            fraction = (covered_sums[end] - covered_sums[start]) / length
+            coverfh.write("%s\t%s\t%s\t%s\t%s\t%.2f\t%.1f\t%.4f\n" % (
+                contig_name, name, entry["type"], entry["start"],
+                entry["end"], mean_depth, median_depth, fraction))
+    coverfh.close()
+
+# save the mean depth of every bin_size bases as a float32 .npy array
+# (the last bin of a contig may be shorter); contigs are concatenated
+# in header order
+
+
+def write_depth_track(out_filename, contig_depths, bin_size):
+    track = list()
+    for depths in contig_depths.values():
+        depth_sums = np.concatenate(([0], np.cumsum(depths, dtype=np.int64)))
+        bounds = np.append(np.arange(0, len(depths), bin_size), len(depths))
+        track.append((depth_sums[bounds[1:]] - depth_sums[bounds[:-1]]) /
+                     np.diff(bounds))
+    np.save(out_filename, np.concatenate(track + [np.zeros(0)]).astype(
+        np.float32))
+
 # calculate the variant allele fraction for each alt allele using
 # freebayes' read/alt observation tags
 
@@ -158,6 +207,179 @@ def handle_sub(vcf_header, record):
     return output
 
 
+# set the depth of the parts of the genome covered by records, from
+# lists of their 0-based starts, ends and depths; where records
+# overlap, later ones win, as when setting them one by one
+
+
+def set_depths(depths, starts, stops, values):
+    starts = np.array(starts, dtype=np.int64)
+    lengths = np.array(stops, dtype=np.int64) - starts
+    values = np.array(values, dtype=depths.dtype)
+    if not (lengths == 1).all():
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) -
+                                                       lengths, lengths)
+        starts = np.repeat(starts, lengths) + offsets
+        values = np.repeat(values, lengths)
+    if (np.diff(starts) <= 0).any():
+        # keep the last value set at each position
+        starts, last = np.unique(starts[::-1], return_index=True)
+        values = values[::-1][last]
+    depths[starts] = values
+
+# return the records to apply to the consensus sequence for a gVCF
+# record; if there are any, the VAF of the record is filled in so that
+# it can be written out as a variant
+
+
+def call_record(out_header, record, min_depth, lower_ambiguity_frequency,
+                upper_ambiguity_frequency):
+    consensus_records = list()
+
+    # do nothing with ref records, or records that don't
+    # meet our minimum depth
+    if record.alts[0] == "<*>" or record.info["DP"] < min_depth:
+        return consensus_records
+
+    # determine if any allele in the variant is an indel
+    has_indel = False
+    for i in range(0, len(record.alts)):
+        has_indel = has_indel or len(record.ref) != len(record.alts[i])
+
+    # process the input variant record to handle multi-allelic
+    # variants and MNPs
+    out_records = list()
+    if has_indel:
+        # indels need to be handle specially as we can't apply
+        # ambiguity codes
+        out_records = handle_indel(out_header, record)
+    else:
+        out_records = handle_sub(out_header, record)
+
+    # classify variants using VAF cutoffs for IUPAC ambiguity
+    # codes, etc
+    for out_r in out_records:
+
+        # at this point we should have resolved multi-allelic
+        # variants
+        assert(len(out_r.alts) == 1)
+
+        vaf = out_r.info["VAF"][0]
+        is_indel = len(out_r.ref) != len(out_r.alts[0])
+
+        # discard low frequency variants
+        if vaf < lower_ambiguity_frequency:
+            continue
+
+        # Write a tag describing what to do with the variant
+        consensus_tag = "None"
+
+        # high-frequency subs and indels are always applied
+        # without ambiguity
+        # we don't have to do an indel VAF check here as it is
+        # dealt with in handle_indel
+        if vaf > upper_ambiguity_frequency or is_indel:
+            # always apply these to the consensus
+            consensus_tag = "fixed"
+        else:
+            # record ambiguous SNPs in the consensus sequence
+            # with IUPAC codes
+            consensus_tag = "ambiguous"
+        out_r.info["ConsensusTag"] = consensus_tag
+        consensus_records.append(out_r)
+
+    if consensus_records:
+        record.info["VAF"] = calculate_vafs(record)
+    return consensus_records
+
+# add the INFO tags of the output VCFs to a header
+
+
+def add_output_info(header):
+    header.info.add("VAF", number="A", type='Float',
+                    description="Variant allele fraction, called "
+                                "from observed reference/alt "
+                                "reads")
+    header.info.add("ConsensusTag", number=1, type='String',
+                    description="The type of base to be included "
+                                "in the consensus sequence (IUPAC"
+                                " or Fixed)")
+
+# return a bgzipped, indexed copy of a gVCF in tmpdir, or the gVCF
+# itself if it is already indexed, for fetching regions
+
+
+def indexed_gvcf(filename, tmpdir):
+    with pysam.VariantFile(filename) as vcf:
+        if vcf.index is not None:
+            return filename
+        compression = vcf.compression
+
+    indexed = os.path.join(tmpdir, os.path.basename(filename) + '.gz')
+    if compression == 'BGZF':
+        os.symlink(os.path.abspath(filename), indexed)
+    else:
+        pysam.tabix_compress(filename, indexed)
+    pysam.tabix_index(indexed, preset='vcf')
+    return indexed
+
+# split each indexed contig into n regions of about the same length,
+# in file order; the last region of a contig is open-ended
+
+
+def split_regions(filename, contig_lengths, n):
+    regions = list()
+    with pysam.VariantFile(filename) as vcf:
+        contigs = list(vcf.index.keys())
+    for contig in contigs:
+        bounds = np.linspace(0, contig_lengths[contig], n + 1).astype(int)
+        for i in range(0, n):
+            end = int(bounds[i + 1]) if i < n - 1 else None
+            regions.append((contig, int(bounds[i]), end))
+    return regions
+
+# process the records of a region of an indexed gVCF that start in the
+# region [start, end), 0-based; returns the starts, ends and depths of
+# these records, for set_depths, and the variant and consensus-site VCF
+# lines, in order
+
+
+def process_region(filename, contig, start, end, min_depth,
+                   lower_ambiguity_frequency, upper_ambiguity_frequency):
+    vcf = pysam.VariantFile(filename)
+    out_header = vcf.header
+    add_output_info(out_header)
+
+    starts, stops, depths = spans = ([], [], [])
+    variant_lines = list()
+    consensus_lines = list()
+    for record in vcf.fetch(contig, start, end):
+        # records overlapping the start belong to the previous region
+        v_start = record.start
+        if v_start < start:
+            continue
+        # as in main
+        is_gvcf_ref = record.alleles[1] == "<*>"
+        v_end = record.stop
+        depth = record.info["DP"]
+        assert(not is_gvcf_ref or v_end - v_start == 1)
+        starts.append(v_start)
+        stops.append(v_end)
+        depths.append(depth)
+
+        if is_gvcf_ref or depth < min_depth:
+            continue
+        consensus_records = call_record(out_header, record, min_depth,
+                                        lower_ambiguity_frequency,
+                                        upper_ambiguity_frequency)
+        for out_r in consensus_records:
+            consensus_lines.append(str(out_r))
+        if consensus_records:
+            variant_lines.append(str(record))
+    vcf.close()
+    return spans, variant_lines, consensus_lines
+
+
 def main():
 
     description = 'Process a .gvcf file to create a file of consensus '\
@@ -204,16 +426,43 @@ def main():
                                                        f"ambiguity "
                                                        f"codes")
 
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help=f"Number of processes; with more than one, "
+                             f"each contig is split into this many "
+                             f"regions processed in parallel (the gVCF "
+                             f"is bgzipped and indexed first if needed)")
+
+    parser.add_argument('-g', '--gene-positions',
+                        help=f"Gene positions JSON, to summarize the depth "
+                             f"of each CDS and mature peptide in "
+                             f"--coverage-output")
+
+    parser.add_argument('--coverage-output',
+                        help=f"The output file name for the per-gene and "
+                             f"per-mature-peptide coverage summary (needs "
+                             f"--gene-positions)\n")
+
+    parser.add_argument('--depth-track-output',
+                        help=f"The output file name (.npy) for the depth "
+                             f"track, the mean depth of every "
+                             f"--depth-track-bin bases\n")
+
+    parser.add_argument('--depth-track-bin', type=int, default=10,
+                        help=f"Bin size of the depth track")
+
     parser.add_argument('file', action='store', nargs=1)
 
     args = parser.parse_args()
+    if args.coverage_output and not args.gene_positions:
+        parser.error("--coverage-output needs --gene-positions")
     vcf = pysam.VariantFile(open(args.file[0],'r'))
 
     # Initialize depth mask to all zeros for all contigs
     contig_depth = defaultdict(list)
     for r in vcf.header.records:
         if r.type == "CONTIG":
-            contig_depth[r['ID']] = [0] * int(r['length'])
+            contig_depth[r['ID']] = np.zeros(int(r['length']),
+                                             dtype=np.int32)
 
     out_header = vcf.header
 
@@ -234,87 +483,94 @@ def main():
     consensus_sites_out = pysam.VariantFile(
         args.consensus_sites_output, 'w', header=out_header)
 
-    for record in vcf:
-
-        is_gvcf_ref = record.alts[0] == "<*>"
-
-        # set depth for this part of the genome
-        # this works for both gVCF blocks and regular variants
-        # because pos/stop are set appropriately
-        v_start = record.pos
-        v_end = record.stop
-        depth = record.info["DP"]
-
-        # disallow gvcf records that are longer than a single base
-        assert(not is_gvcf_ref or v_start == v_end)
-
-        # update depth mask
-        for i in range(v_start, v_end + 1):
-            assert(i > 0)
-            # VCF coordinates are 1-based, we record the depth vector
-            # as 0-based to be consistent with artic-mask
-            contig_depth[record.chrom][i - 1] = depth
-
-        # do nothing else with ref records, or records that don't
-        # meet our minimum depth
-        if is_gvcf_ref or depth < args.min_depth:
-            continue
-
-        # determine if any allele in the variant is an indel
-        has_indel = False
-        for i in range(0, len(record.alts)):
-            has_indel = has_indel or len(record.ref) != len(record.alts[i])
-
-        # process the input variant record to handle multi-allelic
-        # variants and MNPs
-        out_records = list()
-        if has_indel:
-            # indels need to be handle specially as we can't apply
-            # ambiguity codes
-            out_records = handle_indel(out_header, record)
-        else:
-            out_records = handle_sub(out_header, record)
-
-        # classify variants using VAF cutoffs for IUPAC ambiguity
-        # codes, etc
-        accept_variant = False
-        for out_r in out_records:
-
-            # at this point we should have resolved multi-allelic
-            # variants
-            assert(len(out_r.alts) == 1)
-
-            vaf = out_r.info["VAF"][0]
-            is_indel = len(out_r.ref) != len(out_r.alts[0])
-
-            # discard low frequency variants
-            if vaf < args.lower_ambiguity_frequency:
+    # parts of each contig covered by records and their depths, set
+    # once all records are read
+    contig_spans = dict((contig, ([], [], [])) for contig in contig_depth)
+
+    if args.threads > 1:
+        # process regions of the gVCF in parallel, and merge them in
+        # order; depths set by later records overwrite earlier ones, as
+        # when reading the gVCF serially
+        variant_lines = list()
+        consensus_lines = list()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            gvcf = indexed_gvcf(args.file[0], tmpdir)
+            contig_lengths = dict((contig, len(depths)) for contig, depths
+                                  in contig_depth.items())
+            regions = split_regions(gvcf, contig_lengths, args.threads)
+            with ProcessPoolExecutor(max_workers=args.threads) as executor:
+                futures = [executor.submit(
+                    process_region, gvcf, contig, start, end, args.min_depth,
+                    args.lower_ambiguity_frequency,
+                    args.upper_ambiguity_frequency)
+                    for contig, start, end in regions]
+                for (contig, start, end), future in zip(regions, futures):
+                    spans, region_variants, region_consensus = \
+                        future.result()
+                    for merged, region in zip(contig_spans[contig], spans):
+                        merged.extend(region)
+                    variant_lines.extend(region_variants)
+                    consensus_lines.extend(region_consensus)
+
+        # the headers are written by pysam, the records appended as text
+        variants_out.close()
+        consensus_sites_out.close()
+        with open(args.variants_output, 'a') as fh:
+            fh.writelines(variant_lines)
+        with open(args.consensus_sites_output, 'a') as fh:
+            fh.writelines(consensus_lines)
+    else:
+        # spans by record.rid, the index of the contig in the header
+        rid_spans = [contig_spans[contig] for contig in vcf.header.contigs]
+        for record in vcf:
+            # alleles[1] is alts[0], without building the tuple of alts
+            is_gvcf_ref = record.alleles[1] == "<*>"
+
+            # set depth for this part of the genome
+            # this works for both gVCF blocks and regular variants
+            # because start/stop are set appropriately
+            v_start = record.start
+            v_end = record.stop
+            depth = record.info["DP"]
+
+            # disallow gvcf records that are longer than a single base
+            assert(not is_gvcf_ref or v_end - v_start == 1)
+
+            # record.start is 0-based, as the depth vector is to be
+            # consistent with artic-mask
+            starts, stops, depths = rid_spans[record.rid]
+            starts.append(v_start)
+            stops.append(v_end)
+            depths.append(depth)
+
+            # do nothing else with ref records, or records that don't
+            # meet our minimum depth
+            if is_gvcf_ref or depth < args.min_depth:
                 continue
-
-            # Write a tag describing what to do with the variant
-            consensus_tag = "None"
-
-            # high-frequency subs and indels are always applied
-            # without ambiguity
-            # we don't have to do an indel VAF check here as it is
-            # dealt with in handle_indel
-            if vaf > args.upper_ambiguity_frequency or is_indel:
-                # always apply these to the consensus
-                consensus_tag = "fixed"
-            else:
-                # record ambiguous SNPs in the consensus sequence
-                # with IUPAC codes
-                consensus_tag = "ambiguous"
-            out_r.info["ConsensusTag"] = consensus_tag
-            consensus_sites_out.write(out_r)
-            accept_variant = True
-
-        if accept_variant:
-            record.info["VAF"] = calculate_vafs(record)
-            variants_out.write(record)
+            consensus_records = call_record(
+                out_header, record, args.min_depth,
+                args.lower_ambiguity_frequency,
+                args.upper_ambiguity_frequency)
+            for out_r in consensus_records:
+                consensus_sites_out.write(out_r)
+            if consensus_records:
+                variants_out.write(record)
+
+    for contig, spans in contig_spans.items():
+        set_depths(contig_depth[contig], *spans)
 
     write_depth_mask(args.mask_output, contig_depth, args.min_depth)
 
+    if args.coverage_output:
+        with open(args.gene_positions) as fp:
+            gene_positions = json.load(fp)
+        write_coverage_summary(args.coverage_output, contig_depth,
+                               gene_positions, args.min_depth)
+
+    if args.depth_track_output:
+        write_depth_track(args.depth_track_output, contig_depth,
+                          args.depth_track_bin)
+
 
 if __name__ == "__main__":
     main()
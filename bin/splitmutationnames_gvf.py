@@ -16,8 +16,8 @@ import argparse
 import pandas as pd
 import numpy as np
 from functions import separate_attributes, rejoin_attributes, \
-    split_names, unnest_multi
-from functions import empty_attributes, gvf_columns
+    split_names, unnest_multi, read_gvf, write_gvf
+from functions import empty_attributes, gvf_columns, attribute_keys
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -26,6 +26,10 @@ def parse_args():
                         help='Path to the GVF file output of vcf2gvf.py')
     parser.add_argument('--outgvf', type=str,
                         help='Filename for the output gvf file')
+    parser.add_argument('--format', type=str, default='gvf',
+                        choices=['gvf', 'parquet'],
+                        help='Output format; parquet keeps the attributes '
+                             'in separate columns for the next stage')
     parser.add_argument('--names_to_split', type=str,
                         default=None,
                         help='.tsv of multi-aa mutation names to '
@@ -33,46 +37,37 @@ def parse_args():
     return parser.parse_args()
 
 
-if __name__ == '__main__':
-
-    args = parse_args()
-    
-    # split names in gvf file
-    
-    # read in gvf file
-    gvf = pd.read_csv(args.ingvf, sep='\t', names=gvf_columns, index_col=False)
-
-    # remove pragmas and original header row
-    pragmas = gvf[gvf['#seqid'].astype(str).str.contains("##")]
-    pragmas.columns = range(9)
-    pragmas = pragmas.fillna('')
-    gvf = gvf[~gvf['#seqid'].astype(str).str.contains("#")]
-
-    # expand #attributes into columns to edit separately
-    gvf = separate_attributes(gvf)
+def split_gvf_names(gvf, names_to_split):
+    # takes and returns a GVF with #attributes expanded into
+    # separate columns
 
     # split names in "Names" attribute into separate rows
-    gvf = split_names(args.names_to_split, gvf, col_to_split='Name')
+    gvf = split_names(names_to_split, gvf, col_to_split='Name')
     
     # rename IDs: rows with the same entry in 'Name'
     # get the same ID
     gvf['ID'] = 'ID_' + gvf.groupby('Name', sort=False).ngroup().astype(str)
-    
-    # merge attributes back into a single column
-    gvf = rejoin_attributes(gvf, empty_attributes)
 
     # discard temporary columns
-    gvf = gvf[gvf_columns]
+    return gvf[gvf_columns + attribute_keys(empty_attributes)]
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
     
-    # add pragmas to gvf
-    # columns are now 0, 1, ...
-    final_gvf = pd.DataFrame(np.vstack([gvf.columns, gvf]))
-    final_gvf = pragmas.append(final_gvf)
+    # split names in gvf file
     
-    # save modified file to .gvf
+    # read in gvf file, with #attributes expanded into columns
+    gvf, pragmas = read_gvf(args.ingvf)
+
+    # split names and update IDs
+    gvf = split_gvf_names(gvf, args.names_to_split)
+
+    # add pragmas and save modified file
     filepath = args.outgvf
+    write_gvf(gvf, pragmas, filepath, args.format)
     print("Saved as: ", filepath)
     print("")
-    final_gvf.to_csv(filepath, sep='\t', index=False, header=False)
 
 
@@ -24,7 +24,12 @@ import csv
 import sys
 import re
 from collections import OrderedDict
+from string import Template
 import numpy as np
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
 
 
 def parse_args():
@@ -32,8 +37,13 @@ def parse_args():
         description='Summarizes raw surveillance file (TSV) into '
                     'indicator centric and mutation centric readable '
                     'PDF report')
-    parser.add_argument('--tsv', type=str, default=None,
-                        help='Path to surveillance report TSV file')
+    parser.add_argument('--tsv', type=str, default=None, nargs='+',
+                        help='Path(s) to surveillance report TSV '
+                             'file(s), eg. one per variant')
+    parser.add_argument('--outdir', type=str, default=None,
+                        help='Directory to save a <TSV name>.tex report '
+                             'to for each TSV; by default a single '
+                             'report is written to stdout')
     parser.add_argument('--functions_table', type=str, default=None,
                         help='TSV file containing Pokay '
                              'Functional categories:Indicators '
@@ -46,35 +56,40 @@ def parse_args():
                              'for inclusion in report')
     parser.add_argument('--virusseq', type=bool, default=False,
                         help='VirusSeq dataset')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to render reports with')
+    parser.add_argument('--compile', action="store_true",
+                        help='Compile each report to PDF with tectonic')
+    parser.add_argument('--compile_jobs', type=int, default=1,
+                        help='Maximum number of reports to compile at '
+                             'the same time')
 
     return parser.parse_args()
 
 
 def summarize_functions(tsv, functions_df_template):
-    # load functions_df template
-    df = pd.read_csv(functions_df_template, sep='\t', header=0)
+    # functions_df_template is the template dataframe, read once for
+    # all reports
+    df = functions_df_template.copy()
+
+    # find mutation names in each Pokay category in one pass
+    category_mutations = tsv.groupby('function_category')['name'].agg(set)
+    category_mutations = category_mutations.to_dict()
 
     # populate the Mutations column row by row
+    mutations_col = []
     for row in df['Sub-categories from POKAY']:
         row_mutations_set = set()
-        # get list of Pokay categories
-        category_list = row.split(',')
-        for category in category_list:
-            # remove trailing spaces to enable matching
-            category = category.rstrip()
-            # find mutation names that match that category and add
-            # them to the set
-            cat_mutations = tsv[tsv['function_category'] == category][
-                'name']
-            cat_mutations_set = set(cat_mutations)
-            # add category mutations set to row mutations set
-            row_mutations_set.update(cat_mutations_set)
+        # get list of Pokay categories, removing trailing spaces to
+        # enable matching, and add their mutations to the set
+        for category in row.split(','):
+            row_mutations_set.update(
+                category_mutations.get(category.rstrip(), set()))
         # save row mutations set in the 'Mutations' column, sorted
         # alphabetically
         row_list = sorted(list(row_mutations_set))
-        row_str = ', '.join(str(e) for e in row_list)
-        mask = df['Sub-categories from POKAY'] == row
-        df.loc[mask, 'Mutations'] = row_str
+        mutations_col.append(', '.join(str(e) for e in row_list))
+    df['Mutations'] = mutations_col
 
     return df
 
@@ -120,11 +135,13 @@ def add_source_hyperref(dataframe):
     return dataframe
 
 
-def summarize_mutations(tsv, functions_dataframe):
+def summarize_mutations(tsv, functions_dataframe, metadata,
+                        frequency_threshold):
+    # named mutations, in the order of the functions table
     named_mutations = functions_dataframe['Mutations'].values.tolist()
     named_mutations = ', '.join(str(e) for e in named_mutations).split(
         ', ')
-    named_mutations = set(named_mutations)
+    named_mutations = list(dict.fromkeys(named_mutations))
     if metadata != 'n/a':
         tsv_df_cols = ['name', 'function_category',
                        'function_description', 'viral_lineages',
@@ -136,16 +153,14 @@ def summarize_mutations(tsv, functions_dataframe):
                        'citation', 'ao', 'dp', 'reference_seq',
                        'variant_seq', 'citation_url']
 
-    # create empty dataframe
-    df = pd.DataFrame(columns=tsv_df_cols)
-
-    for mutation in named_mutations:
-        # get rows of the tsv for that mutation
-        tsv_rows = tsv[tsv['name'] == mutation]
-        # keep certain columns of the tsv rows
-        tsv_rows = tsv_rows[tsv_df_cols]
-        # concatenate dfs
-        df = pd.concat((df, tsv_rows))
+    # get rows of the tsv for each mutation, grouping the tsv by name
+    # once
+    name_rows = tsv.groupby('name', sort=False).indices
+    rows = [name_rows[mutation] for mutation in named_mutations
+            if mutation in name_rows]
+    rows = np.concatenate(rows) if rows else []
+    # keep certain columns of the tsv rows
+    df = tsv.iloc[rows][tsv_df_cols].astype(object)
 
     # remove clade-defining values from strains column
     # renaming 'viral_clade_defining' to 'viral_lineages'
@@ -199,7 +214,7 @@ def summarize_mutations(tsv, functions_dataframe):
 
     df = add_source_hyperref(dataframe=df)
     if not df['Alternate Frequency'].isnull().values.any():
-        mask = df['Alternate Frequency'] >= args.frequency_threshold
+        mask = df['Alternate Frequency'] >= frequency_threshold
         df = df[mask]
     if metadata != 'n/a':
         mutations_df_cols = ['Mutations', 'Sub-category',
@@ -236,8 +251,7 @@ class TableFormatter:
 
 
 # latex starting boilerplate to set up the document class, packages, etc
-def write_preamble():
-    p = r'''
+PREAMBLE = r'''
 \documentclass{article}
 \usepackage[margin=0.5in, right=1.125in, footskip=35pt]{geometry}
 \usepackage{fancyheadings}
@@ -280,14 +294,18 @@ def write_preamble():
 
 
 '''
-    print(p)
-
 
 # latex ending boilerplate
-def write_postamble():
-    p = r'''
+POSTAMBLE = r'''
 \end{document}'''
-    print(p)
+
+
+def write_preamble(out=sys.stdout):
+    print(PREAMBLE, file=out)
+
+
+def write_postamble(out=sys.stdout):
+    print(POSTAMBLE, file=out)
 
 
 # count the number of rows in a tsv file
@@ -300,35 +318,41 @@ def count_tsv(filename):
     return c
 
 
+# characters latex doesn't like, and their escaped versions; braces
+# are kept in hyperlinks
+latex_escapes = {"_": "\_", "&": "\&", "%": "\%", "#": "\#", "$": "\$",
+                 "{": "\{", "}": "\}", "~": "\textasciitilde",
+                 "^": "\textasciicircum}"}
+latex_table = str.maketrans(latex_escapes)
+latex_href_table = str.maketrans(
+    dict((k, v) for k, v in latex_escapes.items() if k not in "{}"))
+
+
 def escape_latex(s):
-    s = s.replace("_", "\_")
-    s = s.replace("&", "\&")
-    s = s.replace("%", "\%")
-    s = s.replace("#", "\#")
-    s = s.replace("$", "\$")
     if not "href" in s:
-        s = s.replace("{", "\{")
-        s = s.replace("}", "\}")
-    s = s.replace("~", "\textasciitilde")
-    s = s.replace("^", "\textasciicircum}")
-    return s
+        return s.translate(latex_table)
+    return s.translate(latex_href_table)
 
 
 # high-level function to transform a tsv into a latex table
 # performing remapping of column names and arbitrary transformation
 # of values within each column (e.g. escaping characters latex
 # doesn't like) using table formatter
-def df_to_table(df, table_formatter):
-    reader = df.to_dict(into=OrderedDict, orient='records')
+def df_to_table(df, table_formatter, out=sys.stdout):
+    # remove columns
+    df = df.drop(columns=list(table_formatter.column_filter))
 
-    rows = list()
+    # remap column names
     header = list()
+    for k in df.columns:
+        if k in table_formatter.name_map:
+            header.append(table_formatter.name_map[k])
+        else:
+            header.append(escape_latex(k))
 
-    for row in reader:
-
-        # remove columns
-        for k in table_formatter.column_filter:
-            del row[k]
+    rows = list()
+    for values in zip(*[df[k].tolist() for k in df.columns]):
+        row = OrderedDict(zip(df.columns, values))
 
         # skip rows that fail the row filter, if any
         if table_formatter.row_accept is not None and not \
@@ -336,59 +360,54 @@ def df_to_table(df, table_formatter):
                     row):
             continue
 
-        if len(header) == 0:
-
-            # remap column names
-            for k in row.keys():
-                if k in table_formatter.name_map:
-                    header.append(table_formatter.name_map[k])
-                else:
-                    header.append(escape_latex(k))
-
         # transform with row func
         for k in row:
             if k in table_formatter.row_func:
                 row[k] = table_formatter.row_func[k](row[k])
         rows.append(row.values())
 
-    # write latex to stdout
-    write_table(table_formatter.table_spec, header, rows,
-                table_formatter.size)
+    # no header without rows
+    if len(rows) == 0:
+        header = list()
 
+    # write latex
+    write_table(table_formatter.table_spec, header, rows,
+                table_formatter.size, out)
 
-# latex for displaying a table
-def write_table(spec, header, rows, size):
-    # print(r"\begin{center}")
-    print(r"\%s" % size)
 
-    print(r"\begin{longtable}{%s}" % spec)
+# latex for displaying a table, rendered in one go
+table_template = Template(r"""\$size
+\begin{longtable}{$spec}
+\hline
+$header \\ \hline
+\endhead
+$rows\end{longtable}
+\normalsize
+""")
 
-    print(r"\hline")
-    print(" & ".join(header) + r" \\ \hline")
-    print(r"\endhead")
-    for r in rows:
-        print(" & ".join(
-            [escape_latex(str(v)) for v in r]) + r" \\ \hline")
 
-    print(r"\end{longtable}")
-    print(r"\normalsize")
-    # print(r"\end{center}")
+def write_table(spec, header, rows, size, out=sys.stdout):
+    rows = "".join(" & ".join([escape_latex(str(v)) for v in r]) +
+                   " \\\\ \\hline\n" for r in rows)
+    out.write(table_template.substitute(size=size, spec=spec,
+                                        header=" & ".join(header),
+                                        rows=rows))
 
 
 # write the large per-sample QC table
-def write_func_summary(df):
+def write_func_summary(df, out=sys.stdout):
     tf = TableFormatter()
     tf.size = "scriptsize"
     tf.table_spec = "{|p{4.0cm}|p{7.0cm}|p{5.0cm}|}"
 
-    print(r"\section*{Indicator}")
+    print(r"\section*{Indicator}", file=out)
     print(
         r"This table contains key indicators "
-        r"identified")
-    df_to_table(df, tf)
+        r"identified", file=out)
+    df_to_table(df, tf, out)
 
 
-def write_mutation_summary(df):
+def write_mutation_summary(df, metadata, out=sys.stdout):
     tf = TableFormatter()
     tf.size = "scriptsize"
     if metadata != 'n/a':
@@ -396,97 +415,190 @@ def write_mutation_summary(df):
     else:
         tf.table_spec = "{|p{1.2cm}|p{2.5cm}|p{3.3cm}|p{1.8cm}|p{1.0cm}|p{1.3cm}|p{1.3cm}|p{1.3cm}|}"
 
-    print(r"\section*{Mutation Significance}")
+    print(r"\section*{Mutation Significance}", file=out)
     print(
         r"This table contains key functional impacts of mutations "
-        r"identified")
-    df_to_table(df, tf)
-
-
-if __name__ == '__main__':
-
-    args = parse_args()
-    functions_template = args.functions_table
-    report_tsv = args.tsv
-    metadata = args.metadata
-    tsv_df = pd.read_csv(report_tsv, sep='\t', header=0)
+        r"identified", file=out)
+    df_to_table(df, tf, out)
+
+
+def read_metadata(metadata):
+    metadata_df = pd.read_csv(metadata, sep="\t", low_memory=False, compression='gzip',
+                              parse_dates=[
+                                  'sample_collection_date'])
+
+    metadata_df['sample_collection_date'] = pd.to_datetime(
+        metadata_df['sample_collection_date'], format='%Y-%m-%d',
+        errors='coerce')
+    return metadata_df
+
+
+def summarize_metadata(metadata_df):
+    # the metadata needed in reports: number of genomes and the range
+    # of collection dates
+    return (len(metadata_df.index),
+            pd.to_datetime(metadata_df['sample_collection_date'].min()).date(),
+            pd.to_datetime(metadata_df['sample_collection_date'].max()).date())
+
+
+def write_report(out, tsv_df, functions_template_df, metadata='n/a',
+                 metadata_summary=None, variant=None,
+                 frequency_threshold=0.25, virusseq=False):
+    # write the latex report of one surveillance TSV to out; the
+    # functions template and metadata_summary (from summarize_metadata)
+    # are made once by the caller and shared between reports
+    # make functions_df
+    functions_df = summarize_functions(tsv=tsv_df,
+                                       functions_df_template=
+                                       functions_template_df)
+
+    # make mutations_df
+    mutations_df = summarize_mutations(tsv=tsv_df,
+                                       functions_dataframe=functions_df,
+                                       metadata=metadata,
+                                       frequency_threshold=
+                                       frequency_threshold)
+    write_preamble(out)
+    print(r"\section*{Surveillance report}", file=out)
 
     if metadata != 'n/a':
-        metadata_df = pd.read_csv(metadata, sep="\t", low_memory=False, compression='gzip',
-                                  parse_dates=[
-                                      'sample_collection_date'])
-
-        metadata_df['sample_collection_date'] = pd.to_datetime(
-            metadata_df['sample_collection_date'], format='%Y-%m-%d',
-            errors='coerce')
         lineages = []
         for lineage in tsv_df['viral_lineages']:
             lineage = lineage.split(", ")
             lineages.extend(lineage)
 
-        base = os.path.basename(args.tsv)
-        variant = base.split('_')[0]
-        # make functions_df
-        functions_df = summarize_functions(tsv=tsv_df,
-                                           functions_df_template=
-                                           functions_template)
-
-        # make mutations_df
-        mutations_df = summarize_mutations(tsv=tsv_df,
-                                           functions_dataframe=functions_df)
-        write_preamble()
-
-        print(r"\section*{Surveillance report}")
         print(
             r"Surveillance generated by nf-ncov-voc for %s variant" % (
-                variant))
+                variant), file=out)
 
-        print(r"\subsection*{Date }")
+        print(r"\subsection*{Date }", file=out)
         print(
             r"This report is generated on %s using %s number of genomes collected between %s and %s "
-            % (
-                datetime.today().strftime('%Y-%m-%d'),
-                len(metadata_df.index),
-                pd.to_datetime(metadata_df['sample_collection_date'].min()).date(),
-                pd.to_datetime(metadata_df['sample_collection_date'].max()).date()))
+            % ((datetime.today().strftime('%Y-%m-%d'),) +
+               tuple(metadata_summary)),
+            file=out)
 
-        print(r"\section*{Pango Lineages}")
+        print(r"\section*{Pango Lineages}", file=out)
         print(r"{Pango Lineages in this report }%s "
-              % sorted(set(lineages)))
-        write_func_summary(df=functions_df)
-        write_mutation_summary(df=mutations_df)
-
-        if args.virusseq is True:
-            print(r"\newpage")
-            print("The results here are in whole or "
-                  "part based upon data hosted at the "
-                  "Canadian VirusSeq Data Portal: "
-                  " \href{https://virusseq-dataportal.ca/}{"
-                  "https://virusseq-dataportal.ca/}."
-                  "We wish to acknowledge the following "
-                  "organisations/laboratories for "
-                  "contributing data to the Portal: "
-                  "Canadian Public Health Laboratory "
-                  "Network (CPHLN), CanCOGGeN VirusSeq "
-                  "and the list of labs available at "
-                  "\href{https://virusseq-dataportal.ca/acknowledgements"
-                  "}{https://virusseq-dataportal.ca/acknowledgements})")
-
-        write_postamble()
-
-        # mutations_df.to_csv('mutations.tsv', sep='\t', index=False)
+              % sorted(set(lineages)), file=out)
+
+    write_func_summary(df=functions_df, out=out)
+    write_mutation_summary(df=mutations_df, metadata=metadata, out=out)
+
+    if metadata != 'n/a' and virusseq is True:
+        print(r"\newpage", file=out)
+        print("The results here are in whole or "
+              "part based upon data hosted at the "
+              "Canadian VirusSeq Data Portal: "
+              " \href{https://virusseq-dataportal.ca/}{"
+              "https://virusseq-dataportal.ca/}."
+              "We wish to acknowledge the following "
+              "organisations/laboratories for "
+              "contributing data to the Portal: "
+              "Canadian Public Health Laboratory "
+              "Network (CPHLN), CanCOGGeN VirusSeq "
+              "and the list of labs available at "
+              "\href{https://virusseq-dataportal.ca/acknowledgements"
+              "}{https://virusseq-dataportal.ca/acknowledgements})",
+              file=out)
+
+    write_postamble(out)
+
+
+def render_report(report_tsv, outdir, functions_template_df,
+                  metadata='n/a', metadata_summary=None,
+                  frequency_threshold=0.25, virusseq=False):
+    # write the .tex report of one surveillance TSV to outdir, and
+    # return its path and the time it took
+    start = time.perf_counter()
+    tsv_df = pd.read_csv(report_tsv, sep='\t', header=0)
+    base = os.path.basename(report_tsv)
+    variant = base.split('_')[0]
+    filepath = os.path.join(outdir, os.path.splitext(base)[0] + '.tex')
+    with open(filepath, 'w') as out:
+        write_report(out, tsv_df, functions_template_df, metadata,
+                     metadata_summary, variant, frequency_threshold,
+                     virusseq)
+    return filepath, time.perf_counter() - start
+
+
+def compile_report(filepath):
+    # compile a .tex report to PDF next to it, and return the time it
+    # took
+    start = time.perf_counter()
+    subprocess.run(['tectonic', '-X', 'compile',
+                    os.path.basename(filepath), '--reruns', '3',
+                    '--keep-intermediates', '--keep-logs'],
+                   cwd=os.path.dirname(filepath) or '.', check=True)
+    return time.perf_counter() - start
+
+
+def log_timing(stage, name, seconds):
+    # per-stage timings go to stderr, so that they don't end up in a
+    # report written to stdout
+    print("timing\t%s\t%s\t%.2f" % (stage, name, seconds),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    metadata = args.metadata
+    start = time.perf_counter()
+
+    # read the functions template and metadata once for all reports
+    functions_template_df = pd.read_csv(args.functions_table, sep='\t',
+                                        header=0)
+    metadata_summary = None
+    if metadata != 'n/a':
+        metadata_summary = summarize_metadata(read_metadata(metadata))
+    log_timing('read_inputs', 'all', time.perf_counter() - start)
+
+    if args.outdir is None and len(args.tsv) == 1 and not args.compile:
+        report_tsv = args.tsv[0]
+        tsv_df = pd.read_csv(report_tsv, sep='\t', header=0)
+        variant = os.path.basename(report_tsv).split('_')[0]
+        write_report(sys.stdout, tsv_df, functions_template_df, metadata,
+                     metadata_summary, variant, args.frequency_threshold,
+                     args.virusseq)
     else:
-        # base = os.path.basename(args.tsv)
-        # variant = base.split('_')[0]
-        # make functions_df
-        functions_df = summarize_functions(tsv=tsv_df,
-                                           functions_df_template=
-                                           functions_template)
-        # make mutations_df
-        mutations_df = summarize_mutations(tsv=tsv_df,
-                                           functions_dataframe=functions_df)
-        write_preamble()
-        print(r"\section*{Surveillance report}")
-        write_func_summary(df=functions_df)
-        write_mutation_summary(df=mutations_df)
-        write_postamble()
+        # render reports, in a process pool with --workers > 1,
+        # compiling each one to PDF as soon as it is rendered, with at
+        # most --compile_jobs compilations at a time
+        outdir = args.outdir if args.outdir is not None else '.'
+        render_args = (outdir, functions_template_df, metadata,
+                       metadata_summary, args.frequency_threshold,
+                       args.virusseq)
+        render_start = time.perf_counter()
+        render_pool = None
+        if args.workers > 1 and len(args.tsv) > 1:
+            render_pool = ProcessPoolExecutor(max_workers=args.workers)
+            rendered = (future.result() for future in as_completed(
+                [render_pool.submit(render_report, report_tsv,
+                                    *render_args)
+                 for report_tsv in args.tsv]))
+        else:
+            rendered = (render_report(report_tsv, *render_args)
+                        for report_tsv in args.tsv)
+
+        compile_pool = ThreadPoolExecutor(max_workers=args.compile_jobs)
+        compiled = []
+        compile_start = None
+        for filepath, seconds in rendered:
+            log_timing('render', filepath, seconds)
+            if args.compile:
+                if compile_start is None:
+                    compile_start = time.perf_counter()
+                compiled.append((filepath, compile_pool.submit(
+                    compile_report, filepath)))
+        log_timing('render', 'all', time.perf_counter() - render_start)
+        if render_pool is not None:
+            render_pool.shutdown()
+
+        for filepath, future in compiled:
+            log_timing('compile', filepath, future.result())
+        compile_pool.shutdown()
+        if compile_start is not None:
+            log_timing('compile', 'all', time.perf_counter() - compile_start)
+
+    log_timing('total', 'all', time.perf_counter() - start)
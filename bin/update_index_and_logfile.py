@@ -4,6 +4,9 @@ import argparse
 import glob
 import os
 import csv
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functions import read_gvf, rejoin_attributes, empty_attributes
 
 
 def parse_args():
@@ -19,37 +22,147 @@ def parse_args():
                         default=None, help='Path to partial log file, to append new mutations to')
     parser.add_argument('--log_savefile', type=str,
                         default=None, help='Filename to save log to')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to read the GVFs with; '
+                             'they are merged into the index in the order '
+                             'given')
 
     return parser.parse_args()
 
 
-def gvf2df(gvf):
+def parse_attributes(attributes):
+    # pull the index columns out of one GVF #attributes string in a
+    # single pass; each key takes the first value ending in ';' whose
+    # key ends with it (eg. "lineage" matches "viral_lineage"), and
+    # is "nan" if there is none
+    fields = attributes.split(";")[:-1]
+    values = {}
+    for field in fields:
+        key, sep, value = field.partition("=")
+        if not sep:
+            continue
+        for name in attribute_names:
+            if name not in values and key.endswith(name):
+                values[name] = value
+    mutation = values.get("Name", "nan")
+    if mutation != "nan":
+        mutation = re.sub("p.", "", mutation)
+    return (mutation,
+            values.get("alias", "nan"),
+            values.get("chrom_region", "nan"),
+            values.get("protein", "nan"),
+            str("function_description=" not in fields),
+            "nan",
+            values.get("lineage", "nan"))
+
 
+def gvf2df(gvf):
+    """
+    Reads one GVF into the rows of the mutation index it adds to:
+    (pos, mutation, alias, chrom_region, protein, Pokay_annotation,
+    alias_Pokay_annotation, lineage), without duplicates, and returns
+    them with the GVF lineage.
+    """
     # read in gvf
     gvf_columns = ['#seqid', '#source', '#type', '#start', '#end',
                    '#score', '#strand', '#phase', '#attributes']
-    gvf = pd.read_csv(gvf, sep='\t', names=gvf_columns, usecols=['#start', '#seqid', '#attributes'])
-    # remove pragmas and original header
-    gvf = gvf[~gvf['#seqid'].str.contains("#")]
-
-    # create new dataframe in the format of the index, but just for this one gvf
-    index_cols=['pos', 'mutation', 'alias', 'chrom_region', 'protein',
-       'Pokay_annotation', 'alias_Pokay_annotation', 'lineage']
-    df = pd.DataFrame(np.empty((gvf.shape[0], 8)), columns=index_cols)
-    df['pos'] = gvf['#start'].tolist()
-    df['mutation'] = gvf["#attributes"].str.findall('(?<=Name=)(.*?)(?=;)').str[0].tolist()
-    df['mutation'] = df['mutation'].str.replace("p.", "")
-    df['alias'] = gvf["#attributes"].str.findall('(?<=alias=)(.*?)(?=;)').str[0].tolist()
-    df['chrom_region'] = gvf["#attributes"].str.findall('(?<=chrom_region=)(.*?)(?=;)').str[0].tolist()
-    df['protein'] = gvf["#attributes"].str.findall('(?<=protein=)(.*?)(?=;)').str[0].tolist()
-    df['Pokay_annotation'] = (~gvf["#attributes"].str.contains("function_description=;")).tolist()
-    df['alias_Pokay_annotation'] = np.nan
-    df['lineage'] = gvf["#attributes"].str.findall('(?<=lineage=)(.*?)(?=;)').str[0].tolist()
-    lineage = df['lineage'][0]
-    df = df.astype(str)
-    df = df.drop_duplicates()
-
-    return df, lineage
+    if gvf.endswith('.parquet'):
+        # merge the attribute columns back to match the text GVF
+        gvf = rejoin_attributes(read_gvf(gvf)[0], empty_attributes)
+        gvf = gvf[['#seqid', '#start', '#attributes']].reset_index(drop=True)
+    else:
+        gvf = pd.read_csv(gvf, sep='\t', names=gvf_columns, usecols=['#start', '#seqid', '#attributes'])
+        # remove pragmas and original header
+        gvf = gvf[~gvf['#seqid'].str.contains("#")]
+
+    rows = [(int(pos),) + parse_attributes(attributes)
+            for pos, attributes in zip(gvf['#start'].tolist(),
+                                       gvf['#attributes'].tolist())]
+    lineage = rows[0][-1]
+    rows = list(dict.fromkeys(rows))
+
+    return rows, lineage
+
+# the index is keyed on these columns; the other columns hold
+# comma-separated values, one per GVF the mutation was found in
+index_keys = ["pos", "mutation", "alias", "chrom_region", "protein"]
+index_values = ["Pokay_annotation", "alias_Pokay_annotation", "lineage"]
+# GVF attributes holding the index columns
+attribute_names = ["Name", "alias", "chrom_region", "protein", "lineage"]
+
+
+def merge_values(values):
+    # where a column contains "True", make it "True": this will be unneeded once all GVFs have aliases added and are reannotated with Pokay
+    merged = ','.join(values)
+    if "True" in merged:
+        return "True"
+    return merged
+
+
+def read_mutation_index(mutation_index_path):
+    """
+    Reads the mutation index TSV into a dict of
+    (pos, mutation, alias, chrom_region, protein) -> (Pokay_annotation,
+    alias_Pokay_annotation, lineage), plus a dict of lineage -> index
+    keys with that lineage, so that GVFs can be merged into the index
+    one key at a time.
+    """
+    # keep "n/a" and "nan" as written, so that rows missing a
+    # chrom_region or protein are kept and match the GVF rows; empty
+    # cells become "nan", as in gvf2df
+    mutation_index = pd.read_csv(mutation_index_path, sep='\t',
+                                 keep_default_na=False, na_values=[''])
+    mutation_index = mutation_index.astype(str)
+    mutation_index['pos'] = mutation_index['pos'].astype(int)
+
+    keys = zip(*[mutation_index[col].tolist() for col in index_keys])
+    values = zip(*[mutation_index[col].tolist() for col in index_values])
+    index = dict((key, tuple(merge_values([value]) for value in row))
+                 for key, row in zip(keys, values))
+
+    lineage_keys = {}
+    for key, row in index.items():
+        for lineage in row[2].split(","):
+            lineage_keys.setdefault(lineage, set()).add(key)
+
+    return index, lineage_keys
+
+
+def update_mutation_index(index, lineage_keys, rows, lineage):
+    # merge the rows of one GVF into the index; only the keys found in
+    # the GVF are updated, with the GVF values appended to the existing
+    # ones
+    gvf_rows = {}
+    for row in rows:
+        gvf_rows.setdefault(row[:5], []).append(row[5:])
+
+    for key, rows in gvf_rows.items():
+        columns = list(zip(*rows))
+        if key in index:
+            columns = [(old,) + new for old, new in zip(index[key], columns)]
+        index[key] = tuple(merge_values(column) for column in columns)
+        lineage_keys.setdefault(lineage, set()).add(key)
+
+
+def lineage_mutations(index, lineage_keys, lineage):
+    # mutations in the index found in the lineage, for the logfile
+    rows = []
+    for key in sorted(lineage_keys.get(lineage, ())):
+        pos, mutation, alias, chrom_region, protein = key
+        new_mutation = chrom_region + ":" + mutation
+        # for ORF1ab mutations, add the alias
+        if "NSP" in protein:
+            new_mutation = new_mutation + " / " + protein + ":" + alias
+        rows.append((pos, alias, new_mutation, index[key][2]))
+    # drop duplicates (there shouldn't be any)
+    return list(dict.fromkeys(rows))
+
+
+def save_mutation_index(index, index_savefile):
+    rows = [key + value for key, value in sorted(index.items())]
+    mutation_index = pd.DataFrame(rows, columns=index_keys + index_values)
+    mutation_index.to_csv(index_savefile, sep='\t', header=True, index=False)
+
 
 if __name__ == '__main__':
 
@@ -62,73 +175,53 @@ if __name__ == '__main__':
     
     # set empty structures for creating the logfile at the end
     lineages = []
-    logfile_df = pd.DataFrame(np.empty((0, 4)), columns=['pos', 'alias', 'new_mutations', 'lineage'])
+    logfile_rows = []
 
     # open the mutation index
-    mutation_index = pd.read_csv(mutation_index_path, sep='\t', dtype='str')
-    mutation_index['pos'] = mutation_index['pos'].astype(int)
-
-    '''
-    # for troubleshooting: make practice mutation_index with all mentions of ['HH.1.1', 'FT.3.1.1'] removed
-    for lineage in ['HH.1.1', 'FT.3.1.1']:
-        mutation_index = mutation_index[mutation_index['lineage']!=lineage]
-        mutation_index['lineage'] = mutation_index['lineage'].str.replace(lineage, "")
-    '''
-
-    # iterate through gvfs in the list argument and get set from each
-    for file in gvf_list:
+    mutation_index, lineage_keys = read_mutation_index(mutation_index_path)
+
+    # read the GVFs into index rows, in parallel if asked to; the rows
+    # are merged into the index in the order the GVFs were given, so
+    # the output is the same either way
+    if args.workers > 1 and len(gvf_list) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers)
+        gvf_rows = executor.map(gvf2df, gvf_list)
+    else:
+        executor = None
+        gvf_rows = map(gvf2df, gvf_list)
+
+    for file, (rows, lineage) in zip(gvf_list, gvf_rows):
         print("Processing: " + file)
-
-        # open gvf and reformat to match the mutation index
-        df, lineage = gvf2df(file)
-        df['pos'] = df['pos'].astype(int)
         lineages.append(lineage)
-        # append the new gvf df to the index and use groupby() to add the lineage where 
-        mutation_index = pd.concat([mutation_index, df])
-        mutation_index['alias'] = mutation_index['alias'].astype(str)
-        # groupby group_cols, adding new lineages to "lineage" in a list, and the same with the Pokay annotation columns
-        group_cols = ["pos", "mutation", "alias", "chrom_region", "protein"]
-        mutation_index = mutation_index.groupby(group_cols, as_index=False).agg(list)
-        # convert columns from lists back to strings
-        for colname in ["Pokay_annotation", "alias_Pokay_annotation", "lineage"]:
-            mutation_index[colname] = [','.join(map(str, l)) for l in mutation_index[colname]]
-            # where a column contains "True", make it "True": this will be unneeded once all GVFs have aliases added and are reannotated with Pokay
-            mutation_index.loc[mutation_index[colname].str.contains("True"), colname] = True
-
-        # extract novel mutations to a new dataframe to save to the logfile
-        # novel mutations are found in the rows where "lineage"==gvf_lineage 
-        lineage_mask = ((mutation_index['lineage']==lineage) | mutation_index['lineage'].str.contains("," + lineage))
-        lineage_chunk = mutation_index.loc[lineage_mask,:].copy()
-        lineage_chunk['new_mutations'] = lineage_chunk["chrom_region"] + ":" + lineage_chunk["mutation"]
-        # for ORF1ab mutations, add the alias
-        orf1ab_mask = lineage_chunk['protein'].astype(str).str.contains("NSP")
-        lineage_chunk.loc[orf1ab_mask, 'new_mutations'] = lineage_chunk['new_mutations'] + " / " + lineage_chunk["protein"] + ":" + lineage_chunk["alias"]
-        # drop duplicates (there shouldn't be any)
-        lineage_chunk = lineage_chunk[['pos', 'alias', 'new_mutations', 'lineage']].drop_duplicates()
-        # drop NaN rows
-        lineage_chunk = lineage_chunk[lineage_chunk['pos'].notna()]
-        # append to logfile_df
-        logfile_df = pd.concat([logfile_df, lineage_chunk])
-        logfile_df['pos'] = logfile_df['pos'].astype(int)
-            
-
-# save updated mutation index
-mutation_index.to_csv(index_savefile, sep='\t', header=True, index=False)
-
-# clean up logfile_df: restrict df to rows with new mutations, added to the index from the GVFs added above
-gvf_lineage_set = lineages
-# get list of lists for "lineages" column
-lineages_col = logfile_df["lineage"].str.split(",").tolist()
-# keep only rows that have only lineages from the new GVFs
-new_mutation_check = [set(subl).issubset(gvf_lineage_set) for subl in lineages_col]
-logfile_df["new_mutation_check"] = new_mutation_check
-logfile_df = logfile_df[logfile_df['new_mutation_check']==True]
-logfile_df = logfile_df[['new_mutations', 'lineage']]
-
-# read in partial logfile, append the mutations list, and save to the new name
-partial_logfile_df = pd.read_csv(partial_logfile, sep='\t', names=["new_mutations","lineage"])
-partial_logfile_df.loc[len(partial_logfile_df)] = ["New mutations:", ""]
-logfile_df = pd.concat([partial_logfile_df, logfile_df])
-
-# save logfile
-logfile_df.to_csv(log_savefile, sep='\t', header=False, index=False)
\ No newline at end of file
+        # add the new gvf to the index, adding the lineage and Pokay
+        # annotations of mutations already in the index
+        update_mutation_index(mutation_index, lineage_keys, rows, lineage)
+
+        # extract mutations found in this lineage to save to the logfile
+        logfile_rows.extend(lineage_mutations(mutation_index, lineage_keys,
+                                              lineage))
+
+    if executor is not None:
+        executor.shutdown()
+
+    # save updated mutation index
+    save_mutation_index(mutation_index, index_savefile)
+
+    # clean up logfile_df: restrict df to rows with new mutations, added to the index from the GVFs added above
+    logfile_df = pd.DataFrame(logfile_rows, columns=['pos', 'alias', 'new_mutations', 'lineage'])
+    gvf_lineage_set = lineages
+    # get list of lists for "lineages" column
+    lineages_col = logfile_df["lineage"].str.split(",").tolist()
+    # keep only rows that have only lineages from the new GVFs
+    new_mutation_check = [set(subl).issubset(gvf_lineage_set) for subl in lineages_col]
+    logfile_df["new_mutation_check"] = new_mutation_check
+    logfile_df = logfile_df[logfile_df['new_mutation_check']==True]
+    logfile_df = logfile_df[['new_mutations', 'lineage']]
+
+    # read in partial logfile, append the mutations list, and save to the new name
+    partial_logfile_df = pd.read_csv(partial_logfile, sep='\t', names=["new_mutations","lineage"])
+    partial_logfile_df.loc[len(partial_logfile_df)] = ["New mutations:", ""]
+    logfile_df = pd.concat([partial_logfile_df, logfile_df])
+
+    # save logfile
+    logfile_df.to_csv(log_savefile, sep='\t', header=False, index=False)
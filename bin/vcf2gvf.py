@@ -5,7 +5,8 @@
 @author: madeline
 
 This script converts VCF files that have been annotated into GVF
-files. Required user input is a VCF file.
+files. Required user input is a VCF file, or a manifest of VCF
+files (--vcf_list) to convert in one run, optionally in parallel.
     
 The attributes completed by this script are: 
 ['ID', 'Name', 'gene', 'protein_name', 'protein_symbol', 'protein_id', 'ps_filter', 'ps_exc', 'mat_pep',
@@ -15,26 +16,33 @@ The attributes completed by this script are:
 """
 
 import argparse
+import os
 import pandas as pd
 import numpy as np
 import json
-from functions import parse_INFO, find_sample_size, \
-    unnest_multi, get_unknown_labels, separate_attributes, rejoin_attributes, \
-        clade_defining_threshold, map_pos_to_gene_protein, add_alias_names
+from concurrent.futures import ProcessPoolExecutor
+from functions import parse_vcf, find_sample_size, read_size_stats, \
+    separate_attributes, rejoin_attributes, \
+        clade_defining_threshold, map_pos_to_gene_protein, add_alias_names, \
+        build_gene_position_index, load_gene_position_index, write_gvf
 from functions import empty_attributes, gvf_columns, vcf_columns, pragmas
 
 
-def vcftogvf(vcf, strain, GENE_PROTEIN_POSITIONS_DICT, sample_size):
-    vcf_df = pd.read_csv(vcf, sep='\t', names=vcf_columns)
-    # get variant-calling source
-    var_cols = get_unknown_labels(vcf_df)
-    # remove pragmas
-    vcf_df = vcf_df[~vcf_df['#CHROM'].str.contains("#")]
-    # restart index from 0
-    vcf_df = vcf_df.reset_index(drop=True)
-    
-    # expand INFO column into multiple columns
-    vcf_df = parse_INFO(vcf_df, var_cols)
+def vcftogvf(vcf, strain, GENE_PROTEIN_POSITIONS_DICT, sample_size,
+             threshold, gene_index=None):
+    # returns the GVF with #attributes expanded into separate columns;
+    # use rejoin_attributes to merge them back into a single column
+    # read VCF records into named columns, one row per alternate allele
+    vcf_df = parse_vcf(vcf)
+
+    return variants_to_gvf(vcf_df, strain, GENE_PROTEIN_POSITIONS_DICT,
+                           sample_size, threshold, gene_index)
+
+
+def variants_to_gvf(vcf_df, strain, GENE_PROTEIN_POSITIONS_DICT,
+                    sample_size, threshold, gene_index=None):
+    # makes the GVF from variants with the columns given by parse_vcf
+    # (one row per alternate allele)
 
     # create an empty df to make the new GVF in
     new_gvf = pd.DataFrame(index=range(0, len(vcf_df)), columns=gvf_columns)
@@ -77,7 +85,7 @@ def vcftogvf(vcf, strain, GENE_PROTEIN_POSITIONS_DICT, sample_size):
     
     # add gene and protein attributes from JSON
     json_df = map_pos_to_gene_protein(
-        vcf_df['POS'].astype(int), GENE_PROTEIN_POSITIONS_DICT)
+        vcf_df['POS'].astype(int), GENE_PROTEIN_POSITIONS_DICT, gene_index)
     new_gvf["gene"] = json_df["gene"]
     new_gvf["protein_name"] = json_df["protein_name"]
     new_gvf["protein_symbol"] = json_df["protein_symbol"]
@@ -86,26 +94,81 @@ def vcftogvf(vcf, strain, GENE_PROTEIN_POSITIONS_DICT, sample_size):
     # add 'alias' column for ORF1a/b mutations
     new_gvf = add_alias_names(new_gvf, GENE_PROTEIN_POSITIONS_DICT)
     # add clade_defining attribute
-    new_gvf = clade_defining_threshold(args.clades_threshold,
-                                             new_gvf, sample_size)
+    new_gvf = clade_defining_threshold(threshold, new_gvf, sample_size)
         
     # add 'ID' attribute: here, rows with the same entry in 'Name'
     # get the same ID (should all be different)
     new_gvf['ID'] = 'ID_' + new_gvf.groupby('Name', sort=False).ngroup().astype(str)
     
-    # merge attributes back into a single column
-    new_gvf = rejoin_attributes(new_gvf, empty_attributes)
-    
     return new_gvf
 
 
 
+def convert_vcf(vcf_file, strain, outgvf, GENE_PROTEIN_POSITIONS_DICT,
+                gene_index, size_stats, strain_tsv_df, threshold,
+                wastewater, file_format='gvf'):
+    # convert one VCF and save it as a GVF; the gene positions, their
+    # index and the stats table are loaded once by the caller and shared
+    # between VCFs
+    sample_size = find_sample_size(size_stats, strain,
+                                   os.path.basename(vcf_file), wastewater,
+                                   strain_tsv_df)
+    
+    # create gvf from annotated vcf (ignoring pragmas for now)
+    gvf = vcftogvf(vcf_file, strain, GENE_PROTEIN_POSITIONS_DICT,
+                   sample_size, threshold, gene_index)
+
+    # add species to pragmas
+    species = GENE_PROTEIN_POSITIONS_DICT['Src']['species']
+    gvf_pragmas = pragmas.copy()
+    gvf_pragmas[0] = gvf_pragmas[0].str.replace("##species",
+                                                "##species " + str(species))
+
+    # save GVF (or parquet, with the attributes kept in separate columns)
+    write_gvf(gvf, gvf_pragmas, outgvf, file_format)
+
+    return outgvf
+
+
+def read_vcf_list(vcf_list, strain, extension='.gvf'):
+    # manifest of VCFs to convert, one per line:
+    # vcf_path [<tab> strain [<tab> output_gvf]]
+    # strain defaults to --strain, output_gvf to <strain>.gvf (or the VCF
+    # name with a .gvf extension if strain is n/a); the extension is
+    # .parquet with --format parquet
+    conversions = []
+    with open(vcf_list) as fp:
+        for line in fp:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == '':
+                continue
+            vcf_file = fields[0]
+            vcf_strain = fields[1] if len(fields) > 1 and fields[1] \
+                else strain
+            if len(fields) > 2 and fields[2]:
+                outgvf = fields[2]
+            elif vcf_strain != 'n/a':
+                outgvf = vcf_strain + extension
+            else:
+                outgvf = os.path.basename(vcf_file).replace('.vcf', '') \
+                    + extension
+            conversions.append((vcf_file, vcf_strain, outgvf))
+    return conversions
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description='Converts a annotated VCF file to a GVF '
                     'file with functional annotation')
     parser.add_argument('--vcffile', type=str, default=None,
                         help='Path to a snpEFF-annotated VCF file')
+    parser.add_argument('--vcf_list', type=str, default=None,
+                        help='Manifest of snpEFF-annotated VCF files to '
+                             'convert in one run, one per line: '
+                             'vcf<tab>strain<tab>outgvf (strain and '
+                             'outgvf are optional)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to use with --vcf_list')
     parser.add_argument('--size_stats', type=str, default=None,
                         help='Statistics file for for size extraction')
     parser.add_argument('--clades_threshold', type=float,
@@ -115,6 +178,11 @@ def parse_args():
     parser.add_argument('--gene_positions', type=str,
                         default=None,
                         help='gene positions in JSON format')
+    parser.add_argument('--gene_positions_index', type=str,
+                        default=None,
+                        help='Prebuilt .npz index of the gene positions '
+                             'JSON; it is (re)built and saved here if '
+                             'missing or out of date')
     parser.add_argument('--strain', type=str,
                         default=None,
                         help='Lineage; user mode is if strain="n/a"')
@@ -122,6 +190,10 @@ def parse_args():
                         action="store_true")
     parser.add_argument('--outgvf', type=str,
                         help='Filename for the output GVF file')
+    parser.add_argument('--format', type=str, default='gvf',
+                        choices=['gvf', 'parquet'],
+                        help='Output format; parquet keeps the attributes '
+                             'in separate columns for the next stage')
 
     return parser.parse_args()
 
@@ -133,9 +205,6 @@ if __name__ == '__main__':
     # Reading the gene & proetin coordinates of SARS-CoV-2 genome
     with open(args.gene_positions) as fp:
         GENE_PROTEIN_POSITIONS_DICT = json.load(fp)
-    
-    # Assigning the vcf file to a variable
-    vcf_file = args.vcffile
 
     # If the strain and/or stats file are None, set them as 'n/a'
     size_stats = args.size_stats
@@ -145,29 +214,40 @@ if __name__ == '__main__':
             size_stats='n/a'
     if strain == None:
             strain='n/a'
-    
 
-    # print("Processing: " + vcf_file)
+    # index CDS regions once for all VCFs
+    if args.gene_positions_index:
+        gene_index = load_gene_position_index(args.gene_positions_index,
+                                              GENE_PROTEIN_POSITIONS_DICT)
+    else:
+        gene_index = build_gene_position_index(GENE_PROTEIN_POSITIONS_DICT)
 
-    sample_size = find_sample_size(size_stats, strain, vcf_file, args.wastewater)
-    
-    # create gvf from annotated vcf (ignoring pragmas for now)
-    gvf = vcftogvf(vcf_file, strain, GENE_PROTEIN_POSITIONS_DICT,
-                   sample_size)
-    
-    # add species to pragmas
-    species = GENE_PROTEIN_POSITIONS_DICT['Src']['species']
-    pragmas[0] = pragmas[0].str.replace("##species", "##species " + str(species))
+    # read the stats table once for all VCFs
+    strain_tsv_df = None
+    if size_stats != 'n/a':
+        strain_tsv_df = read_size_stats(size_stats)
 
-    # combine pragmas, header, GVF contents
-    final_gvf = pd.DataFrame(np.vstack([gvf.columns, gvf]))
-    final_gvf = pragmas.append(final_gvf)
-    
-    # save GVF
-    filepath = args.outgvf  # outdir + strain + ".annotated.gvf"
-    print("Saved as: ", filepath)
-    print("")
-    final_gvf.to_csv(filepath, sep='\t', index=False, header=False)
+    if args.vcf_list:
+        conversions = read_vcf_list(args.vcf_list, strain,
+                                    '.' + args.format)
+    else:
+        conversions = [(args.vcffile, strain, args.outgvf)]
+
+    shared_args = (GENE_PROTEIN_POSITIONS_DICT, gene_index, size_stats,
+                   strain_tsv_df, args.clades_threshold, args.wastewater,
+                   args.format)
+
+    if args.workers > 1 and len(conversions) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(convert_vcf, vcf_file, vcf_strain,
+                                       outgvf, *shared_args)
+                       for vcf_file, vcf_strain, outgvf in conversions]
+            for future in futures:
+                print("Saved as: ", future.result())
+    else:
+        for vcf_file, vcf_strain, outgvf in conversions:
+            print("Saved as: ", convert_vcf(vcf_file, vcf_strain, outgvf,
+                                            *shared_args))
 
     print("")
     print("Processing complete.")
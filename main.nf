@@ -40,6 +40,17 @@ if ( ! params.prefix ) {
      }
 }
 
+if ( ! (params.gvf_format in ['gvf', 'parquet']) ) {
+     println("--gvf_format should be 'gvf' or 'parquet'")
+     System.exit(1)
+}
+
+if ( params.gvf_format == 'parquet' && workflow.containerEngine ) {
+     // the pandas containers of the GVF modules do not include pyarrow
+     println("--gvf_format parquet needs pyarrow, which is not in the containers; run with -profile conda or --gvf_format gvf")
+     System.exit(1)
+}
+
 //if ( params.mode == 'user' && ! params.userfile ) {
 //    println("When --mode user, userfile (.vcf or .fasta or .tsv) should e provided with --userfile")
 //    System.exit(1)
@@ -2,27 +2,32 @@ process FUNCTIONALANNOTATION {
 
   tag "$meta.id"
 
-  conda "bioconda::pandas=1.4.3"
+  conda "bioconda::pandas=1.4.3 conda-forge::pyarrow=8.0.0"
   container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'https://depot.galaxyproject.org/singularity/pandas:1.4.3' : '' }"
   
   input:
       tuple val(meta), path(gvf)
       tuple val(meta2), path(tsv)
+      path annotation_index
       
   output:
-      tuple val(meta), path("*.gvf"), emit: gvf
+      tuple val(meta), path("*.{gvf,parquet}"), emit: gvf
 
   script:
 
   def args = task.ext.args ?: ''
   def prefix = task.ext.prefix ?: "${meta.id}"
+  def format = params.gvf_format == 'parquet' ? 'parquet' : 'gvf'
+  def index = annotation_index ? "--annotation_index ${annotation_index}" : ''
 
   """
     addfunctions2gvf.py \\
       --ingvf $gvf \\
-      --outgvf ${prefix}.annotated.gvf \\
-      --functional_annotations $tsv
+      --format $format \\
+      --outgvf ${prefix}.annotated.${format} \\
+      --functional_annotations $tsv \\
+      $index
 
   """
 
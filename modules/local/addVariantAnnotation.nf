@@ -2,7 +2,7 @@ process VARIANTANNOTATION {
 
   tag "$meta.id"
 
-  conda "bioconda::pandas=1.4.3"
+  conda "bioconda::pandas=1.4.3 conda-forge::pyarrow=8.0.0"
   container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'https://depot.galaxyproject.org/singularity/pandas:1.4.3' : '' }"
   
@@ -2,13 +2,14 @@ process ANNOTATEMATPEPTIDES_NCOV {
 
   tag "$meta.id"
 
-  conda "bioconda::cyvcf=0.8.0 bioconda::gffutils=0.10.1"
+  conda "bioconda::cyvcf=0.8.0"
   container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
       'docker://cidgoh/nf-ncov-voc-extra:0.2' : ''}"
 
   input:
       tuple val(meta), path(vcf)
       path  gff
+      path  peptide_index
 
   output:
       tuple val(meta), path("*annotated.vcf"), emit: vcf
@@ -20,12 +21,14 @@ process ANNOTATEMATPEPTIDES_NCOV {
 
   def args = task.ext.args ?: ''
   def prefix = task.ext.prefix ?: "${meta.id}"
+  def index = peptide_index ? "--peptide_index ${peptide_index}" : ''
 
     """
     mature_peptide_annotation.py \\
     --vcf_file $vcf \\
     --annotation_file $gff \\
     --output_vcf ${prefix}.annotated.vcf \\
+    $index \\
     $args
     """
 }
\ No newline at end of file
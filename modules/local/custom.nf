@@ -82,9 +82,11 @@ process processGVCF {
   tag {"${gvcf.baseName}"}
 
   publishDir "${params.outdir}/${params.prefix}/${task.process.replaceAll(":","_")}", pattern: "*variants.vcf", mode: 'copy'
+  publishDir "${params.outdir}/${params.prefix}/${task.process.replaceAll(":","_")}", pattern: "*.{coverage.tsv,depth.npy}", mode: 'copy'
 
   input:
       path(gvcf)
+      path(gene_positions)
 
   
   output:
@@ -96,15 +98,21 @@ process processGVCF {
       path("*.variants.vcf"), emit: vcf
       path("*.consensus.vcf")
       path("*.txt")
+      path("*.coverage.tsv"), optional: true
+      path("*.depth.npy")
 
   when:
       gvcf.size()>0
 
   script:
+      def coverage = gene_positions ? "-g ${gene_positions} --coverage-output ${gvcf.baseName}.coverage.tsv" : ''
       """
       process_gvcf.py -d ${params.var_MinDepth} \
       -l ${params.lower_ambiguityFrequency} \
       -u ${params.upper_ambiguityFrequency} \
+      -t ${task.cpus} \
+      $coverage \
+      --depth-track-output ${gvcf.baseName}.depth.npy \
       -m ${gvcf.baseName}.mask.txt \
       -v ${gvcf.baseName}.variants.vcf \
       -c ${gvcf.baseName}.consensus.vcf ${gvcf}
@@ -115,6 +123,7 @@ process processGVCF {
 process surveillanceRawTsv {
 
   tag {"Generating Raw Surveillance Data (TSV)"}
+  label 'process_medium'
 
   publishDir "${params.outdir}/${params.prefix}/${task.process.replaceAll(":","_")}", pattern: "*.tsv", mode: 'copy'
 
@@ -137,7 +146,8 @@ process surveillanceRawTsv {
     gvf2tsv.py --gvf_files ${gvf} \
     --clades ${variants} \
     --table ${stats} \
-    --all_variants
+    --all_variants \
+    --workers $task.cpus
 
     """
   }
@@ -148,11 +158,12 @@ process surveillanceRawTsv {
 process surveillancePDF {
 
   tag {"Generating Surveillance reports PDF"}
+  label 'process_medium'
 
   publishDir "${params.outdir}/${params.prefix}/${task.process.replaceAll(":","_")}", pattern: "*.pdf", mode: 'copy'
 
   input:
-      each tsv
+      path(tsv)
       path(surveillanceindicators)
       path(metadata)
 
@@ -166,19 +177,22 @@ process surveillancePDF {
     surveillance_report_pdf.py --tsv ${tsv} \
     --functions_table ${surveillanceindicators} \
     --metadata ${metadata} \
-    --virusseq True > ${tsv.baseName}.tex
-
-    tectonic -X compile ${tsv.baseName}.tex --reruns 3 --keep-intermediates --keep-logs
-
+    --virusseq True \
+    --outdir . \
+    --workers $task.cpus \
+    --compile \
+    --compile_jobs $task.cpus
 
     """
   }
   else{
     """
     surveillance_report_pdf.py --tsv ${tsv} \
-    --functions_table ${surveillanceindicators} > ${tsv.baseName}.tex 
-    
-    tectonic -X compile ${tsv.baseName}.tex --reruns 3 --keep-intermediates --keep-logs
+    --functions_table ${surveillanceindicators} \
+    --outdir . \
+    --workers $task.cpus \
+    --compile \
+    --compile_jobs $task.cpus
 
     """
   }
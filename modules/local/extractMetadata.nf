@@ -1,5 +1,6 @@
 process extractMetadata {
     tag "$meta.id"
+    label 'process_medium'
 
     conda "bioconda::pandas=1.4.3"
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
@@ -22,6 +23,7 @@ process extractMetadata {
         //def prefix = voc ? "${meta2.id}" : "${params.enddate}"
         //def prefix = task.ext.prefix ?: "${meta2.id}"
         def time = time ? "--startdate ${params.startdate} --enddate ${params.enddate}" : ''
+        def chunks = params.metadata_chunksize ? "--chunksize ${params.metadata_chunksize}" : ''
 
 
         """
@@ -29,8 +31,43 @@ process extractMetadata {
         ${time} \\
         --table ${metadata} \\
         --criteria ${params.grouping_criteria} \\
+        --workers $task.cpus \\
+        ${chunks} \\
         ${voc} 
 
         
         """
-}
\ No newline at end of file
+}
+
+process EXTRACTMETADATA_PARTITION {
+    tag "$meta.id"
+
+    conda "bioconda::pandas=1.4.3"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+    'https://depot.galaxyproject.org/singularity/pandas:1.4.3' : ''}"
+
+    publishDir "${params.outdir}/${params.prefix}/${task.process.replaceAll(":","_")}", pattern: "*.tsv", mode: 'copy'
+
+    input:
+        tuple val(meta), path(metadata)
+        tuple val(meta2), path(lineages)
+    
+    output:
+    
+        path("*_metadata.tsv.gz"), emit: tsv
+        path("*.txt"), emit: txt
+
+    script:
+        def chunks = params.metadata_chunksize ? "--chunksize ${params.metadata_chunksize}" : ''
+
+        """
+        extract_metadata.py \\
+        --table ${metadata} \\
+        --criteria lineage \\
+        ${chunks} \\
+        --partition ${lineages} \\
+        --outdir .
+
+        
+        """
+}
@@ -0,0 +1,48 @@
+process GVFANNOTATE {
+
+  tag "$meta.id"
+
+  conda "bioconda::pandas=1.4.3"
+  container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/pandas:1.4.3' : '' }"
+  
+  input:
+      tuple val(meta), path(vcf)
+      path stats
+      val threshold
+      tuple val(meta2), path(json)
+      path gene_index
+      tuple val(meta3), path(split_tsv)
+      tuple val(meta4), path(functions_tsv)
+      tuple val(meta5), path(variants_tsv)
+      val lineage
+          
+  output:
+      tuple val(meta), path("*.gvf"), emit: gvf
+
+  script:
+
+  def args = task.ext.args ?: ''
+  def prefix = task.ext.prefix ?: "${meta.id}"
+  def strain = lineage ? "--strain ${prefix}" : ''
+  def stat     = stats ? "--size_stats ${stats}" : ''
+  def index = gene_index ? "--gene_positions_index ${gene_index}" : ''
+  def split     = split_tsv ? "--names_to_split ${split_tsv}" : ''
+  def functions     = functions_tsv ? "--functional_annotations ${functions_tsv}" : ''
+
+  """
+    gvf_annotate.py --vcffile $vcf \\
+      $stat \\
+      --clades_threshold $threshold \\
+      --gene_positions $json \\
+      $index \\
+      $split \\
+      $functions \\
+      --clades $variants_tsv \\
+      $strain \\
+      $args \\
+      --outgvf ${prefix}_annotated.gvf
+
+  """
+
+}
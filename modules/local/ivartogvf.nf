@@ -0,0 +1,41 @@
+process IVARTOGVF {
+
+  tag "$meta.id"
+
+  conda "bioconda::pandas=1.4.3 conda-forge::pyarrow=8.0.0"
+  container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/pandas:1.4.3' : '' }"
+
+  input:
+      tuple val(meta), path(tsv), path(stats)
+      val threshold
+      tuple val(meta3), path(json)
+      path gene_index
+      path reference
+
+  output:
+      tuple val(meta), path("*.{gvf,parquet}"), emit: gvf
+
+  script:
+
+  def args = task.ext.args ?: ''
+  def prefix = task.ext.prefix ?: "${meta.id}"
+  def stat     = stats ? "--size_stats ${stats}" : ''
+  def fasta = reference ? "--reference ${reference}" : ''
+  def index = gene_index ? "--gene_positions_index ${gene_index}" : ''
+  def format = params.gvf_format == 'parquet' ? 'parquet' : 'gvf'
+
+  """
+    ivar2gvf.py --ivar_tsv $tsv \\
+      $stat \\
+      $fasta \\
+      --clades_threshold $threshold \\
+      --gene_positions $json \\
+      $index \\
+      $args \\
+      --format $format \\
+      --outgvf ${prefix}.${format}
+
+  """
+
+}
@@ -2,7 +2,7 @@ process NCOVSPLITMUTATIONSGVF {
 
   tag "$meta.id"
 
-  conda "bioconda::pandas=1.4.3"
+  conda "bioconda::pandas=1.4.3 conda-forge::pyarrow=8.0.0"
   container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'https://depot.galaxyproject.org/singularity/pandas:1.4.3' : '' }"
   
@@ -11,18 +11,20 @@ process NCOVSPLITMUTATIONSGVF {
       tuple val(meta2), path(tsv)
 
   output:
-      tuple val(meta), path("*.gvf"), emit: gvf
+      tuple val(meta), path("*.{gvf,parquet}"), emit: gvf
 
   script:
 
   def args = task.ext.args ?: ''
   def prefix = task.ext.prefix ?: "${meta.id}"
+  def format = params.gvf_format == 'parquet' ? 'parquet' : 'gvf'
 
   """
     splitmutationnames_gvf.py --ingvf $gvf \\
       --names_to_split $tsv \\
       $args \\
-      --outgvf ${prefix}.processed.gvf 
+      --format $format \\
+      --outgvf ${prefix}.processed.${format}
 
   """
 }
\ No newline at end of file
@@ -2,7 +2,7 @@ process VCFTOGVF {
 
   tag "$meta.id"
 
-  conda "bioconda::pandas=1.4.3"
+  conda "bioconda::pandas=1.4.3 conda-forge::pyarrow=8.0.0"
   container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'https://depot.galaxyproject.org/singularity/pandas:1.4.3' : '' }"
   
@@ -11,27 +11,83 @@ process VCFTOGVF {
       path stats
       val threshold
       tuple val(meta3), path(json)
+      path gene_index
       val lineage
           
   output:
-      tuple val(meta), path("*.gvf"), emit: gvf
+      tuple val(meta), path("*.{gvf,parquet}"), emit: gvf
 
   script:
 
   def args = task.ext.args ?: ''
   def prefix = task.ext.prefix ?: "${meta.id}"
-  def strain = lineage ? "--strain ${prefix}" : ''
+  def strain = lineage ? "--strain ${meta.id}" : ''
   def stat     = stats ? "--size_stats ${stats}" : ''
+  def index = gene_index ? "--gene_positions_index ${gene_index}" : ''
+  def format = params.gvf_format == 'parquet' ? 'parquet' : 'gvf'
 
   """
     vcf2gvf.py --vcffile $vcf \\
       $stat \\
       --clades_threshold $threshold \\
       --gene_positions $json \\
+      $index \\
       $strain \\
       $args \\
-      --outgvf ${prefix}.gvf
+      --format $format \\
+      --outgvf ${prefix}.${format}
 
   """
 
-}
\ No newline at end of file
+}
+
+process VCFTOGVF_BATCH {
+
+  tag "${metas.size()} VCFs"
+  label 'process_medium'
+
+  conda "bioconda::pandas=1.4.3 conda-forge::pyarrow=8.0.0"
+  container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/pandas:1.4.3' : '' }"
+  
+  input:
+      tuple val(metas), path(vcfs)
+      path stats
+      val threshold
+      tuple val(meta3), path(json)
+      path gene_index
+      val lineage
+          
+  output:
+      // metas and GVF names in input order, to pair GVFs with their meta
+      tuple val(metas), val(gvf_names), path("*.{gvf,parquet}"), emit: gvf
+
+  script:
+
+  def args = task.ext.args ?: ''
+  def stat     = stats ? "--size_stats ${stats}" : ''
+  def index = gene_index ? "--gene_positions_index ${gene_index}" : ''
+  def format = params.gvf_format == 'parquet' ? 'parquet' : 'gvf'
+  // ext.prefix has one value per task, so GVFs are named by their meta
+  gvf_names = metas.collect { meta -> "${meta.id}.${format}" }
+  // one line per VCF: vcf, strain, output GVF
+  def manifest = [metas, vcfs instanceof List ? vcfs : [vcfs], gvf_names]
+      .transpose()
+      .collect { meta, vcf, gvf_name -> "${vcf}\t${lineage ? meta.id : 'n/a'}\t${gvf_name}" }
+      .join('\n')
+
+  """
+    printf '%s\\n' "${manifest}" > vcf_list.tsv
+
+    vcf2gvf.py --vcf_list vcf_list.tsv \\
+      --workers $task.cpus \\
+      --format $format \\
+      $stat \\
+      --clades_threshold $threshold \\
+      --gene_positions $json \\
+      $index \\
+      $args
+
+  """
+
+}
@@ -7,6 +7,7 @@ nextflow.enable.dsl = 2
 
 include { SNPEFF_ANN                    } from '../../modules/local/snpeff_ann'
 include { VCFTOGVF                      } from '../../modules/local/vcftogvf'
+include { VCFTOGVF_BATCH                } from '../../modules/local/vcftogvf'
 include { TAGPROBLEMATICSITES_NCOV      } from '../../modules/local/tagproblematicsites_ncov'
 include { ANNOTATEMATPEPTIDES_NCOV      } from '../../modules/local/annotatematpeptides_ncov'
 
@@ -40,29 +41,66 @@ workflow ANNOTATION {
 
         if (!params.skip_mat_peptide_annottaion && !params.mpox){
           
+            peptide_index = file(params.mat_peptides_index, checkIfExists: true)
             ANNOTATEMATPEPTIDES_NCOV(
               annotation_vcf,
-              params.viral_gff
+              params.viral_gff,
+              peptide_index
             )
             annotation_vcf=ANNOTATEMATPEPTIDES_NCOV.out.vcf
         }
         
         //VCF to GVF transformation
+        //(done in GVF_PROCESSING_ANNOTATION if params.fused_gvf_annotation)
         
-        json_file = file(params.genecoord, checkIfExists: true)
-        json = [ [ id:params.viral_genome_id ], [ json_file ] ]
-        threshold=0.75
-        
-        VCFTOGVF(
-            annotation_vcf,
-            ch_stats.map{it[1]},
-            threshold,
-            json, 
-            true
-            )
-        gvf = VCFTOGVF.out.gvf
+        gvf = Channel.empty()
+        if (!params.fused_gvf_annotation){
+            json_file = file(params.genecoord, checkIfExists: true)
+            json = [ [ id:params.viral_genome_id ], [ json_file ] ]
+            gene_index = file(params.genecoord_index, checkIfExists: true)
+            threshold=0.75
+            
+            if (params.vcf2gvf_batch_size > 1){
+                // convert VCFs in batches, one vcf2gvf.py run per batch
+                annotation_vcf
+                    .buffer(size: params.vcf2gvf_batch_size, remainder: true)
+                    .map { batch -> [ batch.collect{ it[0] }, batch.collect{ it[1] } ] }
+                    .set { vcf_batches }
+
+                VCFTOGVF_BATCH(
+                    vcf_batches,
+                    ch_stats.map{it[1]},
+                    threshold,
+                    json,
+                    gene_index,
+                    true
+                    )
+                // pair each GVF with the meta of its VCF, by position
+                VCFTOGVF_BATCH.out.gvf
+                    .flatMap { metas, gvf_names, gvf_files ->
+                        def gvf_by_name = (gvf_files instanceof List ? gvf_files : [gvf_files])
+                            .collectEntries { gvf_file -> [ gvf_file.getName(), gvf_file ] }
+                        [ metas, gvf_names ].transpose()
+                            .collect { meta, gvf_name -> [ meta, gvf_by_name[gvf_name] ] }
+                    }
+                    .set { gvf }
+            }
+            else {
+                VCFTOGVF(
+                    annotation_vcf,
+                    ch_stats.map{it[1]},
+                    threshold,
+                    json,
+                    gene_index,
+                    true
+                    )
+                gvf = VCFTOGVF.out.gvf
+            }
+        }
+        vcf = annotation_vcf
 
         
     emit:
         gvf
+        vcf
 }
@@ -8,52 +8,102 @@ include { NCOVSPLITMUTATIONSGVF                     } from '../../modules/local/
 include { NCOVSPLITMUTATIONSPOKAY             } from '../../modules/local/splitmutations_pokay'
 include { FUNCTIONALANNOTATION                  } from '../../modules/local/addFunctionalAnnotation'
 include { VARIANTANNOTATION                  } from '../../modules/local/addVariantAnnotation'
+include { GVFANNOTATE                  } from '../../modules/local/gvfannotate'
 
 
 workflow GVF_PROCESSING_ANNOTATION {
     take:
         annotation_gvf
+        annotation_vcf
+        ch_stats
         
     main:
 
-        
-        if(!params.mpox){
-            functional_annotation = file(params.funcannot, checkIfExists: true)
-            func = [ [ id:params.viral_genome_id ],  functional_annotation  ]
-            
-            split_names = file(params.mutationsplit, checkIfExists: true)
-            split_tsv = [ [ id:params.viral_genome_id ],  split_names  ]
-            
-            if(!params.skip_splitting_mutations){
-                
-                NCOVSPLITMUTATIONSPOKAY(
-                    func,
-                    split_tsv
-                )
+        if(params.fused_gvf_annotation){
+            // vcf2gvf, name splitting, functional and variant annotation
+            // in a single process per lineage
+            json_file = file(params.genecoord, checkIfExists: true)
+            json = [ [ id:params.viral_genome_id ], [ json_file ] ]
+            gene_index = file(params.genecoord_index, checkIfExists: true)
+            threshold=0.75
 
-                NCOVSPLITMUTATIONSGVF(
-                    annotation_gvf,
-                    split_tsv
-                )
+            variant_annotation = file(params.variant, checkIfExists: true)
+            variant_tsv = [ [ id:params.viral_genome_id ],  variant_annotation  ]
+
+            split_tsv = [ [ id:params.viral_genome_id ], [] ]
+            func_tsv = [ [ id:params.viral_genome_id ], [] ]
+            if(!params.mpox){
+                functional_annotation = file(params.funcannot, checkIfExists: true)
+                func = [ [ id:params.viral_genome_id ],  functional_annotation  ]
+                func_tsv = func
+
+                if(!params.skip_splitting_mutations){
+                    split_names = file(params.mutationsplit, checkIfExists: true)
+                    split_tsv = [ [ id:params.viral_genome_id ],  split_names  ]
+
+                    NCOVSPLITMUTATIONSPOKAY(
+                        func,
+                        split_tsv
+                    )
+                    func_tsv = NCOVSPLITMUTATIONSPOKAY.out.tsv
+                }
             }
-            
-            FUNCTIONALANNOTATION(
-                NCOVSPLITMUTATIONSGVF.out.gvf,
-                NCOVSPLITMUTATIONSPOKAY.out.tsv
+
+            GVFANNOTATE(
+                annotation_vcf,
+                ch_stats.map{it[1]},
+                threshold,
+                json,
+                gene_index,
+                split_tsv,
+                func_tsv,
+                variant_tsv,
+                true
             )
-            annotation_gvf=FUNCTIONALANNOTATION.out.gvf
-            
+            annotation_gvf=GVFANNOTATE.out.gvf
+        }
+        else {
+            if(!params.mpox){
+                functional_annotation = file(params.funcannot, checkIfExists: true)
+                func = [ [ id:params.viral_genome_id ],  functional_annotation  ]
+
+                split_names = file(params.mutationsplit, checkIfExists: true)
+                split_tsv = [ [ id:params.viral_genome_id ],  split_names  ]
+
+                if(!params.skip_splitting_mutations){
 
+                    NCOVSPLITMUTATIONSPOKAY(
+                        func,
+                        split_tsv
+                    )
+
+                    NCOVSPLITMUTATIONSGVF(
+                        annotation_gvf,
+                        split_tsv
+                    )
+                }
+
+                annotation_index = file(params.funcannot_index, checkIfExists: true)
+
+                FUNCTIONALANNOTATION(
+                    NCOVSPLITMUTATIONSGVF.out.gvf,
+                    NCOVSPLITMUTATIONSPOKAY.out.tsv,
+                    annotation_index
+                )
+                annotation_gvf=FUNCTIONALANNOTATION.out.gvf
+
+
+            }
+            variant_annotation = file(params.variant, checkIfExists: true)
+            variant_tsv = [ [ id:params.viral_genome_id ],  variant_annotation  ]
+
+            VARIANTANNOTATION(
+                annotation_gvf,
+                variant_tsv,
+                true
+            )
+            annotation_gvf=VARIANTANNOTATION.out.gvf
         }
-        variant_annotation = file(params.variant, checkIfExists: true)
-        variant_tsv = [ [ id:params.viral_genome_id ],  variant_annotation  ]
-    
-        VARIANTANNOTATION(
-            annotation_gvf,
-            variant_tsv,
-            true
-        )
-        annotation_gvf=VARIANTANNOTATION.out.gvf
         
 
     emit:
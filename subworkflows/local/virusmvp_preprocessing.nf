@@ -5,6 +5,7 @@ nextflow.enable.dsl = 2
 // import modules
 include { EXTRACTVARIANTS       } from '../../modules/local/extractVariants'
 include { extractMetadata       } from '../../modules/local/extractMetadata'
+include { EXTRACTMETADATA_PARTITION } from '../../modules/local/extractMetadata'
 include { SEQKIT_GREP           } from '../../modules/nf-core/seqkit/grep/main'
 
 
@@ -36,12 +37,26 @@ workflow PREPROCESSING {
             .map{id, voc -> tuple([[id:voc.trim()], voc.trim()])} 
             .set{ ch_voc }
 
-        if(params.grouping_criteria == 'lineage'){
+        if(params.grouping_criteria == 'lineage' && params.partition_metadata){
+          // one pass over the metadata for all lineages
+          EXTRACTMETADATA_PARTITION(metadata, EXTRACTVARIANTS.out.txt)
+          EXTRACTMETADATA_PARTITION.out.tsv
+            .flatten()
+            .map{ tsv -> [ [ id:tsv.getName() - '_metadata.tsv.gz' ], tsv ] }
+            .set{ metadata_tsv }
+          EXTRACTMETADATA_PARTITION.out.txt
+            .flatten()
+            .map{ txt -> [ [ id:txt.getBaseName() ], txt ] }
+            .set{ ids }
+        }
+        else if(params.grouping_criteria == 'lineage'){
           extractMetadata(metadata, ch_voc, [])
           ids=extractMetadata.out.txt
+          metadata_tsv=extractMetadata.out.tsv
         }
         else{
           extractMetadata(metadata, [], true)
+          metadata_tsv=extractMetadata.out.tsv
           //ids=extractMetadata.out.txt.flatten()
           //metadata=extractMetadata.out.tsv.flatten()
         }
@@ -50,7 +65,7 @@ workflow PREPROCESSING {
         SEQKIT_GREP(sequences, ids.map{it[1]})
 
   emit:
-      metadata = extractMetadata.out.tsv
+      metadata = metadata_tsv
       sequences = SEQKIT_GREP.out.filter
       
 
@@ -140,7 +140,7 @@ workflow COVIDMVP {
         ANNOTATION(annotation_vcf, ch_snpeff_db, ch_snpeff_config, params.viral_genome, ch_stats)
         annotation_gvf=ANNOTATION.out.gvf
 
-        GVF_PROCESSING_ANNOTATION(annotation_gvf)
+        GVF_PROCESSING_ANNOTATION(annotation_gvf, ANNOTATION.out.vcf, ch_stats)
         
         //if(!params.skip_postprocessing){
         //    POSTPROCESSING()
@@ -100,7 +100,7 @@ workflow POXMVP {
         ANNOTATION(annotation_vcf, ch_snpeff_db, ch_snpeff_config, params.viral_genome, ch_stats)
         gvf_file=ANNOTATION.out.gvf
 
-        GVF_PROCESSING_ANNOTATION(gvf_file)
+        GVF_PROCESSING_ANNOTATION(gvf_file, ANNOTATION.out.vcf, ch_stats)
 
         
 
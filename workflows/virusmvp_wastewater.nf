@@ -27,6 +27,7 @@ include { FREYJA_DEMIX                                              } from '../m
 include { FREYJA_VARIANTS                                           } from '../modules/nf-core/freyja/variants/main'
 //include { FREYJA_BOOT                                           } from '../modules/nf-core/freyja/boot/main'
 include { IVAR_VARIANTS_TO_VCF  as WW_IVAR_VARIANTS_TO_VCF          } from '../modules/local/custom'
+include { IVARTOGVF                                                 } from '../modules/local/ivartogvf'
 
 include {INPUT_CHECK            } from '../subworkflows/local/input_check'
 //include { BAM_VARIANT_DEMIX_BOOT_FREYJA } from '../subworkflows/nf-core/bam_variant_demix_boot_freyja/main'
@@ -206,6 +207,24 @@ workflow WASTEWATER {
         ch_versions = ch_versions.mix(FREYJA_DEMIX.out.versions.first())
         
         WW_IVAR_VARIANTS_TO_VCF(FREYJA_VARIANTS.out.variants)
+
+        // GVF straight from the iVar variants, without snpEff
+        ch_gvf = Channel.empty()
+        if (params.ivar2gvf){
+            json_file = file(params.genecoord, checkIfExists: true)
+            json = [ [ id:params.viral_genome_id ], [ json_file ] ]
+            gene_index = file(params.genecoord_index, checkIfExists: true)
+            threshold=0.75
+
+            IVARTOGVF(
+                FREYJA_VARIANTS.out.variants.join(WW_SEQKIT_STATS.out.stats),
+                threshold,
+                json,
+                gene_index,
+                params.viral_genome
+            )
+            ch_gvf = IVARTOGVF.out.gvf
+        }
     
     
 
@@ -213,6 +232,7 @@ workflow WASTEWATER {
     emit:
         stats          = WW_SEQKIT_STATS.out.stats
         vcf            = WW_IVAR_VARIANTS_TO_VCF.out.vcf
+        gvf            = ch_gvf                        // channel: [ val(meta), path(gvf) ]
         variants       = FREYJA_VARIANTS.out.variants  // channel: [ val(meta), path(variants_tsv) ]
         //depths         = FREYJA_VARIANTS.out.depths    // channel: [ val(meta), path(depths_tsv) ]
         demix          = FREYJA_DEMIX.out.demix        // channel: [ val(meta), path(demix_tsv) ]